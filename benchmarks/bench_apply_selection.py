@@ -0,0 +1,149 @@
+"""Benchmark apply-selection on synthetic subtomogram and subset stars.
+
+Run from the repository root, e.g.:
+
+    python benchmarks/bench_apply_selection.py --stars 400 --particles 2500
+
+"""
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+import starfile
+
+from subtomotools import particle_operations
+
+
+def legacy_apply_subset(subset_star, subtomo_stars):
+    """Reference implementation, as shipped up to subtomotools 0.1.2."""
+    subset = starfile.read(subset_star, always_dict=True)
+    subset = subset["particles"]
+
+    subset["origin_star"] = subset["rlnImageName"].str.split("@", expand=True)[1]
+
+    for st_star in subtomo_stars:
+        fullset_3d = starfile.read(st_star, always_dict=True)
+        subset_2d = subset[
+            subset["rlnImageName"].str.split("@", expand=True)[1]
+            == f"{Path(st_star).stem}_projected.mrcs"
+        ]
+
+        selected_idx = subset_2d["rlnImageName"].str.split("@", expand=True)[0].tolist()
+        selected_idx = [int(idx) - 1 for idx in selected_idx]
+
+        subset_3d = fullset_3d["particles"].iloc[selected_idx].copy()
+
+        subset_3d["rlnAnglePsi"] = list(subset_2d["rlnAnglePsi"])
+        subset_3d["rlnOriginXAngst"] = list(subset_2d["rlnOriginXAngst"])
+        subset_3d["rlnOriginYAngst"] = list(subset_2d["rlnOriginXAngst"])
+
+        if "rlnClassNumber" in subset_2d:
+            subset_3d["rlnClassNumber"] = list(subset_2d["rlnClassNumber"])
+
+        starfile.write(
+            {"optics": fullset_3d["optics"], "particles": subset_3d},
+            Path(st_star).with_name(f"{Path(st_star).stem}_selected.star"),
+        )
+
+
+def make_dataset(folder: Path, n_stars: int, n_particles: int, fraction: float):
+    """Write subtomogram stars and a shuffled 2D subset star selecting from them."""
+    rng = np.random.default_rng(0)
+    optics = pd.DataFrame(
+        {"rlnOpticsGroup": [1], "rlnMicrographPixelSize": [2.0], "rlnImageSize": [64]}
+    )
+    subtomo_stars, subsets = [], []
+
+    for i in range(n_stars):
+        particles = pd.DataFrame(
+            {
+                "rlnMicrographName": f"tomo{i}.tomostar",
+                "rlnCoordinateX": rng.uniform(0, 1000, n_particles),
+                "rlnCoordinateY": rng.uniform(0, 1000, n_particles),
+                "rlnCoordinateZ": rng.uniform(0, 300, n_particles),
+                "rlnAnglePsi": 0.0,
+                "rlnImageName": [f"tomo{i}/p{j}.mrc" for j in range(n_particles)],
+                "rlnOpticsGroup": 1,
+            }
+        )
+        star = folder / f"tomo{i}.star"
+        starfile.write({"optics": optics, "particles": particles}, star)
+        subtomo_stars.append(str(star))
+
+        selected = np.flatnonzero(rng.uniform(size=n_particles) < fraction)
+        subsets.append(
+            pd.DataFrame(
+                {
+                    "rlnImageName": [
+                        f"{j + 1}@tomo{i}_projected.mrcs" for j in selected
+                    ],
+                    "rlnAnglePsi": rng.uniform(-180, 180, len(selected)),
+                    "rlnOriginXAngst": rng.normal(0, 5, len(selected)),
+                    "rlnOriginYAngst": rng.normal(0, 5, len(selected)),
+                    "rlnClassNumber": rng.integers(1, 50, len(selected)),
+                }
+            )
+        )
+
+    subset = pd.concat(subsets, ignore_index=True).sample(frac=1, random_state=0)
+    starfile.write({"optics": optics, "particles": subset}, folder / "subset.star")
+
+    return str(folder / "subset.star"), subtomo_stars
+
+
+def read_outputs(subtomo_stars):
+    """Read all _selected.star outputs."""
+    return [
+        starfile.read(Path(st_star).with_name(f"{Path(st_star).stem}_selected.star"))
+        for st_star in subtomo_stars
+    ]
+
+
+@click.command()
+@click.option("--stars", default=100, show_default=True, help="Subtomogram stars.")
+@click.option("--particles", default=2500, show_default=True, help="Per star.")
+@click.option("--fraction", default=0.5, show_default=True, help="Selected in 2D.")
+@click.option("--jobs", "-j", default=4, show_default=True, help="Worker processes.")
+def main(stars, particles, fraction, jobs):
+    """Compare grouped apply-selection against the legacy implementation."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+
+        try:
+            subset_star, subtomo_stars = make_dataset(
+                Path(tmp), stars, particles, fraction
+            )
+
+            start = time.perf_counter()
+            legacy_apply_subset(subset_star, subtomo_stars)
+            legacy_time = time.perf_counter() - start
+            expected = read_outputs(subtomo_stars)
+
+            for n_jobs in sorted({1, jobs}):
+                start = time.perf_counter()
+                particle_operations.apply_subset.callback(
+                    n_jobs, subset_star, subtomo_stars
+                )
+                new_time = time.perf_counter() - start
+
+                for old, new in zip(expected, read_outputs(subtomo_stars)):
+                    pd.testing.assert_frame_equal(
+                        old["particles"], new["particles"], check_dtype=False
+                    )
+
+                print(
+                    f"{stars} stars x {particles} particles, jobs={n_jobs}: "
+                    f"legacy {legacy_time:.2f} s, grouped {new_time:.2f} s "
+                    f"({legacy_time / new_time:.1f}x, identical output)"
+                )
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Benchmark 3D deduplication on synthetic point clouds.
+
+Run from the repository root, e.g.:
+
+    python benchmarks/bench_dedup.py --sizes 100000 1000000 10000000
+
+"""
+import time
+
+import click
+import numpy as np
+from synthetic import synthetic_cloud
+
+from subtomotools import utils
+
+
+def legacy_list_close(positions: np.array, exclusion_dist: int):
+    """Reference O(N^2) implementation, as shipped up to subtomotools 0.1.2."""
+    exclude_list = []
+
+    for i in range(len(positions)):
+        if i in exclude_list:
+            continue
+
+        exclude_idx = np.where(
+            utils.euclidean_dist_3D(positions, positions[i]) < exclusion_dist
+        )[0]
+
+        if len(exclude_idx) > 1:
+            exclude_list.extend(exclude_idx[exclude_idx != i].tolist())
+
+    return exclude_list
+
+
+def timed(func, *args):
+    """Return result and wall time of func(*args)."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+@click.command()
+@click.option(
+    "--sizes",
+    "-n",
+    type=int,
+    multiple=True,
+    default=(100_000, 1_000_000, 10_000_000),
+    show_default=True,
+    help="Number of points per cloud, can be given multiple times.",
+)
+@click.option("--radius", "-r", default=10, show_default=True, help="Radius in px.")
+@click.option(
+    "--neighbours",
+    default=0.5,
+    show_default=True,
+    help="Mean number of other points within the radius of each point.",
+)
+@click.option(
+    "--legacy-max",
+    default=20_000,
+    show_default=True,
+    help="Largest size for which the O(N^2) implementation is actually run.",
+)
+def main(sizes, radius, neighbours, legacy_max):
+    """Compare grid-hashed list_close against the legacy O(N^2) scan."""
+    # Calibrate the legacy implementation at a size where it still finishes
+    calibration = min(legacy_max, *sizes)
+    points = synthetic_cloud(calibration, radius, neighbours)
+    expected, legacy_ref = timed(legacy_list_close, points, radius)
+    result, _ = timed(utils.list_close, points, radius)
+
+    if sorted(set(expected)) != result:
+        raise click.ClickException("Grid and legacy results differ!")
+
+    print(f"Legacy scan: {calibration} points in {legacy_ref:.2f} s (identical).\n")
+    print(f"{'points':>12} {'removed':>10} {'grid [s]':>10} {'NMS [s]':>10} "
+          f"{'legacy [s]':>12} {'speedup':>10}")
+
+    for n_points in sizes:
+        points = synthetic_cloud(n_points, radius, neighbours)
+        removed, grid_time = timed(utils.list_close, points, radius)
+
+        # Score-aware mode, random scores
+        scores = np.random.default_rng(1).uniform(size=n_points)
+        _, nms_time = timed(utils.list_close, points, radius, scores)
+
+        if n_points <= legacy_max:
+            _, legacy_time = timed(legacy_list_close, points, radius)
+            legacy_label = f"{legacy_time:.2f}"
+        else:
+            # Extrapolate quadratically from the calibration run
+            legacy_time = legacy_ref * (n_points / calibration) ** 2
+            legacy_label = f"~{legacy_time:.0f}"
+
+        print(
+            f"{n_points:>12} {len(removed):>10} {grid_time:>10.2f} {nms_time:>10.2f} "
+            f"{legacy_label:>12} {legacy_time / grid_time:>9.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Check startup cost of the command line tools.
+
+Fails (exit code 1) if showing the help of the subtomotools group or of the star
+commands (a real subcommand dispatch) loads heavy dependencies, or takes longer
+than the budget. Also compares one process per star against batch mode for many
+small stars. Run from the repository root, e.g.:
+
+    python benchmarks/bench_import.py --budget-ms 150
+
+"""
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import synthetic
+
+# Must not be imported to show help or dispatch a subcommand
+HEAVY_MODULES = ("numpy", "pandas", "mrcfile", "starfile", "tqdm", "scipy")
+
+# Command lines whose startup is checked, help of the group and of subcommands
+DISPATCHES = (
+    ("--help",),
+    ("dedup-3d", "--help"),
+    ("upgrade-star", "--help"),
+    ("downgrade-star", "--help"),
+)
+
+MODULES = (
+    "subtomotools.cli",
+    "subtomotools.star_operations",
+    "subtomotools.particle_operations",
+    "subtomotools.tomotwin_export",
+)
+
+
+def wall_time(args, repeat, cwd=None):
+    """Return median wall time of running args in s."""
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, check=True, capture_output=True, cwd=cwd)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def heavy_imports(args):
+    """Return heavy modules which are loaded by running subtomotools with args.
+
+    Modules imported through subtomotools.lazy, but not used, do not count.
+    """
+    code = (
+        "import sys, types\n"
+        f"sys.argv = ['subtomotools', *{list(args)!r}]\n"
+        "from subtomotools.cli import main\n"
+        "try:\n"
+        "    main()\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        f"print(' '.join(m for m in {HEAVY_MODULES!r} "
+        "if type(sys.modules.get(m)) is types.ModuleType))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+
+    # Last line, after the help text
+    return result.stdout.splitlines()[-1].split()
+
+
+@click.command()
+@click.option("--repeat", default=5, show_default=True, help="Runs per timing.")
+@click.option(
+    "--budget-ms",
+    default=150,
+    show_default=True,
+    help="Maximum startup time of 'subtomotools [command] --help'.",
+)
+@click.option(
+    "--stars", default=20, show_default=True, help="Small stars for batch mode."
+)
+def main(repeat, budget_ms, stars):
+    """Measure import times and batch mode against one process per star."""
+    failed = False
+
+    baseline = wall_time([sys.executable, "-c", "pass"], repeat)
+    print(f"{'interpreter':<40} {baseline * 1000:>8.0f} ms")
+
+    for module in MODULES:
+        seconds = wall_time([sys.executable, "-c", f"import {module}"], repeat)
+        print(f"{'import ' + module:<40} {seconds * 1000:>8.0f} ms")
+
+    for args in DISPATCHES:
+        name = " ".join(("subtomotools", *args))
+        seconds = wall_time([sys.executable, "-m", "subtomotools", *args], repeat)
+        print(f"{name:<40} {seconds * 1000:>8.0f} ms")
+
+        if seconds * 1000 > budget_ms:
+            print(f"FAIL: {name} exceeds budget of {budget_ms} ms.")
+            failed = True
+
+        heavy = heavy_imports(args)
+
+        if heavy:
+            print(f"FAIL: {name} imports {', '.join(heavy)}.")
+            failed = True
+
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        names = []
+
+        for i in range(stars):
+            star = synthetic.relion31_star(folder, 500, 2, seed=i)
+            names.append(star.rename(folder / f"tomo{i}.star").name)
+
+        command = [sys.executable, "-m", "subtomotools", "dedup-3d", "-r", "5"]
+
+        start = time.perf_counter()
+        for name in names:
+            subprocess.run([*command, name], check=True, capture_output=True,
+                           cwd=folder)
+        single = time.perf_counter() - start
+
+        batch = wall_time([*command, *names], 1, cwd=folder)
+
+    print(f"\ndedup-3d on {stars} stars: one process each {single:.2f} s, "
+          f"batch mode {batch:.2f} s ({single / batch:.1f}x)")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Check normalize_background against a straightforward per-image version.
+
+This is a self-consistency check of the batched code, not a comparison with
+RELION: the per-image version is our own reading of normalise() in RELION,
+one image at a time. The ramp is fitted by solving the normal equations
+accumulated over the background pixels (as subtractBackgroundRamp), and mean
+and stddev are taken from running sums (as calculateBackgroundAvgStddev).
+Equivalence with relion_preprocess --norm itself is not verified here.
+Checks even and odd boxes, with and without ramp, and times both. Fails
+(exit code 1) if they differ. Run from the repository root, e.g.:
+
+    python benchmarks/bench_normalization.py --box 64 --batch 256
+
+"""
+import sys
+import time
+
+import click
+import numpy as np
+
+from subtomotools.particle_operations import normalize_background
+
+
+def per_image_normalise(image: np.array, bg_radius: float, ramp: bool):
+    """Normalize one image, following our reading of normalise() in RELION."""
+    image = image.astype(np.float64)
+    size_y, size_x = image.shape
+
+    # Logical coordinates with the origin at (size // 2), as setXmippOrigin
+    background = [
+        (y - size_y // 2, x - size_x // 2)
+        for y in range(size_y)
+        for x in range(size_x)
+        if (y - size_y // 2) ** 2 + (x - size_x // 2) ** 2 > bg_radius**2
+    ]
+    ys, xs = np.array(background).T
+    values = image[ys + size_y // 2, xs + size_x // 2]
+
+    if ramp:
+        # Normal equations of the plane a * x + b * y + c
+        normal = np.array(
+            [
+                [np.sum(xs * xs), np.sum(xs * ys), np.sum(xs)],
+                [np.sum(xs * ys), np.sum(ys * ys), np.sum(ys)],
+                [np.sum(xs), np.sum(ys), len(xs)],
+            ],
+            dtype=np.float64,
+        )
+        rhs = np.array([np.sum(xs * values), np.sum(ys * values), np.sum(values)])
+        a, b, c = np.linalg.solve(normal, rhs)
+
+        y, x = np.indices(image.shape)
+        image = image - (a * (x - size_x // 2) + b * (y - size_y // 2) + c)
+        values = image[ys + size_y // 2, xs + size_x // 2]
+
+    mean = np.sum(values) / len(values)
+    std = np.sqrt(np.sum(values * values) / len(values) - mean * mean)
+
+    return (image - mean) / std
+
+
+def noisy_images(rng, batch: int, box: int):
+    """Return particle-like images: a blob on noise with a background ramp."""
+    y, x = np.indices((box, box)) - box // 2
+    blob = np.exp(-(x**2 + y**2) / (2 * (box / 8) ** 2))
+    slopes = rng.normal(scale=0.05, size=(batch, 2, 1, 1))
+
+    return (
+        5 * blob
+        + slopes[:, 0] * x
+        + slopes[:, 1] * y
+        + rng.normal(loc=3, scale=2, size=(batch, box, box))
+    ).astype(np.float32)
+
+
+@click.command()
+@click.option("--box", default=64, show_default=True, help="Image size in px.")
+@click.option("--batch", default=256, show_default=True, help="Images per batch.")
+@click.option(
+    "--tolerance",
+    default=1e-4,
+    show_default=True,
+    help="Largest allowed difference of normalized values (unit stddev).",
+)
+def main(box, batch, tolerance):
+    """Time normalize_background against the per-image version, check they agree."""
+    rng = np.random.default_rng(0)
+    failed = False
+
+    print(f"{'box':>6} {'ramp':>6} {'per image [s]':>14} {'batched [s]':>12} "
+          f"{'speedup':>10} {'max diff':>10}")
+
+    for size in (box, box + 1):
+        images = noisy_images(rng, batch, size)
+        bg_radius = 0.75 * size / 2
+
+        for ramp in (True, False):
+            start = time.perf_counter()
+            per_image = np.stack(
+                [per_image_normalise(image, bg_radius, ramp) for image in images]
+            )
+            per_image_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            batched = normalize_background(images, bg_radius, ramp)
+            batched_time = time.perf_counter() - start
+
+            difference = np.abs(per_image - batched).max()
+            failed |= difference > tolerance
+
+            print(
+                f"{size:>6} {ramp!s:>6} {per_image_time:>14.3f} "
+                f"{batched_time:>12.3f} {per_image_time / batched_time:>9.1f}x "
+                f"{difference:>10.1e}"
+            )
+
+    if failed:
+        print(f"FAIL: normalized images differ by more than {tolerance}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
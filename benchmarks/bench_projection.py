@@ -0,0 +1,87 @@
+"""Compare Fourier-slice and real-space projection with CTF.
+
+Checks that both methods give the same projections for both CTF layouts, with
+and without --z-thickness, and times them. Fails (exit code 1) if they differ.
+The equivalence (also without CTF and with --bin) is tested on small volumes in
+tests/test_particle_operations.py. Run from the repository root, e.g.:
+
+    python benchmarks/bench_projection.py --box 64 --batch 64
+
+"""
+import sys
+import time
+
+import click
+import numpy as np
+
+from subtomotools.particle_operations import get_fft_backend, project_batch
+
+
+def timed(func, *args, **kwargs):
+    """Return result and wall time of func(*args, **kwargs)."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+@click.command()
+@click.option("--box", default=64, show_default=True, help="Subtomogram size in px.")
+@click.option("--batch", default=64, show_default=True, help="Subtomograms per batch.")
+@click.option(
+    "--z-thickness",
+    "-z",
+    default=20,
+    show_default=True,
+    help="Slab thickness for the slab comparison.",
+)
+@click.option("--fft", default="numpy", show_default=True, help="FFT backend.")
+@click.option(
+    "--tolerance",
+    default=1e-5,
+    show_default=True,
+    help="Largest allowed difference, relative to the largest projected value.",
+)
+def main(box, batch, z_thickness, fft, tolerance):
+    """Time Fourier-slice against real-space projection and check equivalence."""
+    rng = np.random.default_rng(0)
+    backend = get_fft_backend(fft)
+    subtomos = rng.normal(size=(batch, box, box, box)).astype(np.float32)
+
+    layouts = {
+        "rfftn": rng.uniform(size=(batch, box, box, box // 2 + 1)),
+        "fftn": rng.uniform(size=(batch, box, box, box)),
+    }
+    failed = False
+
+    print(f"{'CTF layout':<12} {'z-thickness':>12} {'real [s]':>10} "
+          f"{'fourier [s]':>12} {'speedup':>10} {'max rel. diff':>14}")
+
+    for layout, ctf_volumes in layouts.items():
+        ctf_volumes = ctf_volumes.astype(np.float32)
+
+        for thickness in (None, z_thickness):
+            real, real_time = timed(
+                project_batch, subtomos, ctf_volumes, thickness, backend,
+                method="real",
+            )
+            fourier, fourier_time = timed(
+                project_batch, subtomos, ctf_volumes, thickness, backend,
+                method="fourier",
+            )
+
+            difference = np.abs(real - fourier).max() / np.abs(real).max()
+            failed |= difference > tolerance
+
+            print(
+                f"{layout:<12} {thickness or 'all':>12} {real_time:>10.3f} "
+                f"{fourier_time:>12.3f} {real_time / fourier_time:>9.1f}x "
+                f"{difference:>14.1e}"
+            )
+
+    if failed:
+        print(f"FAIL: projections differ by more than {tolerance}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
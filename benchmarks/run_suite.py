@@ -0,0 +1,379 @@
+"""Run every command line tool on a synthetic dataset and report timings.
+
+Each command runs in a fresh interpreter, so wall time includes imports and peak
+memory (max RSS) is that of the command alone. Results are written as JSON,
+together with the git commit and the stage timings each command records with
+--metrics-json, to compare across commits. Run from the repository root, e.g.:
+
+    python benchmarks/run_suite.py --particles 100000 --report before.json
+    python benchmarks/run_suite.py --particles 100000 --compare before.json
+
+tomotwin-pipeline is not included, as it needs TomoTwin installed.
+"""
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+import synthetic
+
+REPO = Path(__file__).resolve().parents[1]
+
+
+def git_commit():
+    """Return the commit hash of the repository, with -dirty for local changes."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=REPO, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return f"{commit}-dirty" if dirty else commit
+
+
+# Stars merged by merge-stars, shards merged by merge-shards
+MERGE_PARTS = 8
+SHARDS = 4
+# Shape (ZYX) of the tomograms of make-masks
+MASK_SHAPE = (100, 512, 512)
+
+
+def make_dataset(folder: Path, n_particles, n_project, n_tomograms, box):
+    """Generate all inputs of the suite in folder."""
+    print(f"Generating dataset with {n_particles} particles in {folder}.")
+
+    warp = synthetic.warp_star(folder, n_particles, n_tomograms)
+    # upgrade-star only probes the first subtomogram
+    synthetic.subtomo_volumes(folder, warp, box, limit=1)
+
+    relion31 = synthetic.relion31_star(folder, n_particles, n_tomograms)
+    synthetic.relion5_star(folder, n_particles, n_tomograms)
+    synthetic.subset_star(folder, relion31, fraction=0.5)
+    synthetic.coords_folder(folder, n_particles, n_tomograms)
+    synthetic.split_star(folder, relion31, n_parts=MERGE_PARTS)
+    synthetic.tomograms_with_models(folder, n_tomograms, MASK_SHAPE)
+
+    print(f"Generating {n_project} subtomograms of {box}^3 px to project.")
+    volumes = folder / "volumes"
+    volumes.mkdir(exist_ok=True)
+    project = synthetic.warp_star(volumes, n_project, n_tomograms)
+    synthetic.subtomo_volumes(volumes, project, box)
+
+    # Partial outputs (stars and stacks) for merge-shards
+    for i in range(1, SHARDS + 1):
+        run_command(
+            "subtomotools.particle_operations:project_particles",
+            ["--ctf", "-r", "12", "--shard", f"{i}/{SHARDS}", project.name],
+            volumes,
+        )
+
+
+def suite(n_particles, n_project, n_tomograms, jobs):
+    """Return cases as (name, cli function, arguments, working dir, items).
+
+    An optional sixth entry lists outputs removed before each run, for commands
+    which skip existing outputs.
+    """
+    star_ops = "subtomotools.star_operations"
+    particle_ops = "subtomotools.particle_operations"
+    parts = [f"parts/part_{i}.star" for i in range(MERGE_PARTS)]
+    shards = [f"warp_projected.shard{i}of{SHARDS}.star" for i in range(1, SHARDS + 1)]
+    tomograms = [f"tomos/TS_{i}.mrc" for i in range(n_tomograms)]
+
+    return [
+        ("upgrade-star", f"{star_ops}:upgrade_star", ["warp.star"], ".", n_particles),
+        (
+            "downgrade-star",
+            f"{star_ops}:downgrade_star",
+            ["relion31.star"],
+            ".",
+            n_particles,
+        ),
+        ("dedup-3d warp", f"{star_ops}:dedup_3d", ["warp.star"], ".", n_particles),
+        (
+            "dedup-3d relion31",
+            f"{star_ops}:dedup_3d",
+            ["relion31.star"],
+            ".",
+            n_particles,
+        ),
+        (
+            "dedup-3d relion5",
+            f"{star_ops}:dedup_3d",
+            ["-r", "10", "relion5.star"],
+            ".",
+            n_particles,
+        ),
+        (
+            "apply-selection",
+            f"{particle_ops}:apply_subset",
+            ["subset.star", "relion31.star"],
+            ".",
+            n_particles,
+        ),
+        (
+            "star-pipeline",
+            "subtomotools.pipeline:star_pipeline",
+            ["-s", "select:subset=subset.star", "-s", "dedup:radius=5",
+             "-s", "downgrade:m", "relion31.star"],
+            ".",
+            n_particles,
+        ),
+        (
+            "coords2warp",
+            "subtomotools.tomotwin_export:coords2warp",
+            ["-r", "2", "-j", str(jobs), "coords"],
+            ".",
+            n_particles,
+        ),
+        (
+            "project-particles",
+            f"{particle_ops}:project_particles",
+            ["--ctf", "-r", "12", "-j", str(jobs), "warp.star"],
+            "volumes",
+            n_project,
+        ),
+        (
+            "merge-stars",
+            f"{star_ops}:merge_stars",
+            ["-o", "merged.star", *parts],
+            ".",
+            n_particles,
+        ),
+        (
+            "merge-shards",
+            "subtomotools.shards:merge_shards",
+            shards,
+            "volumes",
+            n_project,
+        ),
+        (
+            "pack-subtomos",
+            "subtomotools.volume_io:pack_subtomos",
+            ["-j", str(jobs), "warp.star"],
+            "volumes",
+            n_project,
+        ),
+        (
+            "make-masks",
+            "subtomotools.mask_operations:make_masks",
+            ["-o", "masks", "-j", str(jobs), *tomograms],
+            ".",
+            n_tomograms,
+            ["masks"],
+        ),
+    ]
+
+
+# Runs the command and reports peak memory to stderr on exit. ru_maxrss of the
+# command itself would include the memory of this script, as Linux keeps it
+# across fork and exec, so VmHWM of the new address space is used instead.
+RUNNER = """
+import atexit, resource, sys
+
+def report():
+    try:
+        with open("/proc/self/status") as f:
+            own = next(int(line.split()[1]) for line in f if line.startswith("VmHWM"))
+    except OSError:
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    sys.stderr.write(f"\\nPEAK_RSS_KB {own} {children}\\n")
+
+atexit.register(report)
+"""
+
+
+def run_command(entry, args, cwd):
+    """Run a click command in a fresh interpreter.
+
+    Output:
+        wall time in s, peak RSS of the command and of its largest worker in MB,
+        metrics written by the command with --metrics-json
+
+    """
+    module, func = entry.split(":")
+    code = f"{RUNNER}\nfrom {module} import {func}\n{func}(sys.argv[1:])\n"
+    metrics_json = Path(cwd) / "metrics.json"
+
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-c", code, "--metrics-json", str(metrics_json), *args],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=False,
+    )
+    wall = time.perf_counter() - start
+
+    if process.returncode != 0:
+        raise click.ClickException(
+            f"{entry} {' '.join(args)} failed:\n{process.stderr}"
+        )
+
+    rss = process.stderr.rsplit("PEAK_RSS_KB", 1)[1].split()
+    metrics = json.loads(metrics_json.read_text())
+    metrics_json.unlink()
+
+    return wall, int(rss[0]) / 1024, int(rss[1]) / 1024, metrics
+
+
+def print_comparison(results, baseline):
+    """Print wall time and peak memory relative to a previous report."""
+    previous = {result["name"]: result for result in baseline["results"]}
+
+    print(f"\nCompared to {baseline.get('commit')}:")
+    print(f"{'command':<20} {'wall [s]':>10} {'before':>10} {'ratio':>8} "
+          f"{'RSS [MB]':>10} {'before':>10}")
+
+    for result in results:
+        old = previous.get(result["name"])
+
+        if old is None:
+            continue
+
+        print(
+            f"{result['name']:<20} {result['wall_s']:>10.2f} {old['wall_s']:>10.2f} "
+            f"{result['wall_s'] / old['wall_s']:>7.2f}x "
+            f"{result['peak_rss_mb']:>10.0f} {old['peak_rss_mb']:>10.0f}"
+        )
+
+
+@click.command()
+@click.option(
+    "--particles", "-n", default=100_000, show_default=True,
+    help="Number of particles in star files and .coords folders.",
+)
+@click.option(
+    "--project", default=1000, show_default=True,
+    help="Number of subtomograms written for project-particles.",
+)
+@click.option("--tomograms", default=20, show_default=True)
+@click.option("--box", default=32, show_default=True, help="Subtomogram size in px.")
+@click.option("--jobs", "-j", default=4, show_default=True)
+@click.option(
+    "--repeat", default=3, show_default=True,
+    help="Runs per command, the median is reported.",
+)
+@click.option(
+    "--only", multiple=True,
+    help="Only run commands whose name starts with this, can be given multiple times.",
+)
+@click.option("--workdir", type=click.Path(), help="Keep dataset in this folder.")
+@click.option(
+    "--report", type=click.Path(), default="benchmark_report.json", show_default=True,
+)
+@click.option("--compare", type=click.Path(exists=True), help="Previous report.")
+def main(
+    particles, project, tomograms, box, jobs, repeat, only, workdir, report, compare
+):
+    """Benchmark all command line tools on synthetic data."""
+    if workdir is None:
+        folder = Path(tempfile.mkdtemp(prefix="subtomotools_bench_"))
+    else:
+        folder = Path(workdir)
+        folder.mkdir(parents=True, exist_ok=True)
+
+    # Reuse a kept dataset only if it was generated with the same parameters
+    dataset = {"particles": particles, "project": project, "tomograms": tomograms,
+               "box": box}
+    dataset_json = folder / "dataset.json"
+
+    try:
+        if not dataset_json.exists() or json.loads(dataset_json.read_text()) != dataset:
+            make_dataset(folder, particles, project, tomograms, box)
+            dataset_json.write_text(json.dumps(dataset))
+
+        results = []
+
+        cases = suite(particles, project, tomograms, jobs)
+
+        for name, entry, args, cwd, items, *remove in cases:
+            if only and not name.startswith(only):
+                continue
+
+            runs = []
+
+            for _ in range(repeat):
+                for output in itertools.chain(*remove):
+                    shutil.rmtree(folder / cwd / output, ignore_errors=True)
+
+                runs.append(run_command(entry, args, folder / cwd))
+
+            wall = statistics.median(run[0] for run in runs)
+            rss = max(run[1] for run in runs)
+            workers_rss = max(run[2] for run in runs)
+
+            results.append(
+                {
+                    "name": name,
+                    "command": entry,
+                    "args": args,
+                    "items": items,
+                    "wall_s": wall,
+                    "items_per_s": items / wall,
+                    "peak_rss_mb": rss,
+                    "peak_rss_workers_mb": workers_rss,
+                    "runs_s": [run[0] for run in runs],
+                    "stages_s": runs[-1][3]["stages_s"],
+                    "worker_stages_s": runs[-1][3]["worker_stages_s"],
+                    "counts": runs[-1][3]["counts"],
+                }
+            )
+            print(f"{name:<20} {wall:>8.2f} s {items / wall:>12.0f} particles/s "
+                  f"{rss:>8.0f} MB (workers {workers_rss:.0f} MB)")
+
+    finally:
+        if workdir is None:
+            shutil.rmtree(folder)
+
+    output = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "params": {
+            "particles": particles,
+            "project": project,
+            "tomograms": tomograms,
+            "box": box,
+            "jobs": jobs,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+    with open(report, "w") as f:
+        json.dump(output, f, indent=2)
+
+    print(f"Wrote report to {report}.")
+
+    if compare:
+        with open(compare) as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""Generators for synthetic STA datasets used by the benchmarks.
+
+All star files reference their volumes relative to the dataset folder, so
+commands have to be run from there.
+"""
+import itertools
+import struct
+from pathlib import Path
+
+import mrcfile
+import numpy as np
+import pandas as pd
+import starfile
+
+ANGPIX = 10.0
+
+
+def synthetic_cloud(n_points: int, radius: float, neighbours: float, seed: int = 0):
+    """Uniform random point cloud with a fixed mean number of neighbours in radius.
+
+    Box size is scaled with the number of points, so the density (and thereby the
+    fraction of duplicates) stays the same across sizes.
+    """
+    rng = np.random.default_rng(seed)
+    sphere = 4 / 3 * np.pi * radius**3
+    side = (n_points * sphere / neighbours) ** (1 / 3)
+
+    return rng.uniform(0, side, size=(n_points, 3))
+
+
+def picks(n_particles: int, n_tomograms: int, duplicates: float, seed: int = 0):
+    """Random picks in tomograms of 1000x1000x300 px, some of them picked twice.
+
+    Output:
+        DataFrame with tomo (index of tomogram) and X, Y, Z in pixels; duplicates
+        are shifted by less than 2 px from their original pick.
+
+    """
+    rng = np.random.default_rng(seed)
+    n_unique = round(n_particles * (1 - duplicates))
+
+    xyz = rng.uniform((0, 0, 0), (1000, 1000, 300), size=(n_unique, 3))
+    tomo = rng.integers(0, n_tomograms, n_unique)
+
+    dup = rng.integers(0, n_unique, n_particles - n_unique)
+    xyz = np.concatenate([xyz, xyz[dup] + rng.uniform(-1, 1, (len(dup), 3))])
+    tomo = np.concatenate([tomo, tomo[dup]])
+
+    order = rng.permutation(n_particles)
+
+    xyz = xyz[order]
+
+    return pd.DataFrame(
+        {"tomo": tomo[order], "X": xyz[:, 0], "Y": xyz[:, 1], "Z": xyz[:, 2]}
+    )
+
+
+def angles(n: int, rng):
+    """Random Euler angles in RELION convention."""
+    return {
+        "rlnAngleRot": rng.uniform(-180, 180, n),
+        "rlnAngleTilt": rng.uniform(0, 180, n),
+        "rlnAnglePsi": rng.uniform(-180, 180, n),
+    }
+
+
+def subtomo_names(tomo, particle_idx):
+    """Warp-style subtomogram and CTF paths (session/subtomo/tomo/file)."""
+    image_names = [
+        f"session/subtomo/TS_{t}/TS_{t}_{i:07d}_{ANGPIX:.2f}A.mrc"
+        for t, i in zip(tomo, particle_idx)
+    ]
+    ctf_names = [name.replace("A.mrc", "A_ctf.mrc") for name in image_names]
+
+    return image_names, ctf_names
+
+
+def warp_star(folder: Path, n_particles: int, n_tomograms: int, seed: int = 0):
+    """Write a Warp 1.x style subtomogram star, return its path."""
+    rng = np.random.default_rng(seed)
+    pos = picks(n_particles, n_tomograms, duplicates=0.2, seed=seed)
+    image_names, ctf_names = subtomo_names(pos["tomo"], range(n_particles))
+
+    particles = pd.DataFrame(
+        {
+            "rlnMagnification": 10000.0,
+            "rlnDetectorPixelSize": ANGPIX,
+            "rlnCoordinateX": pos["X"],
+            "rlnCoordinateY": pos["Y"],
+            "rlnCoordinateZ": pos["Z"],
+            **angles(n_particles, rng),
+            "rlnMicrographName": [f"TS_{t}.tomostar" for t in pos["tomo"]],
+            "rlnImageName": image_names,
+            "rlnCtfImage": ctf_names,
+            "rlnOriginX": rng.normal(0, 1, n_particles),
+            "rlnOriginY": rng.normal(0, 1, n_particles),
+            "rlnOriginZ": rng.normal(0, 1, n_particles),
+        }
+    )
+
+    star = folder / "warp.star"
+    starfile.write(particles, star)
+
+    return star
+
+
+def relion31_star(folder: Path, n_particles: int, n_tomograms: int, seed: int = 0):
+    """Write a Relion 3.1 style subtomogram star with optics table."""
+    rng = np.random.default_rng(seed)
+    pos = picks(n_particles, n_tomograms, duplicates=0.2, seed=seed)
+    image_names, ctf_names = subtomo_names(pos["tomo"], range(n_particles))
+
+    optics = pd.DataFrame(
+        {
+            "rlnOpticsGroupName": ["opticsGroup1"],
+            "rlnOpticsGroup": [1],
+            "rlnMicrographPixelSize": [ANGPIX],
+            "rlnImageSize": [32],
+            "rlnVoltage": [300.0],
+            "rlnSphericalAberration": [2.7],
+            "rlnAmplitudeContrast": [0.07],
+            "rlnImageDimensionality": [3],
+        }
+    )
+    particles = pd.DataFrame(
+        {
+            "rlnCoordinateX": pos["X"],
+            "rlnCoordinateY": pos["Y"],
+            "rlnCoordinateZ": pos["Z"],
+            **angles(n_particles, rng),
+            "rlnMicrographName": [f"TS_{t}.mrc" for t in pos["tomo"]],
+            "rlnImageName": image_names,
+            "rlnCtfImage": ctf_names,
+            "rlnOriginXAngst": rng.normal(0, ANGPIX, n_particles),
+            "rlnOriginYAngst": rng.normal(0, ANGPIX, n_particles),
+            "rlnOriginZAngst": rng.normal(0, ANGPIX, n_particles),
+            "rlnOpticsGroup": 1,
+            "rlnGroupNumber": 1,
+        }
+    )
+
+    star = folder / "relion31.star"
+    starfile.write({"optics": optics, "particles": particles}, star)
+
+    return star
+
+
+def relion5_star(folder: Path, n_particles: int, n_tomograms: int, seed: int = 0):
+    """Write a Relion 5 style particle star (centered coordinates in Angstrom)."""
+    rng = np.random.default_rng(seed)
+    pos = picks(n_particles, n_tomograms, duplicates=0.2, seed=seed)
+
+    optics = pd.DataFrame(
+        {
+            "rlnOpticsGroupName": ["opticsGroup1"],
+            "rlnOpticsGroup": [1],
+            "rlnImagePixelSize": [ANGPIX],
+            "rlnImageSize": [32],
+            "rlnImageDimensionality": [3],
+        }
+    )
+    particles = pd.DataFrame(
+        {
+            "rlnTomoName": [f"TS_{t}" for t in pos["tomo"]],
+            "rlnCenteredCoordinateXAngst": pos["X"] - 500,
+            "rlnCenteredCoordinateYAngst": pos["Y"] - 500,
+            "rlnCenteredCoordinateZAngst": pos["Z"] - 150,
+            **angles(n_particles, rng),
+            "rlnOriginXAngst": rng.normal(0, ANGPIX, n_particles),
+            "rlnOriginYAngst": rng.normal(0, ANGPIX, n_particles),
+            "rlnOriginZAngst": rng.normal(0, ANGPIX, n_particles),
+            "rlnOpticsGroup": 1,
+        }
+    )
+
+    star = folder / "relion5.star"
+    starfile.write({"optics": optics, "particles": particles}, star)
+
+    return star
+
+
+def subtomo_volumes(folder: Path, star: Path, box: int, limit=None, seed: int = 0):
+    """Write the subtomograms and Warp-style (rfft layout) CTF volumes of a star.
+
+    Only the first limit particles get volumes if limit is given, which is enough
+    for commands that just probe the header of the first subtomogram.
+    """
+    rng = np.random.default_rng(seed)
+    particles = starfile.read(star, always_dict=True)
+    particles = particles.get("particles", next(iter(particles.values())))
+
+    # Warp writes one CTF per particle, most of them identical within a tomogram.
+    # Like a real CTF, it has the same value at k and -k
+    ctf = np.abs(rng.normal(1, 0.2, (box, box, box)))
+    ctf = (ctf + np.roll(ctf[::-1, ::-1, ::-1], 1, axis=(0, 1, 2))) / 2
+    ctf = ctf[..., : box // 2 + 1].astype(np.float32)
+
+    names = zip(particles["rlnImageName"], particles["rlnCtfImage"])
+
+    for image_name, ctf_name in itertools.islice(names, limit):
+        (folder / image_name).parent.mkdir(parents=True, exist_ok=True)
+        volume = rng.normal(size=(box, box, box)).astype(np.float32)
+        mrcfile.write(folder / image_name, volume, voxel_size=ANGPIX, overwrite=True)
+        mrcfile.write(folder / ctf_name, ctf, voxel_size=ANGPIX, overwrite=True)
+
+
+def subset_star(folder: Path, subtomo_star: Path, fraction: float, seed: int = 0):
+    """Write a 2D subset selection referring to the projections of subtomo_star."""
+    rng = np.random.default_rng(seed)
+    particles = starfile.read(subtomo_star, always_dict=True)["particles"]
+
+    selected = np.flatnonzero(rng.uniform(size=len(particles.index)) < fraction)
+
+    subset = pd.DataFrame(
+        {
+            "rlnImageName": [
+                f"{i + 1}@{subtomo_star.stem}_projected.mrcs" for i in selected
+            ],
+            "rlnAnglePsi": rng.uniform(-180, 180, len(selected)),
+            "rlnOriginXAngst": rng.normal(0, ANGPIX, len(selected)),
+            "rlnOriginYAngst": rng.normal(0, ANGPIX, len(selected)),
+            "rlnClassNumber": rng.integers(1, 50, len(selected)),
+        }
+    )
+    optics = pd.DataFrame({"rlnOpticsGroup": [1], "rlnImagePixelSize": [ANGPIX]})
+
+    star = folder / "subset.star"
+    starfile.write({"optics": optics, "particles": subset}, star)
+
+    return star
+
+
+def coords_folder(folder: Path, n_particles: int, n_tomograms: int, seed: int = 0):
+    """Write TomoTwin-style .coords files (integer XYZ), one per tomogram."""
+    pos = picks(n_particles, n_tomograms, duplicates=0.2, seed=seed)
+    coords = folder / "coords"
+    coords.mkdir(exist_ok=True)
+
+    for tomo, rows in pos.groupby("tomo"):
+        np.savetxt(
+            coords / f"run1_TS_{tomo}_embeddings.coords",
+            np.round(rows[["X", "Y", "Z"]].to_numpy()),
+            fmt="%d",
+        )
+
+    return coords
+
+
+def split_star(folder: Path, star: Path, n_parts: int, overlap: float = 0.1):
+    """Split a star with optics table into parts/part_<i>.star, return their paths.
+
+    Each part also repeats the first overlap fraction of the next part, as when
+    merging classes of overlapping runs.
+    """
+    blocks = starfile.read(star, always_dict=True)
+    particles = blocks["particles"]
+    bounds = np.linspace(0, len(particles.index), n_parts + 1).astype(int)
+    parts = folder / "parts"
+    parts.mkdir(exist_ok=True)
+    paths = []
+
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        end = min(end + round(overlap * (end - start)), len(particles.index))
+        paths.append(parts / f"part_{i}.star")
+        starfile.write(
+            {"optics": blocks["optics"], "particles": particles.iloc[start:end]},
+            paths[-1],
+        )
+
+    return paths
+
+
+def imod_model(path: Path, contours, size):
+    """Write a minimal IMOD model with one object of closed contours.
+
+    Input:
+        contours: list of (N, 3) arrays of XYZ points, in pixels
+        size: (X, Y, Z) size of the image the model is made on
+
+    """
+    header = bytearray(232)
+    header[:5] = b"model"
+    struct.pack_into(">4iI", header, 128, *size, 1, 0)
+
+    # Object header, with the number of contours and no flags
+    obj = bytearray(176)
+    struct.pack_into(">iI", obj, 128, len(contours), 0)
+
+    data = [b"IMODV1.2", header, b"OBJT", obj]
+
+    for points in contours:
+        points = np.asarray(points, dtype=">f4")
+        data += [b"CONT", struct.pack(">iIii", len(points), 0, 0, 0), points.tobytes()]
+
+    data.append(b"IEOF")
+    path.write_bytes(b"".join(data))
+
+
+def tomograms_with_models(folder: Path, n_tomograms: int, shape, seed: int = 0):
+    """Write empty tomograms (ZYX shape) with models of a lamella outline each.
+
+    The tomograms are sparse files, make-masks only reads their header. Each
+    model outlines a random quadrilateral in a few Z planes.
+    """
+    rng = np.random.default_rng(seed)
+    tomos = folder / "tomos"
+    tomos.mkdir(exist_ok=True)
+    paths = []
+    depth, height, width = shape
+    corners = np.array([[0.1, 0.1], [0.9, 0.1], [0.9, 0.9], [0.1, 0.9]])
+
+    for tomo in range(n_tomograms):
+        paths.append(tomos / f"TS_{tomo}.mrc")
+
+        with mrcfile.new_mmap(paths[-1], shape, mrc_mode=2, overwrite=True) as mrc:
+            mrc.voxel_size = ANGPIX
+
+        contours = []
+
+        for z in np.linspace(0.2, 0.8, 3) * depth:
+            xy = (corners + rng.uniform(-0.05, 0.05, corners.shape)) * (width, height)
+            contours.append(np.column_stack([xy, np.full(len(xy), z)]))
+        imod_model(tomos / f"TS_{tomo}.mod", contours, (width, height, depth))
+
+    return paths
@@ -0,0 +1,4 @@
+"""Run the subtomotools command group with python -m subtomotools."""
+from subtomotools.cli import main
+
+main()
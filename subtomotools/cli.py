@@ -0,0 +1,92 @@
+"""Single entry point for all subtomotools commands.
+
+Subcommands are only imported when they are run, so the group itself (and its
+--help) starts without numpy, pandas etc.
+"""
+import importlib
+
+import click
+
+# name: (module:function, short help)
+COMMANDS = {
+    "upgrade-star": (
+        "subtomotools.star_operations:upgrade_star",
+        "Make Warp subtomogram stars compatible with Relion 3.1.4.",
+    ),
+    "downgrade-star": (
+        "subtomotools.star_operations:downgrade_star",
+        "Make Relion 3.1.4 subtomogram stars compatible to Warp.",
+    ),
+    "dedup-3d": (
+        "subtomotools.star_operations:dedup_3d",
+        "Deduplicate particles in star files in 3D.",
+    ),
+    "merge-stars": (
+        "subtomotools.star_operations:merge_stars",
+        "Merge many star files into one, renumbering optics groups.",
+    ),
+    "star-pipeline": (
+        "subtomotools.pipeline:star_pipeline",
+        "Chain star operations in memory, with one read and write.",
+    ),
+    "merge-shards": (
+        "subtomotools.shards:merge_shards",
+        "Merge partial outputs of commands run with --shard.",
+    ),
+    "pack-subtomos": (
+        "subtomotools.volume_io:pack_subtomos",
+        "Pack subtomograms of a star into one volume stack.",
+    ),
+    "project-particles": (
+        "subtomotools.particle_operations:project_particles",
+        "Project subtomograms to 2D.",
+    ),
+    "apply-selection": (
+        "subtomotools.particle_operations:apply_subset",
+        "Apply subset selection to 3D dataset.",
+    ),
+    "make-masks": (
+        "subtomotools.mask_operations:make_masks",
+        "Make masks from IMOD models of closed contours.",
+    ),
+    "coords2warp": (
+        "subtomotools.tomotwin_export:coords2warp",
+        "Create Warp-style star files from a folder of coordinates.",
+    ),
+    "tomotwin-pipeline": (
+        "subtomotools.tomotwin_export:tomotwin_pipeline",
+        "Run TomoTwin map, locate and pick for many tomograms.",
+    ),
+}
+
+
+class LazyGroup(click.Group):
+    """Click group which imports the module of a subcommand only when needed."""
+
+    def list_commands(self, ctx):
+        """Return names of all subcommands."""
+        return list(COMMANDS)
+
+    def get_command(self, ctx, cmd_name):
+        """Import and return a subcommand, or None if it does not exist."""
+        if cmd_name not in COMMANDS:
+            return None
+
+        module, function = COMMANDS[cmd_name][0].split(":")
+
+        return getattr(importlib.import_module(module), function)
+
+    def format_commands(self, ctx, formatter):
+        """List subcommands with their short help, without importing them."""
+        with formatter.section("Commands"):
+            formatter.write_dl(
+                [(name, short_help) for name, (_, short_help) in COMMANDS.items()]
+            )
+
+
+@click.group(cls=LazyGroup)
+def main():
+    """Scripts to facilitate STA, interfacing Warp/M, Relion 3.1 and TomoTwin.
+
+    Run e.g. subtomotools dedup-3d --help for the options of each command.
+    """
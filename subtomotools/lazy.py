@@ -0,0 +1,25 @@
+"""Import heavy modules only when they are first used.
+
+Command modules import numpy, pandas etc. through lazy_import, so that
+subtomotools <command> --help and argument errors return without loading them.
+"""
+import importlib.util
+import sys
+
+
+def lazy_import(name: str):
+    """Return module name, executed only when one of its attributes is accessed.
+
+    Modules which are already imported are returned as they are.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
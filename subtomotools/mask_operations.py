@@ -0,0 +1,379 @@
+"""Masks from IMOD models, e.g. to restrict TomoTwin embedding to the lamella.
+
+Replaces a loop calling mod2mask once per tomogram. Closed contours are read
+directly from the binary .mod file, filled per Z plane and padded by a boundary
+with NumPy, and the mask is written as memory-mapped MRC.
+"""
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import click
+import mrcfile
+import numpy as np
+
+from subtomotools import metrics, utils
+
+# Model flag: Y and Z were flipped when the model was saved
+IMODF_FLIPYZ = 1 << 16
+# Object flag: scattered points, not contours
+IMOD_OBJFLAG_SCAT = 1 << 9
+
+
+def read_imod_contours(path):
+    """Return the contours of all non-scattered objects of an IMOD model.
+
+    Follows the IMOD binary model format (big-endian chunks). Meshes and optional
+    chunks are skipped.
+
+    Output:
+        contours: list of (N, 3) np.arrays of XYZ points, in pixels
+        size: (X, Y, Z) size of the image the model was made on
+
+    """
+    data = Path(path).read_bytes()
+
+    if data[:4] != b"IMOD":
+        raise click.ClickException(f"{path} is not an IMOD model.")
+
+    # Model header: name, size, ..., flags
+    xmax, ymax, zmax, _, flags = struct.unpack_from(">4iI", data, 136)
+    position = 240
+    contours, scattered = [], False
+
+    while position < len(data):
+        chunk = data[position : position + 4]
+        position += 4
+
+        if chunk == b"IEOF":
+            break
+
+        if chunk == b"OBJT":
+            (object_flags,) = struct.unpack_from(">I", data, position + 132)
+            scattered = bool(object_flags & IMOD_OBJFLAG_SCAT)
+            position += 176
+
+        elif chunk == b"CONT":
+            (n_points,) = struct.unpack_from(">i", data, position)
+            points = np.frombuffer(
+                data, dtype=">f4", count=3 * n_points, offset=position + 16
+            ).reshape(-1, 3)
+            position += 16 + 12 * n_points
+
+            if not scattered:
+                contours.append(points.astype(np.float64))
+
+        elif chunk == b"MESH":
+            n_vertices, n_indices = struct.unpack_from(">2i", data, position)
+            position += 16 + 12 * n_vertices + 4 * n_indices
+
+        else:
+            (size,) = struct.unpack_from(">i", data, position)
+            position += 4 + size
+
+    if flags & IMODF_FLIPYZ:
+        contours = [points[:, [0, 2, 1]] for points in contours]
+        ymax, zmax = zmax, ymax
+
+    return contours, (xmax, ymax, zmax)
+
+
+def fill_polygon(points, shape):
+    """Return a boolean (Y, X) mask of the pixels inside a polygon.
+
+    Pixel centers are at index + 0.5, as in 3dmod. Each row counts the polygon
+    edges crossed left of every pixel at once (even-odd rule).
+
+    Input:
+        points: (N, 2) np.array of XY vertices
+        shape: (Y, X) shape of the mask
+
+    """
+    mask = np.zeros(shape, dtype=bool)
+    x0, y0 = points.T
+    x1, y1 = np.roll(points, -1, axis=0).T
+
+    rows = np.arange(
+        max(int(np.floor(y0.min())), 0), min(int(np.ceil(y0.max())), shape[0])
+    )
+    centers = rows[:, None] + 0.5
+
+    # Half-open in Y, so a vertex on a row is crossed only once
+    crossed = ((y0 <= centers) & (centers < y1)) | ((y1 <= centers) & (centers < y0))
+    row_idx, edge_idx = np.nonzero(crossed)
+
+    if not len(row_idx):
+        return mask
+
+    slope = (x1 - x0)[edge_idx] / (y1 - y0)[edge_idx]
+    x = x0[edge_idx] + (centers[row_idx, 0] - y0[edge_idx]) * slope
+
+    # A crossing at x toggles all pixels with center > x
+    counts = np.zeros((len(rows), shape[1] + 1), dtype=np.int32)
+    columns = np.clip(np.floor(x - 0.5).astype(np.int64) + 1, 0, shape[1])
+    np.add.at(counts, (row_idx, columns), 1)
+
+    mask[rows] = (np.cumsum(counts[:, :-1], axis=1) % 2).astype(bool)
+
+    return mask
+
+
+def distances_squared(polygons, shape, boundary: float):
+    """Return squared distances to the filled polygons of one plane.
+
+    Pixels inside are 0, pixels further than boundary from all polygons are inf.
+    Distances to each edge are only evaluated within boundary of the edge.
+
+    Input:
+        polygons: list of (N, 2) np.arrays of XY vertices
+        shape: (Y, X) shape of the plane
+        boundary: largest distance of interest, in pixels
+
+    """
+    inside = np.zeros(shape, dtype=bool)
+
+    for points in polygons:
+        inside |= fill_polygon(points, shape)
+
+    d2 = np.where(inside, 0, np.inf).astype(np.float32)
+
+    if boundary <= 0:
+        return d2
+
+    for points in polygons:
+        for start, end in zip(points, np.roll(points, -1, axis=0)):
+            low = np.maximum(np.floor(np.minimum(start, end) - boundary), 0)
+            high = np.minimum(
+                np.ceil(np.maximum(start, end) + boundary), shape[::-1]
+            ).astype(np.int64)
+            x = np.arange(int(low[0]), high[0]) + 0.5
+            y = np.arange(int(low[1]), high[1]) + 0.5
+
+            # Distance of pixel centers to the closest point of the edge
+            edge = end - start
+            length2 = max(edge @ edge, 1e-12)
+            dx, dy = x[None, :] - start[0], y[:, None] - start[1]
+            t = np.clip((dx * edge[0] + dy * edge[1]) / length2, 0, 1)
+            window = d2[int(low[1]) : high[1], int(low[0]) : high[0]]
+            np.minimum(
+                window, (dx - t * edge[0]) ** 2 + (dy - t * edge[1]) ** 2, out=window
+            )
+
+    return d2
+
+
+def plane_sources(contour_z, n_planes: int, extend: bool = False):
+    """Return the contoured plane each plane takes its mask from, -1 for none.
+
+    Planes between contoured planes use the nearest one. Planes beyond the first
+    and last contoured plane are empty, or with extend use them as well.
+    """
+    contour_z = np.unique(contour_z)
+    z = np.arange(n_planes)
+
+    after = np.clip(np.searchsorted(contour_z, z), 0, len(contour_z) - 1)
+    before = np.clip(after - 1, 0, len(contour_z) - 1)
+    nearest = np.where(
+        np.abs(contour_z[before] - z) <= np.abs(contour_z[after] - z),
+        contour_z[before],
+        contour_z[after],
+    )
+
+    if not extend:
+        nearest[(z < contour_z[0]) | (z > contour_z[-1])] = -1
+
+    return nearest
+
+
+def mask_planes(contours, shape, boundary: float = 10, extend: bool = False):
+    """Yield the planes (Y, X) of a mask of closed contours, padded by boundary.
+
+    Each contour is filled in its Z plane, see plane_sources for the planes in
+    between. The filled volume is dilated by a ball of radius boundary (in
+    pixels): a pixel is in the mask if it is within boundary of the filled
+    region of a nearby plane, with the Z distance included.
+
+    Input:
+        contours: list of (N, 3) np.arrays of XYZ points, see read_imod_contours
+        shape: (Z, Y, X) shape of the mask
+        boundary: padding around the contours, in pixels
+        extend: extend the first and last contoured planes to the whole volume
+
+    """
+    polygons = {}
+
+    for points in contours:
+        if len(points) >= 3:
+            z = int(np.rint(np.median(points[:, 2])))
+            polygons.setdefault(z, []).append(points[:, :2])
+
+    empty = np.zeros(shape[1:], dtype=bool)
+
+    if not polygons:
+        yield from (empty for _ in range(shape[0]))
+        return
+
+    sources = plane_sources(list(polygons), shape[0], extend)
+    reach = int(np.floor(boundary))
+    distances = {}
+    last_key, plane = None, empty
+
+    for z in range(shape[0]):
+        # Closest plane (Z distance squared) per contoured plane within reach
+        window = range(max(z - reach, 0), min(z + reach + 1, shape[0]))
+        dz2 = {}
+
+        for z_other in window:
+            source = sources[z_other]
+
+            if source >= 0:
+                dz2[source] = min(dz2.get(source, np.inf), (z - z_other) ** 2)
+
+        key = tuple(sorted(dz2.items()))
+
+        # Planes between contoured planes mostly repeat the previous one
+        if key != last_key:
+            plane = empty.copy()
+
+            for source, offset2 in key:
+                if source not in distances:
+                    distances[source] = distances_squared(
+                        polygons[source], shape[1:], boundary
+                    )
+
+                plane |= distances[source] <= boundary**2 - offset2
+
+            last_key = key
+
+        yield plane
+
+
+def model_path(tomogram: Path):
+    """Return the model of a tomogram, <name up to the first .>.mod next to it."""
+    return tomogram.with_name(f"{tomogram.name.split('.')[0]}.mod")
+
+
+def make_mask(
+    tomogram: Path,
+    model: Path,
+    out_mrc: Path,
+    boundary: float = 10,
+    extend: bool = False,
+):
+    """Write the mask of the contours of model for tomogram.
+
+    The mask (int8, 0 and 1) has the shape and pixel size of the tomogram, whose
+    header only is read. It is written under a temporary name first, so an
+    interrupted run leaves no mask which would be skipped later.
+
+    Output:
+        n_contours: number of contours in the model
+        perf: Metrics of this tomogram
+
+    """
+    perf = metrics.Metrics()
+    shape, angpix = utils.probe_mrc(tomogram)
+
+    with perf.stage("read model"):
+        contours, size = read_imod_contours(model)
+
+    perf.read(model)
+
+    if tuple(size) != shape[::-1]:
+        print(
+            f"Warning: {model} was made on an image of size {size}, "
+            f"{tomogram} has size {shape[::-1]}."
+        )
+
+    temp_mrc = out_mrc.with_name(f".{out_mrc.name}.tmp")
+
+    with mrcfile.new_mmap(temp_mrc, shape=shape, mrc_mode=0, overwrite=True) as mrc:
+        mrc.voxel_size = angpix
+        planes = mask_planes(contours, shape, boundary, extend)
+
+        for z, plane in enumerate(perf.timed(planes, "rasterize")):
+            with perf.stage("write mask"):
+                mrc.data[z] = plane
+
+        with perf.stage("write mask"):
+            mrc.update_header_stats()
+
+    os.replace(temp_mrc, out_mrc)
+    perf.wrote(out_mrc)
+    perf.count("masks written")
+    perf.count("contours", len(contours))
+
+    return len(contours), perf
+
+
+@click.command()
+@metrics.instrumented()
+@click.option(
+    "-b",
+    "--boundary",
+    default=10,
+    type=float,
+    show_default=True,
+    help="Padding around the contours, in pixels.",
+)
+@click.option(
+    "--extend/--no-extend",
+    default=False,
+    show_default=True,
+    help="Extend the first and last contoured planes to the top and bottom of the "
+    "tomogram, e.g. for a single contour outlining the lamella.",
+)
+@click.option(
+    "-o",
+    "--out",
+    type=click.Path(file_okay=False),
+    default="masks",
+    show_default=True,
+    help="Output folder, masks are named <tomogram>_mask.mrc.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    type=int,
+    show_default=True,
+    help="Number of tomograms processed in parallel.",
+)
+@click.argument("tomograms", type=click.Path(exists=True), nargs=-1)
+def make_masks(boundary, extend, out, jobs, tomograms):
+    """Make masks from IMOD models of closed contours, e.g. for TomoTwin embedding.
+
+    For each tomogram, the model <name up to the first .>.mod next to it is
+    used. Contours are filled in their Z plane, planes in between take the
+    nearest contour, and the mask is padded by the boundary in 3D.
+    Masks which already exist are skipped.
+    """
+    out = Path(out)
+    out.mkdir(parents=True, exist_ok=True)
+    perf = metrics.current()
+    tasks = []
+
+    for tomogram in map(Path, tomograms):
+        stem = tomogram.name.split(".")[0]
+        out_mrc = out / f"{stem}_mask.mrc"
+
+        if out_mrc.exists():
+            print(f"Found mask for {tomogram}.")
+        elif not model_path(tomogram).exists():
+            print(f"No model {model_path(tomogram)} for {tomogram}, skipping.")
+        else:
+            tasks.append(
+                (tomogram, model_path(tomogram), out_mrc, boundary, extend)
+            )
+
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(make_mask, *task) for task in tasks]
+            results = [future.result() for future in futures]
+    else:
+        results = [make_mask(*task) for task in tasks]
+
+    for task, (n_contours, mask_metrics) in zip(tasks, results):
+        perf.merge(mask_metrics, parallel=jobs > 1)
+        print(f"Wrote {task[2]} from {n_contours} contours.")
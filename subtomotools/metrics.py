@@ -0,0 +1,269 @@
+"""Stage timings, counters and peak memory for the command line tools.
+
+Every command is wrapped with instrumented, which adds --profile and
+--metrics-json. Commands get the active Metrics with current() and mark their
+stages with it, e.g.:
+
+    perf = metrics.current()
+
+    with perf.stage("read star"):
+        star = star_io.read_star(path)
+
+    perf.count("particles", len(star["particles"].index))
+
+Worker processes fill their own Metrics and hand them back with their result,
+to be merged by the parent.
+"""
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+import click
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class Metrics:
+    """Named stage timings, counters and bytes read / written.
+
+    Stages can be nested; time spent in an inner stage is not counted for the
+    outer one, so stages add up to the total wall time.
+    """
+
+    def __init__(self):
+        self.stages = Counter()
+        self.worker_stages = Counter()
+        self.counts = Counter()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._stack = []
+
+    @contextmanager
+    def stage(self, name: str):
+        """Add the wall time spent within the context to stage name."""
+        # [name, start, time spent in nested stages]
+        frame = [name, time.perf_counter(), 0.0]
+        self._stack.append(frame)
+
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.perf_counter() - frame[1]
+            self.stages[name] += elapsed - frame[2]
+
+            if self._stack:
+                self._stack[-1][2] += elapsed
+
+    def timed(self, iterable, name: str):
+        """Yield from iterable, adding the time spent producing items to stage name.
+
+        Useful for lazy readers which are consumed within another stage.
+        """
+        iterator = iter(iterable)
+
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+
+            yield item
+
+    def count(self, name: str, n: int = 1):
+        """Add n to counter name."""
+        self.counts[name] += int(n)
+
+    def read(self, path=None, nbytes: int = 0):
+        """Add size of file at path, or nbytes, to the bytes read."""
+        self.bytes_read += os.path.getsize(path) if path is not None else int(nbytes)
+
+    def wrote(self, path=None, nbytes: int = 0):
+        """Add size of file at path, or nbytes, to the bytes written."""
+        self.bytes_written += (
+            os.path.getsize(path) if path is not None else int(nbytes)
+        )
+
+    def merge(self, other: "Metrics", parallel: bool = True):
+        """Add metrics of a worker task.
+
+        Stages of parallel workers are kept apart as worker_stages. Otherwise the
+        task ran in this process within the current stage, and its stages are
+        taken over as they are.
+        """
+        if parallel:
+            self.worker_stages.update(other.stages)
+        else:
+            self.stages.update(other.stages)
+
+            if self._stack:
+                self._stack[-1][2] += sum(other.stages.values())
+
+        self.worker_stages.update(other.worker_stages)
+        self.counts.update(other.counts)
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+
+    def __getstate__(self):
+        """Drop open stages when sent to or from worker processes."""
+        state = self.__dict__.copy()
+        state["_stack"] = []
+        return state
+
+    def as_dict(self):
+        """Return all metrics, including peak memory, as JSON-serializable dict."""
+        return {
+            "stages_s": dict(self.stages),
+            "worker_stages_s": dict(self.worker_stages),
+            "counts": dict(self.counts),
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            **peak_rss_mb(),
+        }
+
+    def print_summary(self):
+        """Print stage timings, counters and peak memory."""
+        print("Time per stage:")
+
+        for stage, seconds in self.stages.items():
+            print(f"    {stage}: {seconds:.2f} s")
+
+        if self.worker_stages:
+            print("Time per stage in workers (summed over workers):")
+
+            for stage, seconds in self.worker_stages.items():
+                print(f"    {stage}: {seconds:.2f} s")
+
+        for name, n in self.counts.items():
+            print(f"{name}: {n}")
+
+        print(f"Read {self.bytes_read / 1e6:.1f} MB, "
+              f"wrote {self.bytes_written / 1e6:.1f} MB.")
+
+        rss = peak_rss_mb()
+
+        if rss:
+            print(f"Peak memory {rss['peak_rss_mb']:.0f} MB, "
+                  f"largest worker {rss['peak_rss_children_mb']:.0f} MB.")
+
+
+def peak_rss_mb():
+    """Return peak resident memory of this process and its largest child in MB."""
+    if resource is None:
+        return {}
+
+    # ru_maxrss is in bytes on macOS, kB elsewhere
+    to_mb = 1e-6 if sys.platform == "darwin" else 1e-3
+
+    return {
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * to_mb,
+        "peak_rss_children_mb": (
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * to_mb
+        ),
+    }
+
+
+_current = Metrics()
+
+
+def current():
+    """Return the Metrics of the running command."""
+    return _current
+
+
+def instrumented(summary: bool = False):
+    """Add --profile and --metrics-json to a click command.
+
+    Must be applied below @click.command(). The wrapped function runs with a
+    fresh Metrics as current(). With summary, stage timings are always printed
+    at the end, otherwise only with --profile.
+    """
+
+    def decorator(func):
+        @click.option(
+            "--profile",
+            is_flag=True,
+            default=False,
+            show_default=True,
+            help="Print time per stage and peak memory, and write a cProfile dump "
+            f"({func.__name__}.prof).",
+        )
+        @click.option(
+            "--metrics-json",
+            type=click.Path(dir_okay=False),
+            default=None,
+            help="Write stage timings, counts, bytes read/written and peak memory "
+            "to this file as JSON.",
+        )
+        @functools.wraps(func)
+        def wrapper(*args, profile=False, metrics_json=None, **kwargs):
+            global _current
+
+            _current = Metrics()
+            started = datetime.now()
+            profiler = cProfile.Profile() if profile else None
+            status = "error"
+
+            try:
+                with _current.stage("other"):
+                    if profiler is None:
+                        result = func(*args, **kwargs)
+                    else:
+                        result = profiler.runcall(func, *args, **kwargs)
+
+                status = "ok"
+
+                return result
+
+            finally:
+                if summary or profile:
+                    _current.print_summary()
+
+                if profiler is not None:
+                    _dump_profile(profiler, f"{func.__name__}.prof")
+
+                if metrics_json is not None:
+                    _write_json(
+                        metrics_json, func.__name__, started, status, _current
+                    )
+
+        return wrapper
+
+    return decorator
+
+
+def _dump_profile(profiler, path):
+    profiler.dump_stats(path)
+
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(15)
+    print(stream.getvalue())
+    print(f"Wrote cProfile stats to {path}.")
+
+
+def _write_json(path, command, started, status, metrics):
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "command": command,
+                "argv": sys.argv,
+                "started": started.isoformat(timespec="seconds"),
+                "status": status,
+                "wall_s": (datetime.now() - started).total_seconds(),
+                **metrics.as_dict(),
+            },
+            f,
+            indent=2,
+        )
@@ -1,5 +1,9 @@
+import hashlib
 import os
 import subprocess
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 from pathlib import Path
 
 import click
@@ -9,8 +13,875 @@ import pandas as pd
 import starfile
 from tqdm import tqdm
 
+from subtomotools import (
+    metrics,
+    projection_cache,
+    shards,
+    star_io,
+    star_operations,
+    utils,
+    volume_io,
+)
+
+FFT_BACKENDS = ("numpy", "scipy", "pyfftw")
+
+
+class _WorkerFFT:
+    """Wrap a scipy.fft-compatible module to always pass the number of workers."""
+
+    def __init__(self, module, workers):
+        self.module = module
+        self.workers = workers
+
+    def __getattr__(self, name):
+        return partial(getattr(self.module, name), workers=self.workers)
+
+
+def get_fft_backend(name: str = "numpy", workers: int = 1):
+    """Return a module-like object providing the numpy.fft functions (rfftn etc.).
+
+    Input:
+        name: "numpy", "scipy" (scipy.fft) or "pyfftw" (with cached plans)
+        workers: number of threads per transform, ignored for numpy
+
+    """
+    if name == "numpy":
+        return np.fft
+
+    if name == "scipy":
+        import scipy.fft
+
+        return _WorkerFFT(scipy.fft, workers)
+
+    if name == "pyfftw":
+        import pyfftw.interfaces.cache
+        import pyfftw.interfaces.scipy_fft
+
+        # Keep FFTW plans alive between calls of the same shape
+        pyfftw.interfaces.cache.enable()
+
+        return _WorkerFFT(pyfftw.interfaces.scipy_fft, workers)
+
+    raise ValueError(f"Unknown FFT backend {name}, choose from {FFT_BACKENDS}.")
+
+
+class CtfCache:
+    """LRU cache of CTF volumes, keyed by content hash.
+
+    Files are only read once per path. Volumes with identical content (e.g. the
+    same CTF written for many particles of a tomogram) are stored only once, so
+    batches can be convolved with a single shared volume.
+    """
+
+    def __init__(self, max_volumes: int = 128):
+        self.max_volumes = max_volumes
+        self.path_to_hash = {}
+        self.volumes = OrderedDict()
+        self.misses = 0
+        self.bytes_read = 0
+
+    def get(self, path):
+        """Return CTF volume stored at path (or N@stack, see volume_io)."""
+        key = self.path_to_hash.get(path)
+
+        if key in self.volumes:
+            self.volumes.move_to_end(key)
+            return self.volumes[key]
+
+        volume = volume_io.read_volume(path)
+        self.misses += 1
+        self.bytes_read += volume.nbytes
+        key = hashlib.blake2b(np.ascontiguousarray(volume), digest_size=16).digest()
+        self.path_to_hash[path] = key
+
+        if key in self.volumes:
+            self.volumes.move_to_end(key)
+            return self.volumes[key]
+
+        self.volumes[key] = volume
+
+        if len(self.volumes) > self.max_volumes:
+            self.volumes.popitem(last=False)
+
+        return volume
+
+
+# One cache per (worker) process
+_ctf_cache = None
+
+
+PROJECTION_METHODS = ("fourier", "real")
+
+
+def _slab_bounds(depth: int, z_thickness=None):
+    """Return first and last (exclusive) slice of the central slab."""
+    if z_thickness is None:
+        return 0, depth
+
+    z_upper = int(np.floor(depth / 2 + z_thickness / 2))
+    z_lower = int(np.floor(depth / 2 - z_thickness / 2))
+
+    return z_lower, z_upper
+
+
+def _slab_weights(depth: int, z_lower: int, z_upper: int):
+    """Weights of each kz for the sum over slices z_lower to z_upper.
+
+    Summing the inverse FFT along Z over the slab equals a weighted sum over
+    kz of the spectrum, with the DFT of the slab window as weights.
+    """
+    kz = np.fft.fftfreq(depth)
+    z = np.arange(z_lower, z_upper)
+
+    return np.exp(2j * np.pi * np.outer(kz, z)).sum(axis=1) / depth
+
+
+def binned_shape(shape: tuple, factor: float):
+    """Return even image shape (YX) after binning shape by factor (>= 1)."""
+    return tuple(
+        min(2 * round(size / (2 * factor)), size - size % 2) for size in shape
+    )
+
+
+def _crop_spectrum(spectra: np.array, shape: tuple, out_shape: tuple):
+    """Keep the lowest frequencies of 2D spectra (BYX, rfft2 layout) of shape (YX).
+
+    Values are scaled so that the inverse transform to out_shape keeps the
+    intensity of the images.
+    """
+    rows = np.r_[0 : (out_shape[0] + 1) // 2, -(out_shape[0] // 2) : 0]
+    columns = np.arange(out_shape[1] // 2 + 1)
+    scale = (out_shape[0] * out_shape[1]) / (shape[0] * shape[1])
+
+    return spectra[:, rows[:, np.newaxis], columns] * scale
+
+
+def fourier_crop(images: np.array, out_shape: tuple, fft=np.fft):
+    """Bin images (BYX) to out_shape (YX) by cropping their Fourier transforms."""
+    shape = images.shape[1:]
+
+    if tuple(out_shape) == shape:
+        return images
+
+    spectra = _crop_spectrum(fft.rfft2(images, axes=(-2, -1)), shape, out_shape)
+
+    return fft.irfft2(spectra, s=out_shape, axes=(-2, -1))
+
+
+def project_batch(
+    subtomos: np.array, ctf_volumes=None, z_thickness=None, fft=np.fft,
+    method="fourier", out_shape=None,
+):
+    """Project a batch of subtomograms along Z, optionally after applying CTFs.
+
+    All transforms of the batch are done in one call along the last axes.
+
+    With method "real", the CTF-weighted volumes are transformed back to real
+    space and averaged along Z. With "fourier" (projection-slice theorem), only
+    2D inverse transforms are needed: the full projection is the kz=0 plane,
+    which only needs the 2D transform of the summed slices, and a central slab
+    is a weighted sum over kz. Both give the same result up to rounding.
+
+    With out_shape, projections are binned by Fourier cropping, within the
+    inverse transform of the CTF-weighted plane if there is one.
+
+    Input:
+        subtomos: 4D np.array (BZYX), as read by mrcfile and stacked
+        ctf_volumes: 4D np.array, either in rfftn (Warp) or full fftn layout.
+            First axis can be 1 to apply the same CTF to the whole batch.
+        z_thickness: if given, only average the central number of slices
+        fft: FFT backend, see get_fft_backend
+        method: "fourier" or "real", only matters with ctf_volumes
+        out_shape: shape (YX) of the projections, if smaller than the box
+
+    Output:
+        projections: 3D np.array (BYX)
+
+    """
+    dim = subtomos.shape[1:]
+    z_lower, z_upper = _slab_bounds(dim[0], z_thickness)
+
+    if out_shape is None:
+        out_shape = dim[1:]
+
+    if ctf_volumes is not None and method == "fourier":
+        return _project_batch_fourier(
+            subtomos, ctf_volumes, z_lower, z_upper, tuple(out_shape), fft
+        )
+
+    axes = (-3, -2, -1)
+
+    # Apply CTF as convolution with volume
+    if ctf_volumes is not None:
+        # Check how the CTF volume is stored
+        # Warp stores it in a FFTW-like way, which allows use of rfftn
+        # rfftn returns the zero-frequency as the first item
+        if ctf_volumes.shape[1:] != dim:
+            subtomos = fft.irfftn(
+                fft.rfftn(subtomos, axes=axes) * ctf_volumes, s=dim, axes=axes
+            )
+
+        # Legacy approaches might store full array, use fftn
+        else:
+            subtomos = np.real(
+                fft.ifftn(fft.fftn(subtomos, axes=axes) * ctf_volumes, axes=axes)
+            )
+
+    # Use np.mean instead of np.sum to prevent overflow issues
+    # mrcfile reads as ZYX
+    projections = np.mean(subtomos[:, z_lower:z_upper], axis=1)
+
+    return fourier_crop(projections, tuple(out_shape), fft)
+
+
+def _project_batch_fourier(subtomos, ctf_volumes, z_lower, z_upper, out_shape, fft):
+    """CTF-weighted projection of the slab z_lower:z_upper, see project_batch."""
+    dim = subtomos.shape[1:]
+    full_layout = ctf_volumes.shape[1:] == dim
+
+    if (z_lower, z_upper) == (0, dim[0]):
+        # kz=0 plane of the 3D spectrum is the 2D spectrum of the sum along Z
+        summed = subtomos.sum(axis=1, dtype=np.float64)
+
+        if full_layout:
+            plane = fft.fft2(summed, axes=(-2, -1)) * ctf_volumes[:, 0]
+        else:
+            plane = fft.rfft2(summed, axes=(-2, -1)) * ctf_volumes[:, 0]
+
+    else:
+        weights = _slab_weights(dim[0], z_lower, z_upper)
+
+        if full_layout:
+            spectrum = fft.fftn(subtomos, axes=(-3, -2, -1)) * ctf_volumes
+        else:
+            spectrum = fft.rfftn(subtomos, axes=(-3, -2, -1)) * ctf_volumes
+
+        plane = np.tensordot(
+            weights.astype(spectrum.dtype), spectrum, axes=([0], [1])
+        )
+
+    if full_layout:
+        # The real part of ifft2 only depends on the Hermitian part of the plane,
+        # which can be stored in rfft2 layout like the Warp case
+        mirrored = np.roll(plane[:, ::-1, ::-1], 1, axis=(1, 2))
+        plane = ((plane + np.conj(mirrored)) / 2)[..., : dim[2] // 2 + 1]
+
+    if out_shape != dim[1:]:
+        plane = _crop_spectrum(plane, dim[1:], out_shape)
+
+    projections = fft.irfft2(plane, s=out_shape, axes=(-2, -1))
+
+    return projections / (z_upper - z_lower)
+
+
+def project_subtomo(
+    subtomo: np.array, ctf_volume=None, z_thickness=None, method="fourier"
+):
+    """Project a single subtomogram along Z, see project_batch."""
+    if ctf_volume is not None:
+        ctf_volume = ctf_volume[np.newaxis]
+
+    return project_batch(
+        subtomo[np.newaxis], ctf_volume, z_thickness, method=method
+    )[0]
+
+
+@lru_cache(maxsize=8)
+def _background_model(shape: tuple, bg_radius: float):
+    """Background mask and ramp-fit matrices for a box size, computed once.
+
+    Coordinates follow RELION, with the origin at pixel (box // 2).
+    """
+    y, x = np.indices(shape, dtype=np.float64)
+    y -= shape[0] // 2
+    x -= shape[1] // 2
+
+    mask = (x**2 + y**2) > bg_radius**2
+
+    # Plane a*x + b*y + c, fitted to the background by least squares
+    plane = np.stack([x.ravel(), y.ravel(), np.ones(x.size)], axis=1)
+    fit = np.linalg.pinv(plane[mask.ravel()])
+
+    return mask, plane, fit
+
+
+def normalize_background(images: np.array, bg_radius: float, ramp: bool = True):
+    """Normalize images to zero mean and unit stddev outside of a circle.
+
+    Mirrors relion_preprocess --norm --bg_radius: optionally subtract a plane
+    fitted to the background pixels, then scale by mean and stddev of the
+    background. All images of the batch are processed at once.
+
+    Input:
+        images: 3D np.array (BYX)
+        bg_radius: radius in pixels, pixels outside are treated as background
+        ramp: subtract fitted background ramp first (RELION default)
+
+    Output:
+        normalized: 3D np.array (BYX), float32
+
+    """
+    shape = images.shape[1:]
+    mask, plane, fit = _background_model(shape, float(bg_radius))
+
+    images = images.astype(np.float64)
+
+    if ramp:
+        coefficients = images[:, mask] @ fit.T
+        images -= (coefficients @ plane.T).reshape(-1, *shape)
+
+    background = images[:, mask]
+    mean = background.mean(axis=1)
+    std = background.std(axis=1)
+
+    # Flat background, avoid division by zero
+    std[std == 0] = 1
+
+    images -= mean[:, np.newaxis, np.newaxis]
+    images /= std[:, np.newaxis, np.newaxis]
+
+    return images.astype(np.float32)
+
+
+def _project_subtomos(
+    subtomos,
+    ctf_names,
+    perf,
+    z_thickness=None,
+    projection="fourier",
+    out_shape=None,
+    fft="numpy",
+    fft_workers=1,
+    ctf_cache_size=128,
+    bg_radius=None,
+    ramp=True,
+):
+    """Project and normalize a batch of subtomograms (BZYX), see project_batch.
+
+    CTF volumes are read through the CTF cache of this process. Returns the
+    projections as float32 stack, stages are recorded in perf.
+    """
+    global _ctf_cache
+
+    ctf_volumes = None
+
+    if ctf_names is not None:
+        with perf.stage("read CTF volumes"):
+            if _ctf_cache is None or _ctf_cache.max_volumes != ctf_cache_size:
+                _ctf_cache = CtfCache(ctf_cache_size)
+
+            misses, bytes_read = _ctf_cache.misses, _ctf_cache.bytes_read
+            volumes = [_ctf_cache.get(ctf_name) for ctf_name in ctf_names]
+
+            # Broadcast if the whole chunk shares one CTF
+            if all(volume is volumes[0] for volume in volumes):
+                ctf_volumes = volumes[0][np.newaxis]
+            else:
+                ctf_volumes = np.stack(volumes)
+
+        perf.count("CTF volumes read", _ctf_cache.misses - misses)
+        perf.read(nbytes=_ctf_cache.bytes_read - bytes_read)
+
+    with perf.stage("CTF and projection"):
+        projections = project_batch(
+            subtomos,
+            ctf_volumes,
+            z_thickness,
+            get_fft_backend(fft, fft_workers),
+            method=projection,
+            out_shape=out_shape,
+        ).astype(np.float32, copy=False)
+
+    if bg_radius is not None:
+        with perf.stage("normalization"):
+            projections = normalize_background(projections, bg_radius, ramp)
+
+    perf.count("particles projected", len(projections))
+
+    return projections
+
+
+def _project_chunk(image_names, ctf_names, **params):
+    """Read, project and normalize a chunk of subtomograms.
+
+    Returns the projections as float32 stack and the Metrics of this chunk.
+    """
+    perf = metrics.Metrics()
+
+    with perf.stage("read subtomograms"):
+        subtomos = volume_io.read_volumes(image_names)
+
+    perf.read(nbytes=subtomos.nbytes)
+
+    return _project_subtomos(subtomos, ctf_names, perf, **params), perf
+
+
+def _project_read_chunk(subtomos, ctf_names, **params):
+    """Project and normalize a chunk of subtomograms which was read ahead."""
+    perf = metrics.Metrics()
+    perf.read(nbytes=subtomos.nbytes)
+
+    return _project_subtomos(subtomos, ctf_names, perf, **params), perf
+
+
+def _write_projections(
+    tasks, out_mrcs, n_particles, shape, angpix, jobs=1, known=()
+):
+    """Run projection tasks and stream their results into a .mrcs stack.
+
+    The output is memory-mapped, so only the tasks in flight are held in memory.
+    With jobs > 1, tasks are run by a pool of worker processes.
+
+    Input:
+        tasks: iterable of (rows, function, args, kwargs). function(*args,
+            **kwargs) returns projections and Metrics, written to rows (slice
+            or index array) of the stack
+        out_mrcs: path of the output stack
+        n_particles: number of images in the stack
+        shape: shape (YX) of the projections
+        angpix: pixel size of the projections, written to the stack header
+        jobs: number of worker processes
+        known: iterable of (rows, projections) at hand already, e.g. from the
+            projection cache, written before running the tasks
+
+    Stage timings, counts and bytes (also those of the workers) are added to
+    metrics.current().
+
+    """
+    perf = metrics.current()
+
+    with mrcfile.new_mmap(
+        out_mrcs, shape=(n_particles, *shape), mrc_mode=2, overwrite=True
+    ) as mrcs, tqdm(total=n_particles) as pbar:
+        mrcs.set_image_stack()
+        mrcs.voxel_size = angpix
+
+        def write(rows, result):
+            projections, task_metrics = result
+            perf.merge(task_metrics, parallel=jobs > 1)
+
+            with perf.stage("write stack"):
+                mrcs.data[rows] = projections
+
+            pbar.update(len(projections))
+
+        for rows, projections in known:
+            with perf.stage("write stack"):
+                mrcs.data[rows] = projections
+
+            pbar.update(len(projections))
+
+        # With jobs > 1 this is the time spent waiting for workers. Serial tasks
+        # are counted in their own stages, see Metrics.merge
+        with perf.stage("project (waiting for workers)"):
+            if jobs > 1:
+                with ProcessPoolExecutor(max_workers=jobs) as executor:
+                    # Keep a bounded number of tasks in flight to limit memory
+                    in_flight = deque()
+
+                    for rows, function, args, kwargs in tasks:
+                        future = executor.submit(function, *args, **kwargs)
+                        in_flight.append((rows, future))
+
+                        if len(in_flight) >= 2 * jobs:
+                            done_rows, future = in_flight.popleft()
+                            write(done_rows, future.result())
+
+                    for done_rows, future in in_flight:
+                        write(done_rows, future.result())
+
+            else:
+                for rows, function, args, kwargs in tasks:
+                    write(rows, function(*args, **kwargs))
+
+        with perf.stage("write stack"):
+            mrcs.update_header_stats()
+
+    perf.wrote(out_mrcs)
+
+
+def project_to_stack(
+    image_names,
+    ctf_names,
+    out_mrcs,
+    shape,
+    angpix,
+    jobs=1,
+    chunk=64,
+    read_ahead=2,
+    rows=None,
+    known=(),
+    **params,
+):
+    """Project subtomograms in chunks and stream them into a .mrcs stack.
+
+    Workers read their own chunks. With a single job, the next chunks are read
+    in the background while projecting (see volume_io.VolumeReader).
+
+    Input:
+        image_names: list of subtomogram paths or N@stack names
+        ctf_names: list of CTF volume paths, or None for no CTF correction
+        out_mrcs: path of the output stack
+        shape: shape (YX) of the projections, binned if smaller than the
+            subtomograms
+        angpix: pixel size of the projections, written to the stack header
+        jobs: number of worker processes
+        chunk: number of particles handled (and FFT'd) together per task
+        read_ahead: number of chunks read in advance with a single job
+        rows: positions of the particles to project, all by default
+        known: (rows, projections) of the other particles, see _write_projections
+        params: passed on to _project_chunk (z_thickness, fft, bg_radius, ...)
+
+    """
+    params["out_shape"] = tuple(shape)
+    n_particles = len(image_names)
+
+    if rows is not None:
+        image_names = [image_names[row] for row in rows]
+
+        if ctf_names is not None:
+            ctf_names = [ctf_names[row] for row in rows]
+
+    starts = range(0, len(image_names), chunk)
+
+    def task_rows(start):
+        if rows is None:
+            return slice(start, start + chunk)
+
+        return rows[start : start + chunk]
+
+    def ctf_chunk(start):
+        return None if ctf_names is None else ctf_names[start : start + chunk]
+
+    if jobs > 1:
+        tasks = (
+            (
+                task_rows(start),
+                _project_chunk,
+                (image_names[start : start + chunk], ctf_chunk(start)),
+                params,
+            )
+            for start in starts
+        )
+    else:
+        reader = volume_io.VolumeReader(
+            (image_names[start : start + chunk] for start in starts), read_ahead
+        )
+        tasks = (
+            (
+                task_rows(start),
+                _project_read_chunk,
+                (subtomos, ctf_chunk(start)),
+                params,
+            )
+            for start, subtomos in zip(
+                starts, metrics.current().timed(reader, "read subtomograms")
+            )
+        )
+
+    _write_projections(tasks, out_mrcs, n_particles, shape, angpix, jobs, known)
+
+
+def project_cached(cache, image_names, ctf_names, out_mrcs, shape, angpix, **kwargs):
+    """Like project_to_stack, but only project particles missing from the cache.
+
+    Cached projections are copied into the stack, new ones are added to the
+    cache afterwards.
+
+    Input:
+        cache: projection_cache.ProjectionCache for projections of shape
+        kwargs: passed on to project_to_stack (jobs, chunk, z_thickness, ...)
+
+    Output:
+        n_cached: number of projections taken from the cache
+
+    """
+    perf = metrics.current()
+    # Copy cached and new images in blocks, to bound memory
+    block = 4096
+
+    with perf.stage("projection cache"):
+        keys = projection_cache.projection_keys(
+            image_names, ctf_names, {**kwargs, "out_shape": tuple(shape)}
+        )
+        slots = cache.lookup(keys)
+
+    cached = np.flatnonzero(slots >= 0)
+    missing = np.flatnonzero(slots < 0)
+    known = (
+        (rows, cache.read(slots[rows]))
+        for rows in np.array_split(cached, range(block, len(cached), block))
+    )
+
+    project_to_stack(
+        image_names,
+        ctf_names,
+        out_mrcs,
+        shape,
+        angpix,
+        rows=missing,
+        known=perf.timed(known, "projection cache"),
+        **kwargs,
+    )
+
+    with perf.stage("projection cache"):
+        with mrcfile.mmap(out_mrcs, mode="r", permissive=True) as mrcs:
+            for start in range(0, len(missing), block):
+                rows = missing[start : start + block]
+                cache.store([keys[row] for row in rows], mrcs.data[rows])
+
+        cache.save()
+
+    perf.count("projections from cache", len(cached))
+
+    return len(cached)
+
+
+def find_tomogram(folder, name: str):
+    """Return the tomogram of a particle in folder.
+
+    Tries <name>.mrc and <name>.rec, then a unique <name>*.mrc (e.g. Warp's
+    TS_01_10.00Apx.mrc), with name stripped of its suffix (e.g. .tomostar).
+    """
+    folder = Path(folder)
+    stem = Path(name).stem
+
+    for candidate in (folder / f"{stem}.mrc", folder / f"{stem}.rec"):
+        if candidate.exists():
+            return candidate
+
+    matches = sorted(folder.glob(f"{stem}*.mrc"))
+
+    if len(matches) != 1:
+        raise click.ClickException(
+            f"Found {len(matches)} tomograms for {name} in {folder}, expected one."
+        )
+
+    return matches[0]
+
+
+def box_centres(star: dict, particles, tomo_dim, tomo_angpix, coords_angpix=None):
+    """Return XYZ centres of particles in voxels of their tomogram, shifts applied.
+
+    Relion 5 centered coordinates (Angstrom) refer to the centre of the
+    tomogram. Other coordinates are in pixels of size coords_angpix, or of the
+    tomogram if not given, see star_operations.shifted_coordinates.
+    """
+    if "rlnCenteredCoordinateXAngst" in particles:
+        centres = np.stack(
+            [
+                particles[f"rlnCenteredCoordinate{ax}Angst"].to_numpy(np.float64)
+                - particles.get(f"rlnOrigin{ax}Angst", 0)
+                for ax in "XYZ"
+            ],
+            axis=1,
+        )
+
+        return centres / tomo_angpix + np.array(tomo_dim[::-1]) / 2
+
+    centres = star_operations.shifted_coordinates(star, particles).astype(np.float64)
+
+    if coords_angpix is not None:
+        centres *= coords_angpix / tomo_angpix
+
+    return centres
+
+
+def _box_starts(centres: np.array, box: int):
+    """Return the ZYX corners of boxes around XYZ centres, see extract_boxes."""
+    return np.round(centres[:, ::-1]).astype(np.int64) - box // 2
+
+
+def boxes_outside(centres: np.array, box: int, shape):
+    """Return mask of the boxes around centres (XYZ) entirely outside shape (ZYX)."""
+    starts = _box_starts(centres, box)
+
+    return np.any((starts + box <= 0) | (starts >= np.array(shape)), axis=1)
+
+
+def extract_boxes(volume: np.array, centres: np.array, box: int):
+    """Cut cubic boxes (BZYX, float32) around centres out of a volume (ZYX).
+
+    Centres are XYZ in voxels, rounded to the nearest voxel, which becomes
+    voxel box // 2 of the box. Boxes within the volume are gathered at once by
+    indexing a sliding-window view of the volume with their corners, in order
+    of Z, so a memory-mapped volume is read front to back. Only boxes reaching
+    outside are cut one by one, and filled with the mean of the part inside.
+    Boxes entirely outside the volume raise a ValueError, see boxes_outside.
+    """
+    starts = _box_starts(centres, box)
+    shape = np.array(volume.shape)
+    outside = np.flatnonzero(boxes_outside(centres, box, shape))
+
+    if len(outside):
+        raise ValueError(
+            f"Boxes {outside.tolist()} lie entirely outside the volume {shape}."
+        )
+
+    boxes = np.empty((len(starts), box, box, box), dtype=np.float32)
+
+    within = np.all((starts >= 0) & (starts + box <= shape), axis=1)
+    rows = np.flatnonzero(within)
+
+    if len(rows):
+        rows = rows[np.argsort(starts[rows, 0], kind="stable")]
+        windows = np.lib.stride_tricks.sliding_window_view(volume, (box,) * 3)
+        boxes[rows] = windows[starts[rows, 0], starts[rows, 1], starts[rows, 2]]
+
+    for i in np.flatnonzero(~within):
+        start = starts[i]
+        lower = np.clip(start, 0, shape)
+        upper = np.clip(start + box, 0, shape)
+        inside = volume[lower[0] : upper[0], lower[1] : upper[1], lower[2] : upper[2]]
+        boxes[i] = np.pad(
+            inside,
+            list(zip(lower - start, start + box - upper)),
+            constant_values=inside.mean(),
+        )
+
+    return boxes
+
+
+@lru_cache(maxsize=2)
+def _open_tomogram(path: str):
+    """Memory-map a tomogram, once per (worker) process."""
+    return mrcfile.mmap(path, mode="r", permissive=True)
+
+
+def _project_tomogram(tomogram, centres, ctf_names, box, chunk=64, **params):
+    """Cut the boxes of one tomogram from its memory map and project them.
+
+    Boxes are extracted and transformed in batches of chunk particles. Returns
+    the projections as float32 stack and the Metrics of this tomogram.
+    """
+    perf = metrics.Metrics()
+
+    with perf.stage("map tomograms"):
+        volume = _open_tomogram(str(tomogram)).data
+
+    # Chunks of particles sorted by Z read the tomogram front to back
+    order = np.argsort(centres[:, 2], kind="stable")
+    centres = centres[order]
+
+    if ctf_names is not None:
+        ctf_names = [ctf_names[i] for i in order]
+
+    projections = []
+
+    for start in range(0, len(centres), chunk):
+        with perf.stage("extract boxes"):
+            subtomos = extract_boxes(volume, centres[start : start + chunk], box)
+
+        perf.read(nbytes=subtomos.nbytes)
+
+        projections.append(
+            _project_subtomos(
+                subtomos,
+                None if ctf_names is None else ctf_names[start : start + chunk],
+                perf,
+                **params,
+            )
+        )
+
+    perf.count("tomograms")
+    projections = np.concatenate(projections)
+    projections[order] = projections.copy()
+
+    return projections, perf
+
+
+def project_tomograms_to_stack(
+    tomograms, ctf_names, out_mrcs, box, shape, angpix, jobs=1, chunk=64, **params
+):
+    """Extract and project particles straight from tomograms into a .mrcs stack.
+
+    Each tomogram is one task: it is memory-mapped once and all of its boxes
+    are cut and projected, without writing subtomograms.
+
+    Input:
+        tomograms: list of (tomogram path, rows, centres), with the rows of
+            its particles in the stack and their XYZ centres in voxels
+        ctf_names: list of CTF volume paths for all rows, or None
+        out_mrcs: path of the output stack
+        box: box size in voxels of the tomograms
+        shape: shape (YX) of the projections, binned if smaller than box
+        angpix: pixel size of the projections, written to the stack header
+        jobs: number of tomograms processed in parallel
+        chunk: number of particles handled (and FFT'd) together
+        params: passed on to _project_subtomos (z_thickness, fft, bg_radius, ...)
+
+    """
+    params["out_shape"] = tuple(shape)
+    n_particles = sum(len(rows) for _, rows, _ in tomograms)
+
+    tasks = (
+        (
+            rows,
+            _project_tomogram,
+            (
+                tomogram,
+                centres,
+                None if ctf_names is None else [ctf_names[row] for row in rows],
+                box,
+                chunk,
+            ),
+            params,
+        )
+        for tomogram, rows, centres in tomograms
+    )
+
+    _write_projections(tasks, out_mrcs, n_particles, shape, angpix, jobs)
+
+
+def _tomogram_tasks(star: dict, particles, folder, box, coords_angpix=None):
+    """Group particles by tomogram for project_tomograms_to_stack.
+
+    Particles of each tomogram are ordered along Z and Y, so that boxes are
+    read from the memory map in file order.
+
+    Output:
+        tomograms: list of (tomogram path, rows, centres), see
+            project_tomograms_to_stack
+        outside: positions of the particles whose box lies entirely outside
+            their tomogram. They are left out, and rows refer to the remaining
+            particles
+
+    """
+    if "rlnTomoName" in particles:
+        names = particles["rlnTomoName"]
+    else:
+        names = particles["rlnMicrographName"]
+
+    tomograms = []
+    kept = np.ones(len(particles.index), dtype=bool)
+
+    for name, rows in utils.group_indices(names).items():
+        tomogram = find_tomogram(folder, name)
+        tomo_dim, tomo_angpix = utils.probe_mrc(str(tomogram))
+        centres = box_centres(
+            star, particles.iloc[rows], tomo_dim, tomo_angpix, coords_angpix
+        )
+
+        outside = boxes_outside(centres, box, tomo_dim)
+        kept[rows[outside]] = False
+        rows, centres = rows[~outside], centres[~outside]
+
+        order = np.lexsort((centres[:, 1], centres[:, 2]))
+        tomograms.append((tomogram, rows[order], centres[order]))
+
+    # Rows in the stack of the particles which are kept
+    new_rows = np.cumsum(kept) - 1
+    tomograms = [
+        (tomogram, new_rows[rows], centres)
+        for tomogram, rows, centres in tomograms
+        if len(rows)
+    ]
+
+    return tomograms, np.flatnonzero(~kept)
+
 
 @click.command()
+@metrics.instrumented(summary=True)
 @click.option(
     "--ctf",
     is_flag=True,
@@ -22,88 +893,351 @@ from tqdm import tqdm
     "-z",
     "--z-thickness",
     default=None,
+    type=int,
     show_default=True,
     help="If given, project only central number of pixels.",
 )
-@click.option("-r", "--radius", help="Radius of particle in pixels, for normalization.")
+@click.option(
+    "--projection",
+    type=click.Choice(PROJECTION_METHODS),
+    default="fourier",
+    show_default=True,
+    help="How to project with --ctf: fourier takes the central slice (or slab) "
+    "of the CTF-weighted spectrum, real transforms the whole volume back first.",
+)
+@click.option(
+    "--bin",
+    "bin_factor",
+    type=click.FloatRange(min=1),
+    default=None,
+    help="Bin projections by this factor, by Fourier cropping.",
+)
+@click.option(
+    "--target-angpix",
+    type=float,
+    default=None,
+    help="Bin projections to about this pixel size, instead of --bin.",
+)
+@click.option(
+    "-r",
+    "--radius",
+    type=int,
+    default=None,
+    help="Radius of particle in pixels of the subtomograms, for normalization. "
+    "If not given, projections are not normalized.",
+)
+@click.option(
+    "--ramp/--no-ramp",
+    default=True,
+    show_default=True,
+    help="Subtract a plane fitted to the background before normalization.",
+)
+@click.option(
+    "--relion-norm",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Normalize with relion_preprocess instead of the built-in normalization.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    type=int,
+    show_default=True,
+    help="Number of worker processes for reading and projection.",
+)
+@click.option(
+    "--chunk",
+    default=64,
+    type=int,
+    show_default=True,
+    help="Number of particles per worker task, transformed as one batch.",
+)
+@click.option(
+    "--read-ahead",
+    default=2,
+    type=int,
+    show_default=True,
+    help="Chunks of subtomograms read in the background while projecting, "
+    "with -j 1.",
+)
+@click.option(
+    "--fft",
+    type=click.Choice(FFT_BACKENDS),
+    default="numpy",
+    show_default=True,
+    help="FFT backend. scipy and pyfftw have to be installed separately.",
+)
+@click.option(
+    "--fft-workers",
+    default=1,
+    type=int,
+    show_default=True,
+    help="Threads per FFT, for the scipy and pyfftw backends.",
+)
+@click.option(
+    "--ctf-cache",
+    default=128,
+    type=int,
+    show_default=True,
+    help="Number of distinct CTF volumes kept in memory per worker.",
+)
+@click.option(
+    "--check",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Check that all subtomograms (and CTF volumes) exist and have one shape.",
+)
+@click.option(
+    "--tomograms",
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+    help="Cut particles directly out of the tomograms in this folder, matched by "
+    "rlnTomoName or rlnMicrographName, instead of reading subtomograms.",
+)
+@click.option(
+    "--box",
+    type=int,
+    default=None,
+    help="Box size in pixels of the tomograms, required with --tomograms.",
+)
+@click.option(
+    "--coords-angpix",
+    type=float,
+    default=None,
+    help="Pixel size of the coordinates, if different from the tomograms.",
+)
+@click.option(
+    "--projection-cache",
+    "cache_folder",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Keep projections in this folder and only project particles not found "
+    "there, e.g. when projecting a grown particle set again.",
+)
+@click.option(
+    "--projection-cache-gb",
+    "cache_gb",
+    default=20.0,
+    type=float,
+    show_default=True,
+    help="Largest size of the projection cache, the projections least recently "
+    "used are replaced first.",
+)
+@click.option(
+    "--shard",
+    callback=shards.parse_shard,
+    default=None,
+    help="Only project shard i of N (e.g. 2/8) of the particles, split by rows. "
+    "Partial outputs (<stem>_projected.shard2of8.star/.mrcs) are combined with "
+    "merge-shards.",
+)
 @click.argument("input_star", nargs=1)
-def project_particles(ctf, z_thickness, radius, input_star):
+def project_particles(  # noqa: C901
+    ctf,
+    z_thickness,
+    projection,
+    bin_factor,
+    target_angpix,
+    radius,
+    ramp,
+    relion_norm,
+    jobs,
+    chunk,
+    read_ahead,
+    fft,
+    fft_workers,
+    ctf_cache,
+    check,
+    tomograms,
+    box,
+    coords_angpix,
+    cache_folder,
+    cache_gb,
+    shard,
+    input_star,
+):
     """Project subtomograms to 2D.
 
     Takes starfile from Warp etc as input.
     Performs projection of all subtomograms listed.
     Writes out starfile to be used for 2D cleaning.
 
+    With --tomograms, particles are cut out of the (memory-mapped) tomograms
+    instead, so subtomograms do not have to be written beforehand.
+
     """
     input_star = Path(input_star)
+    perf = metrics.current()
 
-    particles = starfile.read(input_star)
+    with perf.stage("read star"):
+        star = utils.read_particles(input_star)
 
-    # Check if starfile is Relion >3.1 format.
-    if "particles" in particles:
-        particles = particles["particles"]
+    perf.read(input_star)
+
+    # Relion >3.1 format has a particles block next to optics
+    particles = star[star_io.particles_key(star)]
+
+    if shard is not None:
+        particles = particles.iloc[shards.shard_rows(len(particles.index), shard)]
 
     print(f"Found {len(particles.index)} Particles to project.")
 
-    # Prime some values, so that they only have to be read once
-    with mrcfile.open(particles.iloc[0]["rlnImageName"]) as mrc:
-        dim = mrc.data.shape
-        angpix = mrc.voxel_size.x
+    if tomograms is not None and box is None:
+        raise click.UsageError("--tomograms requires --box.")
 
-    # Preallocate array to store results
-    projections = np.empty((len(particles.index), dim[1], dim[2]), dtype=np.float32)
+    if tomograms is not None and cache_folder is not None:
+        raise click.UsageError("--projection-cache only works with subtomograms.")
 
-    with tqdm(total=len(particles.index)) as pbar:
-        for index, row in particles.iterrows():
-            subtomo = mrcfile.read(row["rlnImageName"])
+    if check:
+        with perf.stage("check files"):
+            problems = []
+
+            if tomograms is None:
+                problems += utils.validate_mrcs(particles["rlnImageName"])
 
-            # Apply CTF as convolution with volume
             if ctf:
-                subtomo_in = subtomo.copy()
-                ctf_volume = mrcfile.read(row["rlnCtfImage"])
+                problems += utils.validate_mrcs(particles["rlnCtfImage"])
 
-                # Check how the CTF volume is stored
-                # Warp stores it in a FFTW-like way, which allows use of rfftn
-                # rfftn returns the zero-frequency as the first item
+        for path, message in problems:
+            print(f"{path}: {message}")
 
-                if not ctf_volume.shape == dim:
-                    subtomo = np.fft.irfftn(
-                        np.fft.rfftn(subtomo_in) * ctf_volume, s=subtomo_in.shape
-                    )
+        if problems:
+            raise click.ClickException(f"Found {len(problems)} problematic files.")
 
-                # Legacy approaches might store full array, use fftn
-                else:
-                    subtomo = np.real(np.fft.ifftn(np.fft.fftn(subtomo) * ctf_volume))
+    # Prime some values, so that they only have to be read once
+    if tomograms is None:
+        dim, angpix = utils.probe_mrc(particles.iloc[0]["rlnImageName"])
+    else:
+        with perf.stage("map tomograms"):
+            tomogram_tasks, outside = _tomogram_tasks(
+                star, particles, tomograms, box, coords_angpix
+            )
 
-            # Use np.mean instead of np.sum to prevent overflow issues
-            if z_thickness is not None:
-                z_thickness = int(z_thickness)
-                z_upper = int(np.floor(dim[0] / 2 + z_thickness / 2))
-                z_lower = int(np.floor(dim[0] / 2 - z_thickness / 2))
+        if len(outside):
+            print(
+                f"Warning: skipping {len(outside)} particles whose box lies "
+                "entirely outside their tomogram, at rows "
+                f"{', '.join(map(str, particles.index[outside]))} of the star."
+            )
+            kept = np.delete(np.arange(len(particles.index)), outside)
+            particles = particles.iloc[kept]
 
-                projections[index] = np.mean(subtomo[z_lower:z_upper], axis=0)
+        if not tomogram_tasks:
+            raise click.ClickException("No particles within their tomograms.")
 
-            else:
-                # mrcfile reads as ZYX
-                projections[index] = np.mean(subtomo.data, axis=0)
+        dim = (box, box, box)
+        angpix = utils.probe_mrc(str(tomogram_tasks[0][0]))[1]
 
-            pbar.update(1)
+    # Fail early if the backend is not installed
+    get_fft_backend(fft, fft_workers)
 
-    print("Particles projected, writing out stack. \n")
+    if bin_factor is not None and target_angpix is not None:
+        raise click.UsageError("Give either --bin or --target-angpix.")
 
-    mrcs = mrcfile.new("temp.mrcs", overwrite=True)
-    mrcs.set_data(projections)
-    mrcs.set_image_stack()
-    mrcs.voxel_size = angpix
-    mrcs.close()
+    if target_angpix is not None:
+        bin_factor = target_angpix / angpix
+
+        if bin_factor < 1:
+            raise click.UsageError(
+                f"--target-angpix is smaller than the pixel size of {angpix} A."
+            )
+
+    shape = dim[1:]
+
+    if bin_factor is not None:
+        shape = binned_shape(shape, bin_factor)
+        # Even box sizes are rounded, so the actual factor may differ slightly
+        angpix = angpix * dim[2] / shape[1]
+
+        if radius is not None:
+            radius = round(radius * shape[1] / dim[2])
+
+        print(f"Binning projections to {shape[1]} px at {angpix:.3f} A/px.")
+
+    out_base = shards.shard_name(
+        f"{input_star.with_name(input_star.stem)}_projected", shard
+    )
+    out_mrcs = f"{out_base}.mrcs"
+    temp_mrcs = f"{Path(out_base).name}_temp.mrcs"
+
+    if radius is None:
+        if relion_norm:
+            raise click.UsageError("--relion-norm requires --radius.")
+
+        print("No radius given, projections will not be normalized.")
+
+    params = {
+        "z_thickness": z_thickness,
+        "projection": projection,
+        "fft": fft,
+        "fft_workers": fft_workers,
+        "ctf_cache_size": ctf_cache,
+        "bg_radius": None if relion_norm else radius,
+        "ramp": ramp,
+    }
+    ctf_names = particles["rlnCtfImage"].tolist() if ctf else None
+
+    if cache_folder is not None:
+        cache = projection_cache.ProjectionCache(cache_folder, shape, cache_gb * 1e9)
+        n_cached = project_cached(
+            cache,
+            particles["rlnImageName"].tolist(),
+            ctf_names,
+            temp_mrcs if relion_norm else out_mrcs,
+            shape,
+            angpix,
+            jobs=jobs,
+            chunk=chunk,
+            read_ahead=read_ahead,
+            **params,
+        )
+        print(f"Took {n_cached} projections from the cache, it holds {len(cache)}.")
+    elif tomograms is None:
+        project_to_stack(
+            particles["rlnImageName"].tolist(),
+            ctf_names,
+            temp_mrcs if relion_norm else out_mrcs,
+            shape,
+            angpix,
+            jobs=jobs,
+            chunk=chunk,
+            read_ahead=read_ahead,
+            **params,
+        )
+    else:
+        project_tomograms_to_stack(
+            tomogram_tasks,
+            ctf_names,
+            temp_mrcs if relion_norm else out_mrcs,
+            box,
+            shape,
+            angpix,
+            jobs=jobs,
+            chunk=chunk,
+            **params,
+        )
+
+    print("Particles projected, stack written. \n")
 
     # make particles star
-    # Micrograph Name and XYZ are assumed to always be present
+    # Micrograph Name and XYZ (or tomogram and centered XYZ for Relion 5)
     particles_2d = pd.DataFrame()
-    particles_2d["rlnMicrographName"] = particles["rlnMicrographName"]
-    particles_2d["rlnCoordinateX"] = particles["rlnCoordinateX"]
-    particles_2d["rlnCoordinateY"] = particles["rlnCoordinateY"]
-    particles_2d["rlnCoordinateZ"] = particles["rlnCoordinateZ"]
+
+    for column in (
+        "rlnMicrographName",
+        "rlnTomoName",
+        "rlnCoordinateX",
+        "rlnCoordinateY",
+        "rlnCoordinateZ",
+        "rlnCenteredCoordinateXAngst",
+        "rlnCenteredCoordinateYAngst",
+        "rlnCenteredCoordinateZAngst",
+    ):
+        if column in particles:
+            particles_2d[column] = particles[column]
 
     # Angles are only sometimes there, eg. after template matching
     # Assume that they all come together
@@ -121,7 +1255,7 @@ def project_particles(ctf, z_thickness, radius, input_star):
 
     # New Info
     particles_2d["rlnImageName"] = [
-        f"{i}@{input_star.with_name(input_star.stem)}_projected.mrcs"
+        f"{i}@{out_mrcs}"
         for i in range(1, len(particles.index) + 1)
     ]
     particles_2d["rlnOpticsGroup"] = "1"
@@ -134,7 +1268,7 @@ def project_particles(ctf, z_thickness, radius, input_star):
                 "rlnOpticsGroupName": "opticsGroup1",
                 "rlnOpticsGroup": "1",
                 "rlnMicrographPixelSize": angpix,
-                "rlnImageSize": dim[2],
+                "rlnImageSize": shape[1],
                 "rlnVoltage": "300",
                 "rlnSphericalAberration": "2.7",
                 "rlnAmplitudeContrast": "0.1",
@@ -143,31 +1277,171 @@ def project_particles(ctf, z_thickness, radius, input_star):
         ]
     )
 
-    starfile.write(
-        {"optics": star_optics, "particles": particles_2d},
-        f"{input_star.with_name(input_star.stem)}_projected.star",
-    )
+    out_star = f"{out_base}.star"
 
-    subprocess.run(
-        [
+    with perf.stage("write star"):
+        starfile.write({"optics": star_optics, "particles": particles_2d}, out_star)
+
+    perf.wrote(out_star)
+
+    if relion_norm:
+        args = [
             "relion_preprocess",
             "--operate_on",
-            "temp.mrcs",
+            temp_mrcs,
             "--norm",
             "--bg_radius",
             str(radius),
             "--operate_out",
-            f"{input_star.with_name(input_star.stem)}_projected.mrcs",
+            out_mrcs,
         ]
-    )
 
-    os.unlink("temp.mrcs")
+        if not ramp:
+            args.append("--no_ramp")
+
+        with perf.stage("relion_preprocess"):
+            subprocess.run(args, check=True)
+
+        os.unlink(temp_mrcs)
+
+
+def subset_particles(subset_star: dict):
+    """Return particles of a 2D subset star (dict of blocks), with shifts in A.
+
+    Shifts in Angstrom do not depend on the binning of the projections and can
+    be taken over by the subtomograms as they are. Shifts in pixels of the
+    projections (rlnOriginX/Y) are converted with the pixel size of their
+    optics group.
+    """
+    particles = subset_star["particles"]
+
+    if "rlnOriginX" not in particles or "rlnOriginXAngst" in particles:
+        return particles
+
+    if "optics" not in subset_star:
+        raise click.ClickException(
+            "Subset star has shifts in pixels, but no optics to convert them."
+        )
+
+    optics = subset_star["optics"]
+
+    if "rlnImagePixelSize" in optics:
+        pixel_size = optics["rlnImagePixelSize"]
+    else:
+        pixel_size = optics["rlnMicrographPixelSize"]
+
+    pixel_size = pixel_size.astype(float)
+
+    if "rlnOpticsGroup" in particles:
+        groups = dict(zip(optics["rlnOpticsGroup"].astype(str), pixel_size))
+        angpix = particles["rlnOpticsGroup"].astype(str).map(groups).to_numpy()
+    else:
+        angpix = pixel_size.iloc[0]
+
+    particles = particles.copy()
+    particles["rlnOriginXAngst"] = particles["rlnOriginX"] * angpix
+    particles["rlnOriginYAngst"] = particles["rlnOriginY"] * angpix
+
+    return particles
+
+
+def select_subset(fullset_3d: pd.DataFrame, subset_2d: pd.DataFrame, indices):
+    """Select 3D particles picked in 2D, and take over 2D alignment.
+
+    Input:
+        fullset_3d: particles table of the subtomogram star
+        subset_2d: rows of the 2D subset referring to this subtomogram star
+        indices: 0-based positions of the selected particles in fullset_3d
+
+    Output:
+        subset_3d: selected particles, in the order of subset_2d
+
+    """
+    subset_3d = fullset_3d.iloc[indices].copy()
+
+    # merge offsets xy and psi angle from 2d classification
+    subset_3d["rlnAnglePsi"] = subset_2d["rlnAnglePsi"].to_numpy()
+    subset_3d["rlnOriginXAngst"] = subset_2d["rlnOriginXAngst"].to_numpy()
+    subset_3d["rlnOriginYAngst"] = subset_2d["rlnOriginYAngst"].to_numpy()
+
+    # if group is given, take over
+    if "rlnClassNumber" in subset_2d:
+        subset_3d["rlnClassNumber"] = subset_2d["rlnClassNumber"].to_numpy()
+
+    return subset_3d
+
+
+def stack_rows(subset_2d: pd.DataFrame, stack_name: str):
+    """Return rows of a 2D subset within one projection stack, see select.
+
+    Output:
+        rows: positions of the rows referring to stack_name in subset_2d
+        indices: 0-based positions of these particles within the stack
+
+    """
+    image_name = subset_2d["rlnImageName"].str.split("@", n=1, expand=True)
+    rows = np.flatnonzero((image_name[1] == stack_name).to_numpy())
+    indices = image_name[0].iloc[rows].astype(np.int64).to_numpy() - 1
+
+    return rows, indices
+
+
+def select(star: dict, subset_2d: pd.DataFrame, stack_name: str):
+    """Apply a 2D subset selection to a subtomogram star (dict of blocks).
+
+    Input star is not modified. Particles are matched by their position in the
+    projection stack stack_name, e.g. <stem>_projected.mrcs, see apply-selection.
+    """
+    rows, indices = stack_rows(subset_2d, stack_name)
+
+    return {
+        "optics": star["optics"],
+        "particles": select_subset(
+            star["particles"], subset_2d.iloc[rows], indices
+        ),
+    }
+
+
+def _apply_subset_to_star(st_star, subset_2d, indices):
+    """Write the selected particles of one subtomogram star.
+
+    Returns the number of selected particles and the Metrics of this star.
+    """
+    perf = metrics.Metrics()
+    out_star = Path(st_star).with_name(f"{Path(st_star).stem}_selected.star")
+
+    with perf.stage("read star"):
+        fullset_3d = utils.read_particles(st_star)
+
+    perf.read(st_star)
+
+    with perf.stage("select particles"):
+        subset_3d = select_subset(fullset_3d["particles"], subset_2d, indices)
+
+    with perf.stage("write star"):
+        star_io.write_star(
+            {"optics": fullset_3d["optics"], "particles": subset_3d}, out_star
+        )
+
+    perf.wrote(out_star)
+    perf.count("particles selected", len(subset_3d.index))
+
+    return len(subset_3d.index), perf
 
 
 @click.command()
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    type=int,
+    show_default=True,
+    help="Number of subtomogram stars processed in parallel.",
+)
+@metrics.instrumented()
 @click.argument("subset_star", nargs=1)
 @click.argument("subtomo_stars", nargs=-1)
-def apply_subset(subset_star, subtomo_stars):
+def apply_subset(jobs, subset_star, subtomo_stars):
     """Apply subset selection to 3D dataset.
 
     Give the star file from subset selection job in relion, the star file(s)
@@ -177,39 +1451,38 @@ def apply_subset(subset_star, subtomo_stars):
     Uses the filename of the projections stack to match.
 
     """
-    subset = starfile.read(subset_star, always_dict=True)
-    subset = subset["particles"]
-
-    subset["origin_star"] = subset["rlnImageName"].str.split("@", expand=True)[1]
-
-    for st_star in subtomo_stars:
-        fullset_3d = starfile.read(st_star, always_dict=True)
-        subset_2d = subset[
-            subset["rlnImageName"].str.split("@", expand=True)[1]
-            == f"{Path(st_star).stem}_projected.mrcs"
-        ]
+    perf = metrics.current()
 
-        selected_idx = subset_2d["rlnImageName"].str.split("@", expand=True)[0].tolist()
+    with perf.stage("read subset star"):
+        subset = subset_particles(star_io.read_star(subset_star))
 
-        # indices in mrcs are 1-based
-        selected_idx = [int(idx) - 1 for idx in selected_idx]
+    perf.read(subset_star)
 
-        subset_3d = fullset_3d["particles"].iloc[selected_idx].copy()
+    # Split image names once into stack and (1-based) index within the stack
+    image_name = subset["rlnImageName"].str.split("@", n=1, expand=True)
+    stack_idx = image_name[0].astype(np.int64).to_numpy() - 1
 
-        # merge offsets xy and psi angle from 2d classification
-        subset_3d["rlnAnglePsi"] = list(subset_2d["rlnAnglePsi"])
-        subset_3d["rlnOriginXAngst"] = list(subset_2d["rlnOriginXAngst"])
-        subset_3d["rlnOriginYAngst"] = list(subset_2d["rlnOriginXAngst"])
+    rows_per_stack = utils.group_indices(image_name[1])
+    no_rows = np.empty(0, dtype=np.int64)
 
-        # if group is given, take over
-        if "rlnClassNumber" in subset_2d:
-            subset_3d["rlnClassNumber"] = list(subset_2d["rlnClassNumber"])
+    def task_args(st_star):
+        rows = rows_per_stack.get(f"{Path(st_star).stem}_projected.mrcs", no_rows)
+        return st_star, subset.iloc[rows], stack_idx[rows]
 
-        starfile.write(
-            {"optics": fullset_3d["optics"], "particles": subset_3d},
-            Path(st_star).with_name(f"{Path(st_star).stem}_selected.star"),
-        )
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(_apply_subset_to_star, *task_args(st_star))
+                for st_star in subtomo_stars
+            ]
+            results = [future.result() for future in futures]
+    else:
+        results = [
+            _apply_subset_to_star(*task_args(st_star)) for st_star in subtomo_stars
+        ]
 
-        print(f"Wrote out {len(subset_3d.index)} particles from {st_star}. \n")
+    for st_star, (n, star_metrics) in zip(subtomo_stars, results):
+        perf.merge(star_metrics, parallel=jobs > 1)
+        print(f"Wrote out {n} particles from {st_star}. \n")
 
     # TODO: hand over to star_downgrade?
@@ -0,0 +1,190 @@
+"""Chain star operations in memory, with a single read and write per star."""
+from functools import lru_cache
+from pathlib import Path
+
+import click
+
+from subtomotools import metrics, particle_operations, star_io, star_operations, utils
+
+
+@lru_cache
+def _read_subset(subset_star: str):
+    """Particles of a 2D subset star, read once for all input stars."""
+    return particle_operations.subset_particles(star_io.read_star(subset_star))
+
+
+def step_select(star, input_star: Path, subset: str, stack=None):
+    """Apply 2D subset selection, matched via <stem>_projected.mrcs by default."""
+    if stack is None:
+        stack = f"{input_star.stem}_projected.mrcs"
+
+    return particle_operations.select(star, _read_subset(subset), stack)
+
+
+def step_dedup(
+    star,
+    input_star: Path,
+    radius: float = 1,
+    score=None,
+    jobs: int = 1,
+    max_angle=None,
+    symmetry: str = "C1",
+):
+    """Deduplicate in 3D, radius in px, optionally keeping the best score.
+
+    With max_angle, only particles of similar orientation are removed.
+    """
+    return star_operations.dedup(
+        star, radius, score, jobs, max_angle=max_angle, symmetry=symmetry
+    )
+
+
+def step_upgrade(star, input_star: Path, amp: float = 0.07):
+    """Upgrade Warp-style star to Relion 3.1."""
+    return star_operations.upgrade(star, amp, input_star.stem)
+
+
+def step_downgrade(star, input_star: Path, m: bool = False):
+    """Downgrade Relion 3.1 star for Warp, or for M with m."""
+    return star_operations.downgrade(star, m)
+
+
+# name: (function, {parameter: type})
+STEPS = {
+    "select": (step_select, {"subset": str, "stack": str}),
+    "dedup": (
+        step_dedup,
+        {
+            "radius": float,
+            "score": str,
+            "jobs": int,
+            "max_angle": float,
+            "symmetry": str,
+        },
+    ),
+    "upgrade": (step_upgrade, {"amp": float}),
+    "downgrade": (step_downgrade, {"m": bool}),
+}
+
+
+def parse_step(spec: str):
+    """Parse a step given as name[:key=value,...], bare keys are set to True.
+
+    Output:
+        name, function, params
+
+    """
+    name, _, args = spec.partition(":")
+
+    if name not in STEPS:
+        raise click.BadParameter(
+            f"Unknown step {name}, choose from {', '.join(STEPS)}.", param_hint="--step"
+        )
+
+    function, types = STEPS[name]
+    params = {}
+
+    for arg in filter(None, args.split(",")):
+        key, has_value, value = arg.partition("=")
+
+        if key not in types:
+            raise click.BadParameter(
+                f"Step {name} has no parameter {key}, only {', '.join(types)}.",
+                param_hint="--step",
+            )
+
+        if types[key] is bool:
+            params[key] = not has_value or value.lower() in ("1", "true", "yes")
+        else:
+            params[key] = types[key](value)
+
+    return name, function, params
+
+
+@click.command()
+@metrics.instrumented()
+@click.option(
+    "-s",
+    "--step",
+    "steps",
+    multiple=True,
+    required=True,
+    help="Operation as name[:key=value,...], can be given multiple times and is "
+    "run in the given order. Steps: select:subset=STAR[,stack=MRCS], "
+    "dedup:radius=PX[,score=COLUMN,jobs=N,max_angle=DEG,symmetry=CN], "
+    "upgrade:amp=AMP, downgrade[:m].",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Output star, only for a single input star.",
+)
+@click.option(
+    "--suffix",
+    default="_pipeline",
+    show_default=True,
+    help="Output is written as <stem><suffix>.star next to each input star.",
+)
+@click.option(
+    "--cache",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Keep a binary copy of the parsed input stars next to them, "
+    "to speed up repeated runs.",
+)
+@click.option(
+    "--star-list",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Text file listing further input stars, one per line.",
+)
+@click.argument("input_stars", type=click.Path(exists=True), nargs=-1)
+def star_pipeline(steps, output, suffix, cache, star_list, input_stars):
+    r"""Run a chain of star operations in memory.
+
+    Each input star is read once, all steps are applied in the given order and
+    the result is written once, instead of writing and re-reading intermediate
+    stars between commands. E.g. select particles from 2D classification,
+    deduplicate and prepare for M:
+
+    \b
+    star-pipeline -s select:subset=run_data.star -s dedup:radius=5 -s downgrade:m
+    tomo1.star tomo2.star
+
+    """
+    steps = [parse_step(spec) for spec in steps]
+    input_stars = utils.collect_paths(input_stars, star_list)
+
+    if not input_stars:
+        raise click.UsageError("No input star given.")
+
+    if output is not None and len(input_stars) > 1:
+        raise click.UsageError("--output can only be used with a single input star.")
+
+    perf = metrics.current()
+
+    for input_star in input_stars:
+        with perf.stage("read star"):
+            star = utils.read_particles(input_star, cache=cache)
+
+        perf.read(input_star)
+
+        for name, function, params in steps:
+            with perf.stage(name):
+                star = function(star, input_star, **params)
+
+        if output is None:
+            out_star = input_star.with_name(f"{input_star.stem}{suffix}.star")
+        else:
+            out_star = Path(output)
+
+        with perf.stage("write star"):
+            star_io.write_star(star, out_star)
+
+        perf.wrote(out_star)
+        perf.count("stars")
+
+        print(f"Wrote {out_star}.")
@@ -0,0 +1,222 @@
+"""Cache of projections across runs of project-particles.
+
+Consecutive rounds of picking or classification mostly project the same
+subtomograms again. Projections are stored in a folder, keyed by everything they
+depend on: subtomogram and CTF volume (path, modification time and size) and
+the projection parameters. A new run only projects the particles not found.
+
+Images of one shape are kept in a raw float32 file of fixed-size slots, which is
+memory-mapped, and an index of key -> slot. When the cache is full, the slots
+least recently used (by run) are reused. Only one run should use a cache folder
+at a time.
+"""
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from subtomotools import volume_io
+
+# Part of every key, increase if stored projections change for the same inputs
+CACHE_VERSION = 1
+
+# Parameters of _project_subtomos the projections depend on
+KEY_PARAMS = ("z_thickness", "projection", "out_shape", "bg_radius", "ramp")
+
+
+def _file_stamps(paths, jobs: int = 16):
+    """Return {path: (absolute path, mtime in ns, size)}, stat'ed in parallel."""
+
+    def stamp(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    paths = list(dict.fromkeys(paths))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(paths, executor.map(stamp, paths)))
+
+
+def projection_keys(image_names, ctf_names, params: dict):
+    """Return a 16-byte key for the projection of each particle.
+
+    Input:
+        image_names: subtomogram paths or N@stack names
+        ctf_names: CTF volume paths or N@stack names, or None without CTF
+        params: projection parameters, see KEY_PARAMS
+
+    """
+    settings = repr(
+        (
+            CACHE_VERSION,
+            ctf_names is not None,
+            *(params.get(name) for name in KEY_PARAMS),
+        )
+    )
+    names = list(image_names) + ([] if ctf_names is None else list(ctf_names))
+    stamps = _file_stamps(volume_io.parse_image_name(name)[1] for name in names)
+
+    def describe(name):
+        if name is None:
+            return ""
+
+        index, path = volume_io.parse_image_name(name)
+        return f"{index}@{stamps[path]}"
+
+    if ctf_names is None:
+        ctf_names = [None] * len(image_names)
+
+    return [
+        hashlib.blake2b(
+            "\0".join((settings, describe(image_name), describe(ctf_name))).encode(),
+            digest_size=16,
+        ).digest()
+        for image_name, ctf_name in zip(image_names, ctf_names)
+    ]
+
+
+class ProjectionCache:
+    """Projections of one image shape, stored in folder, with LRU eviction.
+
+    Input:
+        folder: cache folder, created if needed
+        shape: shape (YX) of the projections
+        max_bytes: largest size of the stored images
+
+    """
+
+    def __init__(self, folder, shape, max_bytes: float):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.shape = tuple(shape)
+        self.capacity = int(max_bytes // (np.prod(self.shape) * 4))
+
+        name = f"projections_{self.shape[0]}x{self.shape[1]}"
+        self.data_path = self.folder / f"{name}.f32"
+        self.index_path = self.folder / f"{name}.npz"
+
+        # Per slot: key (or None if free) and run in which it was last used
+        self.slot_keys = []
+        self.last_used = np.empty(0, dtype=np.int64)
+        self.run = 1
+
+        if self.index_path.exists() and self.data_path.exists():
+            with np.load(self.index_path) as index:
+                self.slot_keys = [
+                    bytes(key) if used else None
+                    for key, used in zip(index["keys"], index["used"])
+                ]
+                self.last_used = index["last_used"]
+                self.run = int(index["run"]) + 1
+
+        self.slots = {
+            key: slot for slot, key in enumerate(self.slot_keys) if key is not None
+        }
+        self._data = None
+
+    def __len__(self):
+        """Return number of stored projections."""
+        return len(self.slots)
+
+    def _map(self, n_slots: int):
+        """Memory-map the data file, grown to at least n_slots."""
+        size = n_slots * int(np.prod(self.shape)) * 4
+
+        if self._data is None or len(self._data) < n_slots:
+            with open(self.data_path, "ab") as f:
+                if f.tell() < size:
+                    f.truncate(size)
+
+            self._data = np.memmap(
+                self.data_path,
+                dtype=np.float32,
+                mode="r+",
+                shape=(n_slots, *self.shape),
+            )
+
+        return self._data
+
+    def lookup(self, keys):
+        """Return slot of each key, -1 if not cached, and mark them as used."""
+        slots = np.array([self.slots.get(key, -1) for key in keys], dtype=np.int64)
+        self.last_used[slots[slots >= 0]] = self.run
+
+        return slots
+
+    def read(self, slots):
+        """Return the images stored in slots."""
+        return np.array(self._map(len(self.slot_keys))[slots])
+
+    def store(self, keys, images):
+        """Store images under keys, reusing the least recently used slots.
+
+        Slots used in this run are kept. If there are not enough other slots, only
+        the first images are stored.
+
+        Output:
+            n: number of images stored
+
+        """
+        new = {}
+
+        for position, key in enumerate(keys):
+            if key not in self.slots and key not in new:
+                new[key] = position
+
+        # Grow up to the capacity, then reuse slots not used in this run
+        n_grow = min(len(new), max(self.capacity - len(self.slot_keys), 0))
+        oldest = np.argsort(self.last_used, kind="stable")
+        reused = oldest[self.last_used[oldest] < self.run][: len(new) - n_grow]
+        slots = reused.tolist() + list(
+            range(len(self.slot_keys), len(self.slot_keys) + n_grow)
+        )
+
+        if len(reused):
+            # Drop evicted keys from the saved index before overwriting their data
+            for slot in reused.tolist():
+                if self.slot_keys[slot] is not None:
+                    del self.slots[self.slot_keys[slot]]
+                    self.slot_keys[slot] = None
+
+            self.save()
+
+        self.slot_keys += [None] * n_grow
+        self.last_used = np.concatenate(
+            [self.last_used, np.zeros(n_grow, dtype=np.int64)]
+        )
+        stored = list(new.items())[: len(slots)]
+
+        if stored:
+            self._map(len(self.slot_keys))[slots] = images[
+                [position for _, position in stored]
+            ]
+
+            for (key, _), slot in zip(stored, slots):
+                self.slots[key] = slot
+                self.slot_keys[slot] = key
+
+            self.last_used[slots] = self.run
+
+        return len(stored)
+
+    def save(self):
+        """Write the index, replacing the previous one at once."""
+        if self._data is not None:
+            self._data.flush()
+
+        keys = np.zeros((len(self.slot_keys), 16), dtype=np.uint8)
+        used = np.array([key is not None for key in self.slot_keys], dtype=bool)
+
+        if used.any():
+            keys[used] = np.frombuffer(
+                b"".join(key for key in self.slot_keys if key is not None),
+                dtype=np.uint8,
+            ).reshape(-1, 16)
+
+        temp_path = self.index_path.with_suffix(".tmp.npz")
+        np.savez(
+            temp_path, keys=keys, used=used, last_used=self.last_used, run=self.run
+        )
+        os.replace(temp_path, self.index_path)
@@ -0,0 +1,274 @@
+"""Split work of a command into shards, and merge their partial outputs.
+
+A shard i/N processes a deterministic part of the input, so that the shards can
+run as separate jobs (e.g. on several nodes). Partial outputs are named
+<name>.shard<i>of<N>.<suffix> and combined with merge-shards.
+"""
+from __future__ import annotations
+
+import re
+from pathlib import Path
+
+import click
+
+from subtomotools import metrics
+from subtomotools.lazy import lazy_import
+
+mrcfile = lazy_import("mrcfile")
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+star_io = lazy_import("subtomotools.star_io")
+
+SHARD_PATTERN = re.compile(r"^(?P<base>.+)\.shard(?P<i>\d+)of(?P<n>\d+)$")
+
+
+def parse_shard(ctx, param, value):
+    """Click callback to parse i/N (1 <= i <= N) into a tuple, or None."""
+    if value is None:
+        return None
+
+    try:
+        i, n = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise click.BadParameter(
+            f"{value} is not of the form i/N, e.g. 2/8."
+        ) from None
+
+    if not 1 <= i <= n:
+        raise click.BadParameter(f"Shard {i} has to be between 1 and {n}.")
+
+    return i, n
+
+
+def shard_name(name: str, shard=None):
+    """Return name of the partial output of shard (i, N), or name without shard."""
+    if shard is None:
+        return name
+
+    return f"{name}.shard{shard[0]}of{shard[1]}"
+
+
+def shard_rows(n_rows: int, shard):
+    """Return the range of rows of shard (i, N), contiguous and of equal size."""
+    i, n = shard
+
+    return range((i - 1) * n_rows // n, i * n_rows // n)
+
+
+def shard_groups(sizes, shard):
+    """Return positions of the groups (e.g. tomograms) in shard (i, N).
+
+    Groups are kept in order and split into contiguous blocks, balanced by
+    their sizes: each group goes to the shard containing its midpoint.
+    """
+    i, n = shard
+    sizes = np.asarray(sizes, dtype=np.float64)
+    total = sizes.sum()
+
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+
+    midpoints = np.cumsum(sizes) - sizes / 2
+    shards = np.minimum((midpoints * n / total).astype(np.int64), n - 1)
+
+    return np.flatnonzero(shards == i - 1)
+
+
+def _shard_stack(particles: pd.DataFrame, star_path: Path, i: int, n: int):
+    """Return the partial stack referenced by particles of shard i, or None."""
+    if "rlnImageName" not in particles or particles.empty:
+        return None
+
+    stacks = particles["rlnImageName"].str.split("@", n=1).str[-1].unique()
+
+    if len(stacks) != 1:
+        return None
+
+    stack = Path(stacks[0])
+    match = SHARD_PATTERN.match(stack.with_suffix("").name)
+
+    if match is None or (int(match["i"]), int(match["n"])) != (i, n):
+        return None
+
+    # Image names are usually relative to where the command was run
+    if not stack.exists() and (star_path.parent / stack).exists():
+        stack = star_path.parent / stack
+
+    return stack
+
+
+def merge_shard_stars(star_paths, out_star: Path):
+    """Concatenate the partial stars of shards 1 to N, in order.
+
+    If each partial star refers to its own partial stack (as written by
+    project-particles), the stacks are concatenated as well and rlnImageName
+    rewritten to the merged stack. Particle data is copied via memory maps.
+
+    Output:
+        n: number of particles in the merged star
+        stacks: partial stacks which were merged
+
+    """
+    perf = metrics.current()
+    stars = []
+    stacks = []
+
+    for i, star_path in enumerate(star_paths, start=1):
+        with perf.stage("read stars"):
+            star = star_io.read_star(star_path)
+
+        perf.read(star_path)
+        particles = star[star_io.particles_key(star)]
+        stars.append(star)
+        stacks.append(_shard_stack(particles, star_path, i, len(star_paths)))
+
+    key = star_io.particles_key(stars[0])
+    particles = [star[star_io.particles_key(star)] for star in stars]
+
+    # Only merge stacks if every non-empty shard has one
+    merge_stacks = any(stack is not None for stack in stacks) and all(
+        stack is not None or part.empty for stack, part in zip(stacks, particles)
+    )
+
+    if merge_stacks:
+        match = SHARD_PATTERN.match(
+            next(stack for stack in stacks if stack is not None).with_suffix("").name
+        )
+        out_mrcs = out_star.with_name(f"{match['base']}.mrcs")
+
+        # Keep the path of image names as it was written, e.g. relative
+        image_prefix = particles[0]["rlnImageName"].str.split("@", n=1).str[-1][0]
+        image_prefix = str(Path(image_prefix).with_name(out_mrcs.name))
+
+        with perf.stage("merge stacks"):
+            particles = _merge_stacks(stacks, particles, out_mrcs, image_prefix)
+
+        perf.wrote(out_mrcs)
+
+    merged = pd.concat(particles, ignore_index=True)
+
+    with perf.stage("write star"):
+        star_io.write_star({**stars[0], key: merged}, out_star)
+
+    perf.wrote(out_star)
+    perf.count("particles", len(merged.index))
+
+    return len(merged.index), [stack for stack in stacks if merge_stacks and stack]
+
+
+def _merge_stacks(stacks, particles, out_mrcs: Path, image_prefix: str):
+    """Copy partial stacks into out_mrcs, return particles with new image names."""
+    shapes = []
+    voxel_size = None
+
+    for stack in stacks:
+        if stack is None:
+            shapes.append(None)
+            continue
+
+        with mrcfile.mmap(stack, mode="r", permissive=True) as mrc:
+            shapes.append(mrc.data.shape)
+            voxel_size = mrc.voxel_size.copy()
+
+    image_shape = next(shape for shape in shapes if shape is not None)[1:]
+
+    if any(shape is not None and shape[1:] != image_shape for shape in shapes):
+        raise click.ClickException("Partial stacks have different image sizes.")
+
+    n_images = sum(shape[0] for shape in shapes if shape is not None)
+    renamed = []
+    offset = 0
+
+    with mrcfile.new_mmap(
+        out_mrcs, shape=(n_images, *image_shape), mrc_mode=2, overwrite=True
+    ) as merged:
+        merged.set_image_stack()
+        merged.voxel_size = voxel_size
+
+        for stack, shape, part in zip(stacks, shapes, particles):
+            part = part.copy()
+
+            if stack is not None:
+                with mrcfile.mmap(stack, mode="r", permissive=True) as mrc:
+                    merged.data[offset : offset + shape[0]] = mrc.data
+
+                indices = part["rlnImageName"].str.split("@", n=1).str[0].astype(int)
+                part["rlnImageName"] = [
+                    f"{index}@{image_prefix}" for index in indices + offset
+                ]
+                offset += shape[0]
+
+            renamed.append(part)
+
+        merged.update_header_stats()
+
+    return renamed
+
+
+def group_shards(paths):
+    """Group partial stars by their output name, checking all shards are there.
+
+    Output:
+        groups: dict of output star -> list of partial stars, ordered by shard
+
+    """
+    groups = {}
+
+    for path in map(Path, paths):
+        match = SHARD_PATTERN.match(path.with_suffix("").name)
+
+        if match is None:
+            raise click.BadParameter(f"{path} is not a partial output (.shardIofN).")
+
+        out_star = path.with_name(f"{match['base']}{path.suffix}")
+        n = int(match["n"])
+        group = groups.setdefault(out_star, {"n": n, "shards": {}})
+
+        if group["n"] != n:
+            raise click.ClickException(f"Shards of {out_star} differ in their N.")
+
+        group["shards"][int(match["i"])] = path
+
+    for out_star, group in groups.items():
+        missing = sorted(set(range(1, group["n"] + 1)) - set(group["shards"]))
+
+        if missing:
+            raise click.ClickException(
+                f"Missing shards {', '.join(map(str, missing))} of {group['n']} "
+                f"for {out_star}."
+            )
+
+    return {
+        out_star: [group["shards"][i] for i in range(1, group["n"] + 1)]
+        for out_star, group in groups.items()
+    }
+
+
+@click.command()
+@metrics.instrumented()
+@click.option(
+    "--clean",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Remove partial stars and stacks after merging.",
+)
+@click.argument("partial_stars", type=click.Path(exists=True), nargs=-1)
+def merge_shards(clean, partial_stars):
+    """Merge partial outputs of commands run with --shard.
+
+    Give the partial stars of all shards, e.g. tomo_projected.shard*of8.star.
+    They are concatenated in shard order and written without the shard part of
+    their name. Partial stacks of project-particles are merged alongside, with
+    rlnImageName pointing to the merged stack.
+    """
+    if not partial_stars:
+        raise click.UsageError("No partial star given.")
+
+    for out_star, star_paths in group_shards(partial_stars).items():
+        n, stacks = merge_shard_stars(star_paths, out_star)
+        print(f"Merged {len(star_paths)} shards with {n} particles into {out_star}.")
+
+        if clean:
+            for path in [*star_paths, *stacks]:
+                path.unlink()
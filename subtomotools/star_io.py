@@ -0,0 +1,577 @@
+"""Streaming reader and writer for (large) STAR files.
+
+starfile parses and serializes whole files at once. The functions here read the
+particles block in row chunks, so column transforms run in constant memory, and
+can keep a binary sidecar cache (npz, read without pickle) of fully parsed files.
+"""
+import hashlib
+import io
+import json
+import os
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Columns stored as float32 / categorical when reading typed tables
+FLOAT32_PREFIXES = ("rlnCoordinate", "rlnCenteredCoordinate", "rlnOrigin", "rlnAngle")
+CATEGORICAL_COLUMNS = ("rlnMicrographName", "rlnTomoName", "rlnCtfImage")
+
+DEFAULT_CHUNKSIZE = 200_000
+
+
+def apply_types(df: pd.DataFrame):
+    """Downcast coordinates, shifts and angles to float32, names to categoricals.
+
+    A column is only downcast if float32 holds all its values exactly (e.g.
+    integer pixel coordinates), so written stars keep every digit they were
+    read with.
+    """
+    for column in df.columns:
+        if column.startswith(FLOAT32_PREFIXES) and pd.api.types.is_numeric_dtype(
+            df[column]
+        ):
+            values = df[column].to_numpy(dtype=np.float64)
+            downcast = values.astype(np.float32)
+
+            if np.array_equal(downcast, values, equal_nan=True):
+                df[column] = downcast
+        elif column in CATEGORICAL_COLUMNS:
+            df[column] = df[column].astype("category")
+
+    return df
+
+
+def _parse_rows(lines, columns):
+    """Parse data lines of a loop block, same conventions as starfile."""
+    df = pd.read_csv(
+        io.StringIO("".join(lines).replace("'", '"')),
+        sep=r"\s+",
+        header=None,
+        comment="#",
+        keep_default_na=False,
+        na_values=["nan", "NaN", "<NA>"],
+        engine="c",
+    )
+    df.columns = columns
+
+    return df
+
+
+def _parse_value(value: str):
+    """Return value as int or float if possible, otherwise as string."""
+    for conversion in (int, float):
+        try:
+            return conversion(value)
+        except ValueError:
+            pass
+
+    return value.strip("\"'")
+
+
+class StarReader:
+    """Sequential reader for STAR files, one data block at a time.
+
+    Loop blocks can be consumed in row chunks with read_chunks, which keeps
+    memory bounded by the chunk size.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = open(self.path)  # noqa: SIM115
+        self._pending = None
+        self._columns = None
+
+    def __enter__(self):
+        """Use as context manager."""
+        return self
+
+    def __exit__(self, *args):
+        """Close file when leaving context."""
+        self.close()
+
+    def close(self):
+        """Close the underlying file."""
+        self._file.close()
+
+    def _readline(self):
+        if self._pending is not None:
+            line, self._pending = self._pending, None
+            return line
+
+        return self._file.readline()
+
+    def next_block(self):
+        """Advance to the next data block.
+
+        Output:
+            name: block name (without data_), or None at end of file
+            header: list of column names for loop blocks, dict for simple blocks
+
+        """
+        # Skip rows of a loop block which was not (fully) consumed
+        if self._columns is not None:
+            for _ in self.read_chunks():
+                pass
+
+        line = self._readline()
+
+        while line and not line.startswith("data_"):
+            line = self._readline()
+
+        if not line:
+            return None, None
+
+        name = line.strip()[5:]
+        values = {}
+
+        line = self._readline()
+
+        while line and not line.startswith("data_"):
+            stripped = line.strip()
+
+            if stripped.startswith("loop_"):
+                return name, self._read_loop_header()
+
+            if stripped.startswith("_"):
+                key, value = stripped.split(maxsplit=1)
+                values[key[1:]] = _parse_value(value)
+
+            line = self._readline()
+
+        self._pending = line or None
+
+        return name, values
+
+    def _read_loop_header(self):
+        columns = []
+        line = self._readline()
+
+        while line and (not line.strip() or line.strip().startswith("_")):
+            if line.strip():
+                columns.append(line.split()[0][1:])
+            line = self._readline()
+
+        self._pending = line or None
+        self._columns = columns
+
+        return columns
+
+    def read_chunks(self, chunksize: int = DEFAULT_CHUNKSIZE, typed: bool = False):
+        """Yield rows of the current loop block as DataFrames of <= chunksize rows."""
+        columns, lines = self._columns, []
+
+        line = self._readline()
+
+        while line and not line.startswith("data_"):
+            if line.strip() and not line.lstrip().startswith("#"):
+                lines.append(line)
+
+                if len(lines) >= chunksize:
+                    chunk = _parse_rows(lines, columns)
+                    lines = []
+                    yield apply_types(chunk) if typed else chunk
+
+            line = self._readline()
+
+        self._pending = line or None
+        self._columns = None
+
+        if lines:
+            chunk = _parse_rows(lines, columns)
+            yield apply_types(chunk) if typed else chunk
+
+    def read_block(self, header):
+        """Return the current block as DataFrame (loop) or dict (simple)."""
+        if isinstance(header, dict):
+            return header
+
+        chunks = list(self.read_chunks())
+
+        if not chunks:
+            return pd.DataFrame(columns=header)
+
+        return pd.concat(chunks, ignore_index=True)
+
+
+def _is_particles(name: str, block: str):
+    # Warp-style star files have a single, unnamed block
+    return name == block or (block == "particles" and name == "")
+
+
+def _find_loop(reader: StarReader, block: str):
+    """Read blocks up to the loop block, return them, its name and its columns."""
+    blocks = {}
+
+    name, header = reader.next_block()
+
+    while name is not None and not (
+        _is_particles(name, block) and isinstance(header, list)
+    ):
+        blocks[name] = reader.read_block(header)
+        name, header = reader.next_block()
+
+    if name is None:
+        raise ValueError(f"No loop block {block} found in {reader.path}.")
+
+    return blocks, name, header
+
+
+def read_star_header(path, block: str = "particles"):
+    """Read the blocks preceding a loop block and its name and columns, not its rows.
+
+    Output:
+        blocks: dict with all blocks preceding the loop block
+        name: name of the loop block, "" for the unnamed block of Warp-style stars
+        columns: column names of the loop block
+
+    """
+    with StarReader(path) as reader:
+        return _find_loop(reader, block)
+
+
+def read_star_chunks(
+    path, block: str = "particles", chunksize: int = DEFAULT_CHUNKSIZE, typed=False
+):
+    """Read the blocks preceding a loop block, and stream the loop block itself.
+
+    Blocks after the streamed block are not read.
+
+    Input:
+        path: path to star file
+        block: name of the loop block to stream, unnamed blocks match "particles"
+        chunksize: number of rows per chunk
+        typed: apply float32 / categorical types, see apply_types
+
+    Output:
+        blocks: dict with all blocks preceding the streamed block
+        columns: column names of the streamed block
+        chunks: iterator over DataFrames with up to chunksize rows
+
+    """
+    reader = StarReader(path)
+
+    try:
+        blocks, _, header = _find_loop(reader, block)
+    except ValueError:
+        reader.close()
+        raise
+
+    def chunks():
+        with reader:
+            yield from reader.read_chunks(chunksize, typed)
+
+    return blocks, header, chunks()
+
+
+CACHE_VERSION = 1
+
+
+def _cache_path(path: Path):
+    return path.with_name(f".{path.name}.cache.npz")
+
+
+def _cache_key(path: Path, typed: bool):
+    """Return a digest of the contents of the star file and the read options."""
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    return f"{CACHE_VERSION}:{int(typed)}:{digest.hexdigest()}"
+
+
+def _plain_array(values):
+    """Return values as np.array which can be saved without pickle."""
+    values = np.asarray(values)
+
+    return values.astype(str) if values.dtype == object else values
+
+
+def _save_cache(cache_path: Path, key: str, blocks: dict):
+    """Save blocks as npz: one array per column, strings as categories and codes.
+
+    Simple blocks and the layout of the tables are kept as JSON, so the cache
+    is read without pickle.
+    """
+    layout, arrays = [], {}
+
+    for i, (name, block) in enumerate(blocks.items()):
+        if not isinstance(block, pd.DataFrame):
+            layout.append({"name": name, "values": block})
+            continue
+
+        columns = []
+
+        for j, column in enumerate(block.columns):
+            values = block[column]
+            prefix = f"{i}_{j}"
+
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                categories = values.cat.categories
+                arrays[f"{prefix}_codes"] = values.cat.codes.to_numpy()
+                arrays[f"{prefix}_categories"] = _plain_array(categories)
+                columns.append([column, "category", str(categories.dtype)])
+            elif pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(
+                values
+            ):
+                arrays[prefix] = values.to_numpy()
+                columns.append([column, "numeric", str(values.dtype)])
+            else:
+                codes, uniques = pd.factorize(values)
+                arrays[f"{prefix}_codes"] = codes
+                arrays[f"{prefix}_categories"] = _plain_array(uniques)
+                columns.append([column, "string", str(values.dtype)])
+
+        layout.append({"name": name, "columns": columns, "rows": len(block.index)})
+
+    meta = json.dumps({"key": key, "blocks": layout})
+    temp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+
+    with open(temp_path, "wb") as f:
+        np.savez(f, meta=np.array(meta), **arrays)
+
+    os.replace(temp_path, cache_path)
+
+
+def _load_cache(cache_path: Path, key: str):
+    """Return the blocks saved by _save_cache, or None if key does not match."""
+    with np.load(cache_path, allow_pickle=False) as arrays:
+        meta = json.loads(str(arrays["meta"]))
+
+        if meta["key"] != key:
+            return None
+
+        blocks = {}
+
+        for i, layout in enumerate(meta["blocks"]):
+            if "values" in layout:
+                blocks[layout["name"]] = layout["values"]
+                continue
+
+            data = {}
+
+            for j, (column, kind, dtype) in enumerate(layout["columns"]):
+                prefix = f"{i}_{j}"
+
+                if kind == "numeric":
+                    data[column] = arrays[prefix]
+                    continue
+
+                categories = pd.Index(arrays[f"{prefix}_categories"]).astype(dtype)
+                values = pd.Categorical.from_codes(
+                    arrays[f"{prefix}_codes"], categories
+                )
+                data[column] = values if kind == "category" else values.astype(dtype)
+
+            blocks[layout["name"]] = pd.DataFrame(
+                data, index=pd.RangeIndex(layout["rows"])
+            )
+
+    return blocks
+
+
+def read_star(path, typed: bool = False, cache: bool = False):
+    """Read all blocks of a star file into a dict, like starfile.read(always_dict=True).
+
+    Input:
+        path: path to star file
+        typed: apply float32 / categorical types, see apply_types
+        cache: keep a binary sidecar (.<name>.cache.npz) next to the star file,
+            reused as long as the contents of the star match. It is read
+            without pickle, so a cache written by someone else can not run code
+
+    Output:
+        blocks: dict of DataFrames (loop blocks) and dicts (simple blocks)
+
+    """
+    path = Path(path)
+
+    if cache:
+        key = _cache_key(path, typed)
+
+        try:
+            blocks = _load_cache(_cache_path(path), key)
+
+            if blocks is not None:
+                return blocks
+
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            pass
+
+    blocks = {}
+
+    with StarReader(path) as reader:
+        name, header = reader.next_block()
+
+        while name is not None:
+            blocks[name] = reader.read_block(header)
+
+            if typed and isinstance(blocks[name], pd.DataFrame):
+                blocks[name] = apply_types(blocks[name])
+
+            name, header = reader.next_block()
+
+    if cache:
+        try:
+            _save_cache(_cache_path(path), key, blocks)
+        except OSError:
+            print(f"Could not write cache for {path}, continuing without.")
+
+    return blocks
+
+
+def particles_key(blocks: dict):
+    """Return the key of the particles block in a dict from read_star."""
+    for name, block in blocks.items():
+        if _is_particles(name, "particles") and isinstance(block, pd.DataFrame):
+            return name
+
+    raise ValueError("No particles block found.")
+
+
+def write_star(blocks: dict, path):
+    """Write a dict of blocks, formatted like starfile.write."""
+    with StarWriter(path) as writer:
+        for name, block in blocks.items():
+            writer.write_block(name, block)
+
+
+def _quote_strings(df: pd.DataFrame):
+    """Quote string values which are empty or contain spaces."""
+    quoted = None
+
+    for column in df.columns:
+        if pd.api.types.is_numeric_dtype(df[column]):
+            continue
+
+        values = df[column].astype(str)
+        needs_quotes = values.str.contains(" ", regex=False) | (values == "")
+
+        if needs_quotes.any():
+            quoted = df.copy() if quoted is None else quoted
+            quoted[column] = values.where(~needs_quotes, '"' + values + '"')
+
+    return df if quoted is None else quoted
+
+
+def _format_rows(df: pd.DataFrame, float_format: str):
+    """Return rows as tab-separated lines, formatted like starfile.write.
+
+    Formatting column-wise and joining is several times faster than to_csv with
+    a float_format, which formats every value through pandas.
+    """
+    columns = []
+
+    for column in df.columns:
+        values = df[column]
+
+        if pd.api.types.is_float_dtype(values):
+            strings = [float_format % value for value in values.tolist()]
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            # Format each category once, missing values (code -1) are replaced below
+            categories = values.cat.categories.astype(str).tolist()
+            strings = [categories[code] for code in values.cat.codes.tolist()]
+        else:
+            strings = values.astype(str).tolist()
+
+        missing = values.isna().to_numpy()
+
+        if missing.any():
+            strings = [
+                "<NA>" if is_missing else string
+                for string, is_missing in zip(strings, missing)
+            ]
+
+        columns.append(strings)
+
+    return "".join(f"{line}\n" for line in map("\t".join, zip(*columns)))
+
+
+class StarWriter:
+    """Write STAR files block by block, with loop blocks appended in chunks.
+
+    Output is formatted like starfile.write.
+    """
+
+    def __init__(self, path, float_format: str = "%.6f"):
+        self.path = Path(path)
+        self.float_format = float_format
+        self._file = open(self.path, "w")  # noqa: SIM115
+
+        now = datetime.now()
+        self._file.write(
+            f"# Created by subtomotools at {now:%H:%M:%S} on {now:%d/%m/%Y}\n\n\n"
+        )
+
+    def __enter__(self):
+        """Use as context manager."""
+        return self
+
+    def __exit__(self, *args):
+        """Close file when leaving context."""
+        self.close()
+
+    def close(self):
+        """Close the underlying file."""
+        self._file.close()
+
+    def write_block(self, name: str, data):
+        """Write a full block, DataFrame as loop and dict as simple block."""
+        if isinstance(data, dict):
+            self._file.write(f"data_{name}\n\n")
+
+            for key, value in data.items():
+                if isinstance(value, str) and " " in value:
+                    value = f'"{value}"'
+
+                self._file.write(f"_{key}\t\t\t{value}\n")
+
+            self._file.write("\n\n")
+
+        else:
+            # Format in row chunks, so the text of a large table is never all in memory
+            chunks = (
+                data.iloc[start : start + DEFAULT_CHUNKSIZE]
+                for start in range(0, len(data.index), DEFAULT_CHUNKSIZE)
+            )
+            self.write_loop(name, chunks, columns=data.columns)
+
+    def write_loop(self, name: str, chunks, columns=None):
+        """Write a loop block from an iterable of DataFrames with the same columns.
+
+        Input:
+            name: block name (without data_)
+            chunks: iterable of DataFrames, consumed one by one
+            columns: column names, only needed if chunks may be empty
+
+        Output:
+            n_rows: number of rows written
+
+        """
+        n_rows = 0
+        header_written = False
+
+        for chunk in chunks:
+            if not header_written:
+                self._write_loop_header(name, chunk.columns)
+                header_written = True
+
+            self._file.write(_format_rows(_quote_strings(chunk), self.float_format))
+            n_rows += len(chunk.index)
+
+        if not header_written:
+            self._write_loop_header(name, columns if columns is not None else [])
+
+        self._file.write("\n\n")
+
+        return n_rows
+
+    def _write_loop_header(self, name, columns):
+        self._file.write(f"data_{name}\n\nloop_\n")
+
+        for idx, column in enumerate(columns, 1):
+            self._file.write(f"_{column} #{idx}\n")
@@ -1,51 +1,30 @@
-import collections
+from __future__ import annotations
+
+import concurrent.futures
+import itertools
 from pathlib import Path
 
 import click
-import mrcfile
-import pandas as pd
-import starfile
 
-from subtomotools import utils
+from subtomotools import metrics, shards
+from subtomotools.lazy import lazy_import
 
+# Loaded on first use, so that --help and argument errors return quickly
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+star_io = lazy_import("subtomotools.star_io")
+utils = lazy_import("subtomotools.utils")
 
-@click.command()
-@click.option(
-    "--amp",
-    default=0.07,
-    show_default=True,
-    help="Amplitude contrast given during CTF estimation.",
-)
-@click.argument("star", nargs=1)
-def upgrade_star(amp, star):
-    """Take subtomogram starfile from Warp and make it compatible with Relion 3.1.4."""
-    star = Path(star)
 
-    particles = starfile.read(star)
+def upgrade_particles(particles: pd.DataFrame, angpix: float):
+    """Convert Warp-style particle columns to Relion 3.1 conventions.
 
-    # Check values for optics header
-    angpix = None
-
-    if "rlnPixelSize" in particles:
-        angpix = particles["rlnPixelSize"][0]
-        del particles["rlnPixelSize"]
-
-    if "rlnVoltage" in particles:
-        voltage = particles["rlnVoltage"][0]
-        del particles["rlnVoltage"]
-    else:
-        voltage = 300
-
-    if "rlnSphericalAberration" in particles:
-        cs = particles["rlnSphericalAberration"][0]
-        del particles["rlnSphericalAberration"]
-    else:
-        cs = 2.7
-
-    with mrcfile.open(particles.iloc[0]["rlnImageName"]) as mrc:
-        dim = mrc.data.shape
-        if angpix is None:
-            angpix = mrc.voxel_size.x
+    Removes per-particle optics columns, assigns optics group 1 and converts
+    shifts from pixels to Angstrom. Modifies particles in place and returns it.
+    """
+    for column in ("rlnPixelSize", "rlnVoltage", "rlnSphericalAberration"):
+        if column in particles:
+            del particles[column]
 
     del particles["rlnMagnification"]
     del particles["rlnDetectorPixelSize"]
@@ -64,11 +43,124 @@ def upgrade_star(amp, star):
         particles["rlnOriginZAngst"] = particles["rlnOriginZ"].multiply(angpix)
         del particles["rlnOriginZ"]
 
+    return particles
+
+
+def downgrade_particles(particles: pd.DataFrame, angpix: float, m: bool = False):
+    """Convert Relion 3.1 particle columns to Warp conventions.
+
+    Removes optics group columns and converts shifts from Angstrom to pixels.
+    With m, returns only the columns needed by Warp/M.
+    """
+    # Remove entries related to optics groups
+    del particles["rlnOpticsGroup"]
+    del particles["rlnGroupNumber"]
+
+    particles["rlnMagnification"] = 10000
+    particles["rlnDetectorPixelSize"] = angpix
+
+    # If rlnOrigin is given, convert to pixels
+    if "rlnOriginXAngst" in particles:
+        particles["rlnOriginX"] = particles["rlnOriginXAngst"].divide(angpix)
+        particles["rlnOriginY"] = particles["rlnOriginYAngst"].divide(angpix)
+        del particles["rlnOriginXAngst"]
+        del particles["rlnOriginYAngst"]
+
+    # Treat Z separately in case of 2D data
+    if "rlnOriginZAngst" in particles:
+        particles["rlnOriginZ"] = particles["rlnOriginZAngst"].divide(angpix)
+        del particles["rlnOriginZAngst"]
+
+    if not m:
+        return particles
+
+    particles_m = pd.DataFrame()
+    particles_m["rlnCoordinateX"] = particles["rlnCoordinateX"]
+    particles_m["rlnCoordinateY"] = particles["rlnCoordinateY"]
+    particles_m["rlnCoordinateZ"] = particles["rlnCoordinateZ"]
+
+    particles_m["rlnMicrographName"] = particles["rlnMicrographName"].str.replace(
+        ".mrc", ".tomostar", regex=False
+    )
+
+    particles_m["rlnAngleRot"] = particles["rlnAngleRot"]
+    particles_m["rlnAngleTilt"] = particles["rlnAngleTilt"]
+    particles_m["rlnAnglePsi"] = particles["rlnAnglePsi"]
+
+    particles_m["rlnOriginX"] = particles["rlnOriginX"]
+    particles_m["rlnOriginY"] = particles["rlnOriginY"]
+    particles_m["rlnOriginZ"] = particles["rlnOriginZ"]
+
+    particles_m["rlnImageName"] = particles["rlnImageName"]
+    particles_m["rlnCtfImage"] = particles["rlnCtfImage"]
+
+    return particles_m
+
+
+@click.command()
+@metrics.instrumented()
+@click.option(
+    "--amp",
+    default=0.07,
+    show_default=True,
+    help="Amplitude contrast given during CTF estimation.",
+)
+@click.option(
+    "--check",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Check that all subtomograms exist and have the same box size.",
+)
+@click.option(
+    "--star-list",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Text file listing further input stars, one per line.",
+)
+@click.argument("stars", nargs=-1)
+def upgrade_star(amp, check, star_list, stars):
+    """Take subtomogram starfile from Warp and make it compatible with Relion 3.1.4.
+
+    Several stars can be given (or listed with --star-list); they are processed
+    one after the other in the same process.
+    """
+    stars = utils.collect_paths(stars, star_list)
+
+    if not stars:
+        raise click.UsageError("No input star given.")
+
+    for star in stars:
+        upgrade_star_file(star, amp, check)
+
+
+def upgrade_optics(particles: pd.DataFrame, amp: float = 0.07, name="opticsGroup1"):
+    """Return Relion 3.1 optics table and pixel size for Warp-style particles.
+
+    Microscope values are taken from the first particle if present, box size
+    (and pixel size, if not in the star) from the header of its subtomogram.
+    """
+    first = particles.iloc[0]
+
+    # Check values for optics header
+    angpix = first["rlnPixelSize"] if "rlnPixelSize" in particles else None
+    voltage = first["rlnVoltage"] if "rlnVoltage" in particles else 300
+
+    if "rlnSphericalAberration" in particles:
+        cs = first["rlnSphericalAberration"]
+    else:
+        cs = 2.7
+
+    dim, first_angpix = utils.probe_mrc(first["rlnImageName"])
+
+    if angpix is None:
+        angpix = first_angpix
+
     # Make _optics group for compatibility > 3.0
     star_optics = pd.DataFrame.from_dict(
         [
             {
-                "rlnOpticsGroupName": star.stem,
+                "rlnOpticsGroupName": name,
                 "rlnOpticsGroup": "1",
                 "rlnMicrographPixelSize": angpix,
                 "rlnImageSize": dim[2],
@@ -80,13 +172,70 @@ def upgrade_star(amp, star):
         ]
     )
 
-    starfile.write(
-        {"optics": star_optics, "particles": particles},
-        f"{star.with_name(star.stem)}_upgraded.star",
-    )
+    return star_optics, angpix
+
+
+def upgrade(star: dict, amp: float = 0.07, name: str = "opticsGroup1"):
+    """Upgrade a Warp-style star (dict of blocks) to Relion 3.1, see upgrade-star.
+
+    Input star is not modified.
+    """
+    particles = star[star_io.particles_key(star)]
+    star_optics, angpix = upgrade_optics(particles, amp, name)
+
+    # Shallow copy, columns are only replaced and deleted
+    return {
+        "optics": star_optics,
+        "particles": upgrade_particles(particles.copy(deep=False), angpix),
+    }
+
+
+def upgrade_star_file(star, amp: float = 0.07, check: bool = False):
+    """Upgrade one Warp-style star, written as <stem>_upgraded.star next to it."""
+    star = Path(star)
+    perf = metrics.current()
+
+    _, _, chunks = star_io.read_star_chunks(star)
+    chunks = perf.timed(chunks, "read star")
+    first = next(chunks, None)
+
+    if first is None:
+        raise click.ClickException(f"No particles found in {star}.")
+
+    if check:
+        with perf.stage("check files"):
+            _, _, name_chunks = star_io.read_star_chunks(star)
+            problems = utils.validate_mrcs(
+                name for chunk in name_chunks for name in chunk["rlnImageName"]
+            )
+
+        for path, message in problems:
+            print(f"{path}: {message}")
+
+        if problems:
+            raise click.ClickException(f"Found {len(problems)} problematic files.")
+
+    star_optics, angpix = upgrade_optics(first, amp, star.stem)
+    out_star = f"{star.with_name(star.stem)}_upgraded.star"
+
+    # Particles are transformed and written chunk by chunk
+    with perf.stage("write star"), star_io.StarWriter(out_star) as writer:
+        writer.write_block("optics", star_optics)
+        n_particles = writer.write_loop(
+            "particles",
+            (
+                upgrade_particles(chunk, angpix)
+                for chunk in itertools.chain([first], chunks)
+            ),
+        )
+
+    perf.count("particles", n_particles)
+    perf.read(star)
+    perf.wrote(out_star)
 
 
 @click.command()
+@metrics.instrumented()
 @click.option(
     "--m",
     is_flag=True,
@@ -94,68 +243,71 @@ def upgrade_star(amp, star):
     show_default=True,
     help="Make .star minimal for use with Warp/M.",
 )
-@click.argument("star", nargs=1)
-def downgrade_star(m, star):
-    """Take subtomogram starfile from Relion 3.1.4 and make it compatible to Warp."""
-    star = Path(star)
+@click.option(
+    "--star-list",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Text file listing further input stars, one per line.",
+)
+@click.argument("stars", nargs=-1)
+def downgrade_star(m, star_list, stars):
+    """Take subtomogram starfile from Relion 3.1.4 and make it compatible to Warp.
 
-    star_parsed = starfile.read(star)
+    Several stars can be given (or listed with --star-list); they are processed
+    one after the other in the same process.
+    """
+    stars = utils.collect_paths(stars, star_list)
 
-    particles = star_parsed["particles"]
+    if not stars:
+        raise click.UsageError("No input star given.")
 
-    # Remove entries related to optics groups
-    del particles["rlnOpticsGroup"]
-    del particles["rlnGroupNumber"]
+    for star in stars:
+        downgrade_star_file(star, m)
 
-    # Add some optics info instead
-    angpix = star_parsed["optics"].iloc[0]["rlnMicrographPixelSize"]
 
-    particles["rlnMagnification"] = 10000
-    particles["rlnDetectorPixelSize"] = angpix
+def downgrade(star: dict, m: bool = False):
+    """Downgrade a Relion 3.1 star (dict of blocks) for Warp, see downgrade-star.
 
-    # If rlnOrigin is given, convert to pixels
-    if "rlnOriginXAngst" in particles:
-        particles["rlnOriginX"] = particles["rlnOriginXAngst"].divide(angpix)
-        particles["rlnOriginY"] = particles["rlnOriginYAngst"].divide(angpix)
-        del particles["rlnOriginXAngst"]
-        del particles["rlnOriginYAngst"]
+    Input star is not modified. With m, the particles are returned as the
+    unnamed block of a minimal star for Warp/M.
+    """
+    angpix = star["optics"].iloc[0]["rlnMicrographPixelSize"]
 
-    # Treat Z separately in case of 2D data
-    if "rlnOriginZAngst" in particles:
-        particles["rlnOriginZ"] = particles["rlnOriginZAngst"].divide(angpix)
-        del particles["rlnOriginZAngst"]
+    # Shallow copy, columns are only replaced and deleted
+    particles = downgrade_particles(star["particles"].copy(deep=False), angpix, m)
 
-    if m:
-        particles_m = pd.DataFrame()
-        particles_m["rlnCoordinateX"] = particles["rlnCoordinateX"]
-        particles_m["rlnCoordinateY"] = particles["rlnCoordinateY"]
-        particles_m["rlnCoordinateZ"] = particles["rlnCoordinateZ"]
+    return {"" if m else "particles": particles}
 
-        def mrc2tomostar(str):
-            return str.replace(".mrc", ".tomostar")
 
-        particles_m["rlnMicrographName"] = particles["rlnMicrographName"].apply(
-            mrc2tomostar
-        )
+def downgrade_star_file(star, m: bool = False):
+    """Downgrade one Relion 3.1 star, written as <stem>_downgraded(_data).star."""
+    star = Path(star)
+    perf = metrics.current()
 
-        particles_m["rlnAngleRot"] = particles["rlnAngleRot"]
-        particles_m["rlnAngleTilt"] = particles["rlnAngleTilt"]
-        particles_m["rlnAnglePsi"] = particles["rlnAnglePsi"]
+    blocks, _, chunks = star_io.read_star_chunks(star)
+    chunks = perf.timed(chunks, "read star")
 
-        particles_m["rlnOriginX"] = particles["rlnOriginX"]
-        particles_m["rlnOriginY"] = particles["rlnOriginY"]
-        particles_m["rlnOriginZ"] = particles["rlnOriginZ"]
+    # Add some optics info instead
+    angpix = blocks["optics"].iloc[0]["rlnMicrographPixelSize"]
 
-        particles_m["rlnImageName"] = particles["rlnImageName"]
-        particles_m["rlnCtfImage"] = particles["rlnCtfImage"]
+    if m:
+        out_star, block = f"{star.with_name(star.stem)}_downgraded_data.star", ""
+    else:
+        out_star, block = f"{star.with_name(star.stem)}_downgraded.star", "particles"
 
-        starfile.write(particles_m, f"{star.with_name(star.stem)}_downgraded_data.star")
+    # Particles are transformed and written chunk by chunk
+    with perf.stage("write star"), star_io.StarWriter(out_star) as writer:
+        n_particles = writer.write_loop(
+            block, (downgrade_particles(chunk, angpix, m) for chunk in chunks)
+        )
 
-    else:
-        starfile.write(particles, f"{star.with_name(star.stem)}_downgraded.star")
+    perf.count("particles", n_particles)
+    perf.read(star)
+    perf.wrote(out_star)
 
 
 @click.command()
+@metrics.instrumented()
 @click.option(
     "--radius",
     "-r",
@@ -164,8 +316,60 @@ def downgrade_star(m, star):
     show_default=True,
     help="Deduplication radius in pixels.",
 )
-@click.argument("input_star", type=click.Path(), nargs=1)
-def dedup_3d(radius, input_star): #noqa: C901
+@click.option(
+    "--cache",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Keep a binary copy of the parsed input star next to it, "
+    "to speed up repeated runs.",
+)
+@click.option(
+    "--score",
+    default=None,
+    help="Keep the particle with the highest value in this column instead of "
+    "the first one, e.g. rlnMaxValueProbDistribution or rlnLogLikeliContribution.",
+)
+@click.option(
+    "--max-angle",
+    default=None,
+    type=click.FloatRange(min=0, max=180),
+    help="Only remove particles whose orientation (rlnAngleRot/Tilt/Psi) also "
+    "differs by at most this many degrees, e.g. to keep neighbouring subunits "
+    "of filaments and lattices.",
+)
+@click.option(
+    "--symmetry",
+    default="C1",
+    show_default=True,
+    help="Point group (Cn or Dn) of the particles for --max-angle, orientations "
+    "related by symmetry count as the same.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    type=int,
+    show_default=True,
+    help="Number of tomograms deduplicated in parallel.",
+)
+@click.option(
+    "--star-list",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Text file listing further input stars, one per line.",
+)
+@click.option(
+    "--shard",
+    callback=shards.parse_shard,
+    default=None,
+    help="Only deduplicate shard i of N (e.g. 2/8), split by tomogram. Partial "
+    "outputs (<stem>_dedup.shard2of8.star) are combined with merge-shards.",
+)
+@click.argument("input_stars", type=click.Path(), nargs=-1)
+def dedup_3d(
+    radius, cache, score, max_angle, symmetry, jobs, star_list, shard, input_stars
+):
     """Deduplicate particles in a star file in 3D.
 
     Input star-file (either with or without optics groups) and a radius.
@@ -173,130 +377,426 @@ def dedup_3d(radius, input_star): #noqa: C901
 
     Radius is in pixels, using the pixel spacing which is reflected in the
 
+    Several stars can be given (or listed with --star-list); they are processed
+    one after the other in the same process.
     """
-    input_star = Path(input_star)
+    input_stars = utils.collect_paths(input_stars, star_list)
+
+    if not input_stars:
+        raise click.UsageError("No input star given.")
+
+    for input_star in input_stars:
+        if len(input_stars) > 1:
+            print(f"{input_star}:")
+
+        dedup_star_file(
+            input_star, radius, cache, score, jobs, shard, max_angle, symmetry
+        )
 
-    star = starfile.read(input_star)
+
+def dedup(
+    star: dict,
+    radius: float = 1,
+    score=None,
+    jobs: int = 1,
+    shard=None,
+    max_angle=None,
+    symmetry: str = "C1",
+):
+    """Deduplicate the particles of a star (dict of blocks) in 3D, see dedup-3d.
+
+    Input star is not modified. Returns a star with the same blocks, particles
+    closer than radius (in px) to an earlier particle of their tomogram removed.
+    With score, the particle with the highest value in this column wins instead
+    (greedy non-maximum suppression). Tomograms are processed by jobs workers.
+    With shard (i, N), only the tomograms of this shard are kept, see
+    shards.shard_groups. With max_angle, close particles are only removed if
+    their orientations (up to symmetry, Cn or Dn) differ by at most max_angle
+    degrees.
+    """
+    perf = metrics.current()
 
     # Make sure both older and newer star files are handled properly
-    if isinstance(star, collections.OrderedDict) or isinstance(star, dict):
-        particles = star["particles"]
-    else:
-        particles = star
+    particles_key = star_io.particles_key(star)
+    particles = star[particles_key]
+
+    if score is not None and score not in particles:
+        raise click.ClickException(f"Score column {score} not found.")
 
-    # If rlnImageName and rlnMicrographName exists, create unique tomo ID based path
-    # This should cover Warp 1.X-style star-files
-    if "rlnImageName" in particles.columns and "rlnMicrographName" in particles.columns:
+    matrices = symmetry_ops = None
 
-        def return_session(str):
-            return str.split("/")[-4]
+    if max_angle is not None:
+        if not {"rlnAngleRot", "rlnAngleTilt", "rlnAnglePsi"} <= set(particles):
+            raise click.ClickException("--max-angle needs rlnAngleRot/Tilt/Psi.")
 
-        particles["tomo_uid"] = (
-            particles["rlnImageName"].apply(return_session)
-            + "_"
-            + particles["rlnMicrographName"]
+        try:
+            symmetry_ops = utils.symmetry_matrices(symmetry)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--symmetry") from None
+
+        with perf.stage("rotation matrices"):
+            matrices = utils.euler_matrices(
+                particles["rlnAngleRot"],
+                particles["rlnAngleTilt"],
+                particles["rlnAnglePsi"],
+            )
+
+    with perf.stage("tomogram ids"):
+        tomo_uid = utils.tomogram_ids(particles)
+
+    with perf.stage("distance search"):
+        # Calculate shifted XYZ for all particles at once
+        positions = shifted_coordinates(star, particles)
+        scores = None if score is None else particles[score].to_numpy()
+
+        # Group rows by tomogram once, in order of first appearance
+        tomo_rows = list(utils.group_indices(tomo_uid).values())
+
+        if shard is not None:
+            sizes = [len(rows) for rows in tomo_rows]
+            tomo_rows = [tomo_rows[g] for g in shards.shard_groups(sizes, shard)]
+
+        n_particles = sum(len(rows) for rows in tomo_rows)
+        tasks = (
+            (
+                positions[rows],
+                radius,
+                None if scores is None else scores[rows],
+                None if matrices is None else matrices[rows],
+                max_angle,
+                symmetry_ops,
+            )
+            for rows in tomo_rows
         )
 
+        # Remove based on distance threshold
+        if jobs > 1 and len(tomo_rows) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                too_close = list(
+                    executor.map(
+                        utils.list_close,
+                        *zip(*tasks),
+                        chunksize=max(1, len(tomo_rows) // (4 * jobs)),
+                    )
+                )
+        else:
+            too_close = [utils.list_close(*task) for task in tasks]
 
-    # Otherwise, just take micrograph name
-    elif "rlnMicrographName" in particles.columns:
-        particles["tomo_uid"] = particles["rlnMicrographName"]
+        keep_idx = [
+            np.delete(rows, too_close_idx)
+            for rows, too_close_idx in zip(tomo_rows, too_close)
+        ]
 
-    # Or TomoName for Relion5 style
-    elif "rlnTomoName" in particles.columns:
-        particles["tomo_uid"] = particles["rlnTomoName"]
+    perf.count("tomograms", len(keep_idx))
 
-    # Otherwise, assume all particle in one tomogram
-    else:
-        print("Neither micrograph nor image name found."
-              "Assuming all positions in one tomogram!")
-        particles["tomo_uid"] = "1"
+    keep_idx = np.concatenate([np.empty(0, dtype=np.int64), *keep_idx])
+    particles_dedup = particles.iloc[keep_idx].reset_index(drop=True)
 
-    particles_dedup = pd.DataFrame()
+    # Remove duplicate entries (if multiple classifications were merged)
+    if "rlnImageName" in particles.columns:
+        particles_dedup = particles_dedup.drop_duplicates(
+            subset=["rlnImageName"], keep="first"
+        )
 
-    # Iterate over unique tomograms
-    for tomo in particles["tomo_uid"].unique():
-        particles_selected = particles[particles["tomo_uid"] == tomo]
-        particles_selected.reset_index(drop=True, inplace=True)
+    print(f"{len(particles_dedup.index)} of {n_particles} particles retained.")
 
-        # Calculate shifted XYZ
-        df_temp = pd.DataFrame()
+    perf.count("particles", n_particles)
+    perf.count("particles retained", len(particles_dedup.index))
 
-        # Relion 5 style
-        if "rlnCenteredCoordinateXAngst" in particles_selected:
-            angpix = star["optics"]["rlnImagePixelSize"][0]
+    return {**star, particles_key: particles_dedup}
 
-            df_temp["X"] = particles_selected["rlnCenteredCoordinateXAngst"] - (
-                particles_selected["rlnOriginXAngst"]).divide(angpix)
 
-            df_temp["Y"] = particles_selected["rlnCenteredCoordinateYAngst"] - (
-                particles_selected["rlnOriginYAngst"]).divide(angpix)
+def dedup_star_file(
+    input_star,
+    radius: float = 1,
+    cache: bool = False,
+    score=None,
+    jobs: int = 1,
+    shard=None,
+    max_angle=None,
+    symmetry: str = "C1",
+):
+    """Deduplicate one star file, written as <stem>_dedup.star next to it.
 
-            df_temp["Z"] = particles_selected["rlnCenteredCoordinateZAngst"] - (
-                particles_selected["rlnOriginZAngst"]).divide(angpix)
+    With shard (i, N), the partial output is <stem>_dedup.shard<i>of<N>.star.
+    """
+    input_star = Path(input_star)
+    perf = metrics.current()
 
+    with perf.stage("read star"):
+        star = utils.read_particles(input_star, cache=cache)
 
-        elif "rlnOriginXAngst" in particles_selected:
+    perf.read(input_star)
 
-            if "rlnImagePixelSize" in star["optics"]:
-                angpix = star["optics"]["rlnImagePixelSize"][0]
-            elif "rlnMicrographPixelSize" in star["optics"]:
-                    angpix = star["optics"]["rlnMicrographPixelSize"][0]
+    star = dedup(star, radius, score, jobs, shard, max_angle, symmetry)
+    out_name = shards.shard_name(f"{input_star.stem}_dedup", shard)
+    out_star = input_star.with_name(f"{out_name}.star")
 
-            df_temp["X"] = particles_selected["rlnCoordinateX"] - (
-                particles_selected["rlnOriginXAngst"].divide(angpix)
-            )
-            df_temp["Y"] = particles_selected["rlnCoordinateY"] - (
-                particles_selected["rlnOriginYAngst"].divide(angpix)
-            )
-            df_temp["Z"] = particles_selected["rlnCoordinateZ"] - (
-                particles_selected["rlnOriginZAngst"].divide(angpix)
-            )
-        elif "rlnOriginX" in particles_selected:
-            df_temp["X"] = (
-                particles_selected["rlnCoordinateX"] - particles_selected["rlnOriginX"]
-            )
-            df_temp["Y"] = (
-                particles_selected["rlnCoordinateY"] - particles_selected["rlnOriginY"]
-            )
-            df_temp["Z"] = (
-                particles_selected["rlnCoordinateZ"] - particles_selected["rlnOriginZ"]
-            )
-        else:
-            df_temp["X"] = particles_selected["rlnCoordinateX"]
-            df_temp["Y"] = particles_selected["rlnCoordinateY"]
-            df_temp["Z"] = particles_selected["rlnCoordinateZ"]
+    with perf.stage("write star"):
+        star_io.write_star(star, out_star)
 
-        # Remove based on distance threshold
-        too_close_idx = utils.list_close(df_temp.values, radius)
+    perf.wrote(out_star)
 
-        particles_dedup_temp = particles_selected.drop(set(too_close_idx), axis=0)
 
-        particles_dedup = pd.concat([particles_dedup, particles_dedup_temp])
+@click.command()
+@metrics.instrumented()
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False),
+    required=True,
+    help="Merged star.",
+)
+@click.option(
+    "--keep-duplicates",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Keep particles whose rlnImageName was already seen in an earlier row.",
+)
+@click.option(
+    "--hash-dedup",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Compare only 64-bit hashes of rlnImageName to find duplicates, using 8 "
+    "bytes per particle instead of the name. Distinct names with the same hash are "
+    "dropped as duplicates, for 50 million particles with a chance of about 1e-4.",
+)
+@click.option(
+    "--star-list",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Text file listing further input stars, one per line.",
+)
+@click.argument("input_stars", type=click.Path(exists=True), nargs=-1)
+def merge_stars(output, keep_duplicates, hash_dedup, star_list, input_stars):
+    """Merge many star files into one, e.g. per-tomogram or per-class stars.
+
+    Stars are streamed in the given order and written as they are read, so
+    memory does not grow with the number of particles. Optics groups of Relion
+    3.1/5 stars are merged and renumbered. Particles with a rlnImageName seen
+    before are dropped, e.g. when merging classes of overlapping runs. Only
+    columns present in all stars are kept.
+    """
+    stars = utils.collect_paths(input_stars, star_list)
 
-    # Remove duplicate entries (if multiple classifications were merged)
-    if "rlnImageName" in particles.columns:
-        particles_dedup = particles_dedup.drop_duplicates(
-            subset=["rlnImageName"], keep="first"
-        )
+    if not stars:
+        raise click.UsageError("No input star given.")
 
-    # Remove uuid column
-    del particles_dedup["tomo_uid"]
+    n_particles, n_merged = merge_star_files(
+        stars, Path(output), not keep_duplicates, exact=not hash_dedup
+    )
 
     print(
-        f"{len(particles_dedup.index)} of {len(particles.index)} particles retained."
+        f"Merged {n_particles} particles of {len(stars)} stars into {output}, "
+        f"{n_particles - n_merged} duplicates removed."
     )
 
-    if isinstance(star, collections.OrderedDict) or isinstance(star, dict):
 
-        star['particles'] = particles_dedup
+def merge_optics(optics_tables):
+    """Merge optics tables, renumbering their groups from 1.
+
+    Groups with the same name and values are merged. Groups with a name already
+    taken by different values are renamed to <name>_<group>.
+
+    Input:
+        optics_tables: list of optics DataFrames
+
+    Output:
+        optics: merged optics table, with the columns present in all tables
+        mappings: list with a dict old group -> new group for each table
+
+    """
+    columns = [
+        column
+        for column in optics_tables[0].columns
+        if all(column in table for table in optics_tables)
+    ]
+    keys = [column for column in columns if column != "rlnOpticsGroup"]
+
+    rows = []
+    groups = {}
+    names = set()
+    mappings = []
+
+    for table in optics_tables:
+        mapping = {}
+
+        for row in table.to_dict("records"):
+            key = tuple(row[column] for column in keys)
 
-        starfile.write(star,
-            input_star.with_name(f"{input_star.stem}_dedup.star"),
+            if key not in groups:
+                merged = {column: row[column] for column in columns}
+                merged["rlnOpticsGroup"] = groups[key] = len(rows) + 1
+                name = merged.get("rlnOpticsGroupName")
+
+                if name in names:
+                    merged["rlnOpticsGroupName"] = f"{name}_{groups[key]}"
+
+                names.add(merged.get("rlnOpticsGroupName"))
+                rows.append(merged)
+
+            mapping[row["rlnOpticsGroup"]] = groups[key]
+
+        mappings.append(mapping)
+
+    return pd.DataFrame(rows, columns=columns), mappings
+
+
+def _common_columns(column_lists):
+    """Return columns present in all lists, in order of the first one."""
+    columns = [
+        column
+        for column in column_lists[0]
+        if all(column in other for other in column_lists)
+    ]
+
+    if not {"rlnCoordinateX", "rlnCenteredCoordinateXAngst"} & set(columns):
+        raise click.ClickException(
+            "The stars have no coordinate columns in common (e.g. Relion 5 and "
+            "Relion 3.1 stars), they can not be merged."
         )
+    dropped = sorted(
+        {column for other in column_lists for column in other} - set(columns)
+    )
+
+    if dropped:
+        print(f"Dropping columns not present in all stars: {', '.join(dropped)}.")
+
+    return columns
+
+
+def merge_star_files(stars, out_star: Path, dedup: bool = True, exact: bool = True):
+    """Stream stars into one, see merge-stars.
+
+    Headers are read first, to merge the optics tables and find the common
+    columns, then the particles of each star are read, renumbered, filtered and
+    written chunk by chunk. Blocks preceding the particles (e.g. general of
+    Relion 5) are taken from the first star. With exact=False, duplicates are
+    found by hash only, see utils.SeenValues.
+
+    Output:
+        n_particles: number of particles read
+        n_merged: number of particles written
+
+    """
+    perf = metrics.current()
+
+    with perf.stage("read headers"):
+        headers = [star_io.read_star_header(star) for star in stars]
+
+    has_optics = ["optics" in blocks for blocks, _, _ in headers]
+
+    if any(has_optics) and not all(has_optics):
+        raise click.ClickException(
+            "Some stars have an optics table and some do not, upgrade the "
+            "Warp-style stars first with upgrade-star."
+        )
+
+    first_blocks, block, _ = headers[0]
+    columns = _common_columns([star_columns for _, _, star_columns in headers])
+
+    if all(has_optics):
+        optics, mappings = merge_optics([blocks["optics"] for blocks, _, _ in headers])
+        first_blocks = {**first_blocks, "optics": optics}
+        print(f"Merged optics tables into {len(optics.index)} optics groups.")
     else:
-        starfile.write(
-            particles_dedup, input_star.with_name(f"{input_star.stem}_dedup.star")
+        mappings = [None] * len(stars)
+
+    seen = utils.SeenValues(exact) if dedup and "rlnImageName" in columns else None
+    n_particles = 0
+
+    def merged_chunks():
+        nonlocal n_particles
+
+        for star, mapping in zip(stars, mappings):
+            _, _, chunks = star_io.read_star_chunks(star)
+
+            for chunk in perf.timed(chunks, "read stars"):
+                chunk = chunk[columns]
+                n_particles += len(chunk.index)
+
+                if mapping is not None and "rlnOpticsGroup" in chunk:
+                    chunk["rlnOpticsGroup"] = chunk["rlnOpticsGroup"].map(mapping)
+
+                    if chunk["rlnOpticsGroup"].isna().any():
+                        raise click.ClickException(
+                            f"Particles of {star} refer to optics groups missing "
+                            "from its optics table."
+                        )
+
+                if seen is not None:
+                    with perf.stage("remove duplicates"):
+                        chunk = chunk[seen.first_seen(chunk["rlnImageName"])]
+
+                yield chunk
+
+            perf.read(star)
+
+    with perf.stage("write star"), star_io.StarWriter(out_star) as writer:
+        for name, data in first_blocks.items():
+            writer.write_block(name, data)
+
+        n_merged = writer.write_loop(block, merged_chunks(), columns=columns)
+
+    perf.wrote(out_star)
+    perf.count("stars", len(stars))
+    perf.count("particles", n_particles)
+    perf.count("particles retained", n_merged)
+
+    return n_particles, n_merged
+
+
+def shifted_coordinates(star, particles: pd.DataFrame):
+    """Return XYZ positions of particles, with shifts (rlnOrigin) applied.
+
+    Handles Relion 5 (centered coordinates in Angstrom), Relion 3.1 (origin in
+    Angstrom) and Warp/Relion 3.0 (origin in pixels) style star files.
+
+    Input:
+        star: parsed star file, used to look up the pixel size in the optics table
+        particles: particles table
+
+    Output:
+        positions: (N, 3) np.array of shifted XYZ coordinates.
+
+    """
+    # Relion 5 style
+    if "rlnCenteredCoordinateXAngst" in particles:
+        angpix = star["optics"]["rlnImagePixelSize"][0]
+
+        return np.stack(
+            [
+                particles[f"rlnCenteredCoordinate{ax}Angst"]
+                - particles[f"rlnOrigin{ax}Angst"].divide(angpix)
+                for ax in "XYZ"
+            ],
+            axis=1,
+        )
+
+    elif "rlnOriginXAngst" in particles:
+        if "rlnImagePixelSize" in star["optics"]:
+            angpix = star["optics"]["rlnImagePixelSize"][0]
+        elif "rlnMicrographPixelSize" in star["optics"]:
+            angpix = star["optics"]["rlnMicrographPixelSize"][0]
+
+        return np.stack(
+            [
+                particles[f"rlnCoordinate{ax}"]
+                - particles[f"rlnOrigin{ax}Angst"].divide(angpix)
+                for ax in "XYZ"
+            ],
+            axis=1,
+        )
+
+    elif "rlnOriginX" in particles:
+        return np.stack(
+            [
+                particles[f"rlnCoordinate{ax}"] - particles[f"rlnOrigin{ax}"]
+                for ax in "XYZ"
+            ],
+            axis=1,
         )
 
-    return
+    return particles[["rlnCoordinateX", "rlnCoordinateY", "rlnCoordinateZ"]].to_numpy()
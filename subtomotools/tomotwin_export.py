@@ -1,13 +1,155 @@
+import hashlib
+import pickle
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import click
 import pandas as pd
-import starfile
 
 import subtomotools.utils as utils
+from subtomotools import metrics, star_io
+
+
+def coords_name(coord: Path, split: bool):
+    """Return output star (uid) and tomogram name for a .coords file."""
+    if split:
+        # Split Unique ID / Name
+        uid, name = coord.stem.split("_", maxsplit=1)
+        name = name.rsplit("_", maxsplit=1)[0]
+
+    else:
+        uid = "particles"
+        name = coord.stem
+
+    # improve naming for AreTomo-aligned TS
+    if name.endswith("_ali_Imod"):
+        name = name[:-5]
+
+    return uid, name
+
+
+def coords_to_star(coords: pd.DataFrame, name: str, radius: int):
+    """Deduplicate picks of one tomogram and format them as star columns."""
+    # Remove particles closer than radius
+    too_close_idx = utils.list_close(coords.values, radius)
+    coords_dedup = coords.drop(index=too_close_idx).reset_index(drop=True)
+
+    # Format as star columns
+    coords_dedup.rename(
+        columns={0: "rlnCoordinateX", 1: "rlnCoordinateY", 2: "rlnCoordinateZ"},
+        inplace=True,
+    )
+    coords_dedup["rlnMicrographName"] = f"{name}.tomostar"
+
+    return coords_dedup
+
+
+def ingest_coords(coord: Path, split: bool, radius: int):
+    """Parse and deduplicate one .coords file.
+
+    Output:
+        uid: name of the output star
+        name: tomogram name
+        n_found: number of coordinates before deduplication
+        coords_dedup: DataFrame with star columns
+
+    """
+    uid, name = coords_name(coord, split)
+
+    # Parse coordinates for all references
+    coords = utils.parse_coords(coord)
+
+    return uid, name, len(coords.index), coords_to_star(coords, name, radius)
+
+
+def write_uid_stars(results, out_folder: Path, only_uids=None):
+    """Write one Warp-style star per uid, concatenating each uid's picks once.
+
+    Input:
+        results: iterable of (uid, name, n_found, coords_dedup), in output order
+        out_folder: folder for the <uid>.star files
+        only_uids: if given, only write stars of these uids, and missing ones.
+            Stars of these uids without any results left are removed.
+
+    Output:
+        written: list of paths of the written stars
+
+    """
+    uid_dict = {}
+    written = []
+
+    for uid, _, _, coords_dedup in results:
+        uid_dict.setdefault(uid, []).append(coords_dedup)
+
+    for uid, coords_list in uid_dict.items():
+        out_star = out_folder / f"{uid}.star"
+
+        if only_uids is not None and uid not in only_uids and out_star.exists():
+            continue
+
+        star_io.write_star({"": pd.concat(coords_list, ignore_index=True)}, out_star)
+        written.append(out_star)
+
+    # All .coords files of these uids were removed since the last run
+    for uid in sorted(set(only_uids or ()) - set(uid_dict)):
+        stale_star = out_folder / f"{uid}.star"
+
+        if stale_star.exists():
+            stale_star.unlink()
+            print(f"Removed {stale_star}, none of its .coords files are left.")
+
+    return written
+
+
+def file_hash(path: Path):
+    """Return blake2b hash of file content."""
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def load_manifest(manifest_path: Path, params: tuple):
+    """Return cached entries of an earlier run, if it used the same parameters."""
+    try:
+        with open(manifest_path, "rb") as f:
+            manifest = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return {}
+
+    if manifest.get("params") != params:
+        print("Parameters changed since last run, processing all files.")
+        return {}
+
+    return manifest["entries"]
+
+
+def cached_result(entry: dict, coord: Path):
+    """Return cached result for coord if the file is unchanged, otherwise None.
+
+    Size and modification time are checked first. If only the modification
+    time differs, the content hash decides.
+    """
+    if entry is None:
+        return None
+
+    stat = coord.stat()
+
+    if entry["size"] != stat.st_size:
+        return None
+
+    if entry["mtime_ns"] != stat.st_mtime_ns:
+        if entry["hash"] != file_hash(coord):
+            return None
+
+        entry["mtime_ns"] = stat.st_mtime_ns
+
+    return entry["result"]
 
 
 @click.command()
+@metrics.instrumented()
 @click.option("--split/--nosplit",
               is_flag=True,
               default=False,
@@ -21,8 +163,24 @@ import subtomotools.utils as utils
     show_default=True,
     help="The radius within only 1 pick should be considered, in px",
 )
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    type=int,
+    show_default=True,
+    help="Number of .coords files parsed and deduplicated in parallel.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Keep a manifest next to the output stars and only process new or "
+    "changed .coords files. Stars are only rewritten if their input changed.",
+)
 @click.argument("coords_folder", type=click.Path(), nargs=1)
-def coords2warp(split, radius, coords_folder):
+def coords2warp(split, radius, jobs, incremental, coords_folder):
     """Creates a Warp-style star file from a folder of coordinates.
 
     Optionally, split into star-files based on prefix (before first "_")
@@ -31,47 +189,284 @@ def coords2warp(split, radius, coords_folder):
 
     """
     coords_folder = Path(coords_folder)
+    perf = metrics.current()
 
-    uid_dict = {}
+    coords_files = list(coords_folder.glob("*.coords"))
+
+    manifest_path = coords_folder.parent / f".{coords_folder.name}.coords2warp.pkl"
+    params = (split, radius)
+
+    with perf.stage("check manifest"):
+        entries = load_manifest(manifest_path, params) if incremental else {}
+
+        # Reuse results of unchanged files
+        results = {
+            str(coord): cached_result(entries.get(str(coord)), coord)
+            for coord in coords_files
+        }
 
-    for coord in coords_folder.glob("*.coords"):
+    todo = [coord for coord in coords_files if results[str(coord)] is None]
 
-        if split:
-            # Split Unique ID / Name
-            uid, name = coord.stem.split("_", maxsplit=1)
-            name = name.rsplit("_", maxsplit=1)[0]
+    if incremental:
+        print(f"Reusing {len(coords_files) - len(todo)} unchanged .coords files.")
 
+    n_todo = len(todo)
+    perf.count("coords files", len(coords_files))
+    perf.count("coords files processed", n_todo)
+
+    with perf.stage("read and deduplicate coords"):
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                processed = list(
+                    executor.map(
+                        ingest_coords,
+                        todo,
+                        [split] * n_todo,
+                        [radius] * n_todo,
+                        chunksize=max(1, n_todo // (4 * jobs)),
+                    )
+                )
         else:
-            uid = "particles"
-            name = coord.stem
+            processed = [ingest_coords(coord, split, radius) for coord in todo]
+
+    changed_uids = set()
 
-        # Create one output star per uid
-        if uid not in uid_dict:
-            uid_dict[uid] = pd.DataFrame()
+    for coord, result in zip(todo, processed):
+        uid, name, n_found, coords_dedup = result
 
-        # improve naming for AreTomo-aligned TS
-        if name.endswith("_ali_Imod"):
-            name = name[:-5]
+        print(f"{name}: found {n_found} coordinates.")
+        print(f"{len(coords_dedup.index)} coordinates left after deduplication.")
 
-        # Parse coordinates for all references
-        coords = utils.parse_coords(coord)
+        results[str(coord)] = result
+        changed_uids.add(uid)
 
-        print(f"{name}: found {len(coords.index)} coordinates.")
+        perf.read(coord)
+        perf.count("picks found", n_found)
+        perf.count("picks retained", len(coords_dedup.index))
 
-        # Remove particles closer than radius
-        coords_dedup = utils.dedup(coords.values, radius)
+    # Removed files change their star, too
+    changed_uids.update(
+        entry["result"][0] for path, entry in entries.items() if path not in results
+    )
 
-        # Format as star columns
-        coords_dedup.rename(
-            columns={0: "rlnCoordinateX", 1: "rlnCoordinateY", 2: "rlnCoordinateZ"},
-            inplace=True,
+    # Most recently parsed file first, as before
+    with perf.stage("write stars"):
+        written = write_uid_stars(
+            list(results.values())[::-1],
+            coords_folder.parent,
+            only_uids=changed_uids if incremental else None,
         )
-        coords_dedup["rlnMicrographName"] = f"{name}.tomostar"
 
-        # Append to full set
-        uid_dict[uid] = pd.concat([coords_dedup, uid_dict[uid]])
+    for out_star in written:
+        perf.wrote(out_star)
+
+    if incremental:
+        processed_paths = {str(coord) for coord in todo}
+        new_entries = {}
 
-    for uid in uid_dict:
-        starfile.write(uid_dict[uid], coords_folder.parent / f"{uid}.star")
+        for coord in coords_files:
+            path = str(coord)
+            stat = coord.stat()
+
+            new_entries[path] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "hash": file_hash(coord)
+                if path in processed_paths
+                else entries[path]["hash"],
+                "result": results[path],
+            }
+
+        with open(manifest_path, "wb") as f:
+            pickle.dump({"params": params, "entries": new_entries}, f, protocol=4)
 
     return
+
+
+def _run_stage(args, stage: str, perf: metrics.Metrics):
+    """Run one TomoTwin command line tool, timed as stage."""
+    try:
+        with perf.stage(stage):
+            subprocess.run(
+                [str(arg) for arg in args], check=True, capture_output=True, text=True
+            )
+    except subprocess.CalledProcessError as e:
+        print(e.stdout)
+        print(e.stderr)
+        raise
+
+
+def pipeline_tomogram(embedding: Path, reference: Path, out_folder: Path, pick_args):
+    """Map, locate and pick one tomogram, skipping stages with existing outputs.
+
+    Maps are written to a temporary folder and removed directly afterwards.
+    Located maxima are kept in out_folder/locate and picks in out_folder/coords,
+    named like in the bash_helpers loops.
+
+    Output:
+        stem: name of the embedding file, up to the first "."
+        coords: DataFrame with all picks of the tomogram
+        perf: Metrics of this tomogram
+
+    """
+    stem = embedding.name.split(".")[0]
+    tloc = out_folder / "locate" / f"{stem}.tloc"
+    coords_file = out_folder / "coords" / f"{stem}.coords"
+    perf = metrics.Metrics()
+
+    if coords_file.exists():
+        return stem, utils.parse_coords(coords_file), perf
+
+    with tempfile.TemporaryDirectory(dir=out_folder) as work:
+        work = Path(work)
+
+        if not tloc.exists():
+            _run_stage(
+                ["tomotwin_map.py", "distance", "-r", reference, "-v", embedding,
+                 "-o", work],
+                "map",
+                perf,
+            )
+            _run_stage(
+                ["tomotwin_locate.py", "findmax", "-m", work / "map.tmap", "-o", work],
+                "locate",
+                perf,
+            )
+            shutil.move(work / "located.tloc", tloc)
+
+        _run_stage(
+            ["tomotwin_pick.py", "-l", tloc, *pick_args, "--o", work / "pick"],
+            "pick",
+            perf,
+        )
+
+        with perf.stage("collect picks"):
+            pick_files = sorted((work / "pick").glob("*.coords"))
+
+            # Keep all picks of the tomogram in one .coords, like cat in loop_pick.sh
+            with open(coords_file, "w") as f:
+                f.writelines(pick_file.read_text() for pick_file in pick_files)
+
+            coords = pd.concat(
+                [utils.parse_coords(pick_file) for pick_file in pick_files]
+                or [pd.DataFrame(columns=[0, 1, 2])],
+                ignore_index=True,
+            )
+
+        perf.count("tomograms picked")
+        perf.wrote(coords_file)
+
+    return stem, coords, perf
+
+
+@click.command()
+@metrics.instrumented(summary=True)
+@click.option("--split/--nosplit",
+              is_flag=True,
+              default=False,
+              show_default=True,
+              help="Split star files based on prefix of tomogram, before first _")
+@click.option(
+    "--radius",
+    "-r",
+    default=1,
+    type=int,
+    show_default=True,
+    help="The radius within only 1 pick should be considered, in px",
+)
+@click.option("--target", default=None, help="Target to pick, default all targets.")
+@click.option("--minmetric", default=0.99, show_default=True, type=float)
+@click.option("--maxmetric", default=1.0, show_default=True, type=float)
+@click.option("--minsize", default=80, show_default=True, type=int)
+@click.option("--maxsize", default=600, show_default=True, type=int)
+@click.option(
+    "-o",
+    "--out",
+    type=click.Path(),
+    default=".",
+    show_default=True,
+    help="Output folder, for locate/, coords/ and the star files.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    type=int,
+    show_default=True,
+    help="Number of tomograms processed in parallel.",
+)
+@click.argument("reference", type=click.Path(exists=True), nargs=1)
+@click.argument("embeddings", type=click.Path(exists=True), nargs=-1)
+def tomotwin_pipeline(
+    split,
+    radius,
+    target,
+    minmetric,
+    maxmetric,
+    minsize,
+    maxsize,
+    out,
+    jobs,
+    reference,
+    embeddings,
+):
+    """Run TomoTwin map, locate and pick for many tomograms, write Warp stars.
+
+    Takes the reference embeddings (.temb) and the tomogram embeddings (.temb
+    files or folders containing them). Tomograms are processed in parallel,
+    stages whose outputs already exist are skipped.
+    Picks are deduplicated and written as in coords2warp.
+
+    """
+    out = Path(out)
+    (out / "locate").mkdir(parents=True, exist_ok=True)
+    (out / "coords").mkdir(parents=True, exist_ok=True)
+
+    embedding_files = []
+
+    for embedding in map(Path, embeddings):
+        if embedding.is_dir():
+            embedding_files.extend(sorted(embedding.glob("*.temb")))
+        else:
+            embedding_files.append(embedding)
+
+    pick_args = ["--minmetric", minmetric, "--maxmetric", maxmetric,
+                 "--minsize", minsize, "--maxsize", maxsize]
+
+    if target is not None:
+        pick_args += ["--target", target]
+
+    perf = metrics.current()
+    results = []
+
+    # Stages run as subprocesses, so threads are enough to keep them busy
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(
+                pipeline_tomogram, embedding, Path(reference), out, pick_args
+            )
+            for embedding in embedding_files
+        ]
+
+        for future in as_completed(futures):
+            stem, coords, tomo_perf = future.result()
+
+            stages = ", ".join(
+                f"{k} {v:.1f} s" for k, v in tomo_perf.stages.items()
+            )
+            print(f"{stem}: {len(coords.index)} picks ({stages or 'cached'}).")
+
+            with perf.stage("deduplicate picks"):
+                uid, name = coords_name(Path(f"{stem}.coords"), split)
+                coords_dedup = coords_to_star(coords, name, radius)
+
+            results.append((uid, name, len(coords.index), coords_dedup))
+            perf.merge(tomo_perf)
+            perf.count("picks found", len(coords.index))
+            perf.count("picks retained", len(coords_dedup.index))
+
+    with perf.stage("write stars"):
+        written = write_uid_stars(sorted(results, key=lambda result: result[1]), out)
+
+    for out_star in written:
+        perf.wrote(out_star)
@@ -1,72 +1,538 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
+import mrcfile
 import numpy as np
 import pandas as pd
 
+from subtomotools import star_io
+
+
+def read_coords(coordsfile: Path):
+    """Read .coords (whitespace-separated numbers, one pick per line) as np.array.
+
+    Uses np.fromfile instead of a CSV parser, the number of columns is taken
+    from the first line.
+    """
+    with open(coordsfile) as f:
+        n_columns = len(f.readline().split())
+
+    if n_columns == 0:
+        return np.empty((0, 3))
+
+    return np.fromfile(coordsfile, sep=" ").reshape(-1, n_columns)
+
 
 def parse_coords(coordsfile: Path):
     """Parse .coords as DataFrame."""
-    coords = pd.DataFrame()
+    coords = pd.DataFrame(read_coords(coordsfile))
 
-    coords = pd.read_csv(coordsfile, sep=" ", header=None)
+    # Keep integer columns as integers, as a CSV parser would
+    for column in coords.columns:
+        if np.all(np.mod(coords[column], 1) == 0):
+            coords[column] = coords[column].astype(np.int64)
 
     return coords
 
 
+def group_indices(values):
+    """Group row positions by value in one pass, in order of first appearance.
+
+    Missing values are not assigned to any group.
+
+    Input:
+        values: array-like of hashable values, e.g. a pd.Series
+
+    Output:
+        groups: dict of value -> np.array of row positions
+
+    """
+    codes, uniques = pd.factorize(values)
+
+    valid = np.flatnonzero(codes >= 0)
+    order = valid[np.argsort(codes[valid], kind="stable")]
+    counts = np.bincount(codes[valid], minlength=len(uniques))
+
+    return dict(zip(uniques, np.split(order, np.cumsum(counts)[:-1])))
+
+
+class SeenValues:
+    """Set of strings seen so far, to drop repeated values from a stream of chunks.
+
+    Values are looked up by their 64-bit hash, in sorted arrays which are merged
+    like a log-structured merge tree. The values themselves are kept as UTF-8
+    bytes next to their hashes and compared on every hash match, so distinct
+    values are never taken as equal: about the length of a value plus 8 bytes
+    per distinct value instead of a Python object each.
+
+    With exact=False, only the hashes are kept (8 bytes per distinct value) and
+    distinct values with the same hash are taken as equal; for 50 million
+    values, the chance of any such collision is about 1e-4.
+    """
+
+    def __init__(self, exact: bool = True):
+        self.exact = exact
+        self.runs = []
+        self.keys = []
+
+    def __len__(self):
+        """Return number of distinct values seen."""
+        return sum(len(run) for run in self.runs)
+
+    def _in_run(self, i, unique, keys):
+        """Return mask of the (hash sorted) unique values found in run i."""
+        run = self.runs[i]
+        low = np.searchsorted(run, unique, side="left")
+        high = np.searchsorted(run, unique, side="right")
+        found = high > low
+
+        if not self.exact:
+            return found
+
+        run_keys = self.keys[i]
+        hits = np.flatnonzero(found)
+        found[hits] = run_keys[low[hits]] == keys[hits]
+
+        # Distinct values with the same hash in this run, compare all of them
+        for j in hits[~found[hits] & (high[hits] - low[hits] > 1)]:
+            found[j] = keys[j] in run_keys[low[j] : high[j]]
+
+        return found
+
+    def first_seen(self, values):
+        """Return mask of values not seen before (in earlier chunks or values)."""
+        values = values.tolist() if hasattr(values, "tolist") else list(values)
+        # Python's string hash is several times faster than pd.util.hash_array
+        hashes = np.fromiter(map(hash, values), dtype=np.int64, count=len(values))
+        unique, first, inverse = np.unique(
+            hashes, return_index=True, return_inverse=True
+        )
+        keys = None
+
+        if self.exact:
+            objects = np.array(values, dtype=object)
+            # Distinct values of this chunk with the same hash count separately
+            clashes = np.flatnonzero(objects[first][inverse] != objects)
+
+            if len(clashes):
+                extra = {values[i]: i for i in clashes[::-1].tolist()}
+                first = np.concatenate([first, list(extra.values())]).astype(np.int64)
+                first = first[np.argsort(hashes[first], kind="stable")]
+                unique = hashes[first]
+
+            keys = np.array([v.encode() for v in objects[first].tolist()], dtype=bytes)
+
+        new = np.ones(len(unique), dtype=bool)
+
+        for i in range(len(self.runs)):
+            new &= ~self._in_run(i, unique, keys)
+
+        mask = np.zeros(len(values), dtype=bool)
+        mask[first[new]] = True
+
+        if new.any():
+            self.runs.append(unique[new])
+            self.keys.append(keys[new] if self.exact else None)
+
+        # Merge runs of similar size, so there are only log(n) of them
+        while len(self.runs) > 1 and len(self.runs[-2]) <= 2 * len(self.runs[-1]):
+            run, keys = np.concatenate(self.runs[-2:]), self.keys[-2:]
+            del self.runs[-1], self.keys[-1]
+
+            if self.exact:
+                order = np.argsort(run, kind="stable")
+                self.runs[-1], self.keys[-1] = run[order], np.concatenate(keys)[order]
+            else:
+                self.runs[-1] = np.sort(run)
+
+        return mask
+
+
+def read_particles(path, cache: bool = False):
+    """Read a star file into a dict of blocks, with a compact particles table.
+
+    Micrograph, tomogram and CTF names are stored as categoricals, coordinates,
+    shifts and angles as float32 where that is exact (see star_io.apply_types).
+    Each name is then kept once, with a small integer code per particle.
+
+    Input:
+        path: path to star file
+        cache: keep a binary sidecar next to the star, see star_io.read_star
+
+    Output:
+        blocks: dict of DataFrames (loop blocks) and dicts (simple blocks)
+
+    """
+    return star_io.read_star(path, typed=True, cache=cache)
+
+
+def tomogram_ids(particles: pd.DataFrame):
+    """Return a categorical Series with a unique ID of the tomogram of each particle.
+
+    For Warp 1.X-style stars, the ID combines the session (fourth-last part of
+    rlnImageName) with rlnMicrographName. Packed stars (see pack-subtomos) refer
+    to N@stack names, their original subtomogram paths are taken from
+    rlnImageOriginalName. Without it, all particles of a stack share the
+    session. String operations only run on the distinct sessions, the rest is
+    done on integer codes.
+    """
+    columns = particles.columns
+
+    # If rlnImageName and rlnMicrographName exists, create unique tomo ID
+    # based on path. This should cover Warp 1.X-style star-files
+    if "rlnImageName" in columns and "rlnMicrographName" in columns:
+        image_names = particles.get("rlnImageOriginalName", particles["rlnImageName"])
+
+        # Strip an N@ stack index and the last three path components, then
+        # factorize the few sessions
+        session_paths = image_names.astype(str).str.replace(
+            r"^\d+@|/[^/]*/[^/]*/[^/]*$", "", regex=True
+        )
+        session_codes, session_paths = pd.factorize(session_paths)
+        sessions = [path.rsplit("/", 1)[-1] for path in session_paths]
+
+        micrograph_codes, micrographs = pd.factorize(particles["rlnMicrographName"])
+        pair_codes, pairs = pd.factorize(
+            session_codes * len(micrographs) + micrograph_codes
+        )
+
+        # Different session paths may end in the same session name
+        id_codes, ids = pd.factorize(
+            pd.Index(
+                [
+                    f"{sessions[pair // len(micrographs)]}_"
+                    f"{micrographs[pair % len(micrographs)]}"
+                    for pair in pairs
+                ]
+            )
+        )
+
+        return pd.Series(
+            pd.Categorical.from_codes(id_codes[pair_codes], ids),
+            index=particles.index,
+        )
+
+    # Otherwise, just take micrograph name
+    elif "rlnMicrographName" in columns:
+        return particles["rlnMicrographName"]
+
+    # Or TomoName for Relion5 style
+    elif "rlnTomoName" in columns:
+        return particles["rlnTomoName"]
+
+    # Otherwise, assume all particle in one tomogram
+    print("Neither micrograph nor image name found."
+          "Assuming all positions in one tomogram!")
+
+    return pd.Series("1", index=particles.index)
+
+
 def scale_coordinates(coords: pd.DataFrame, scaling_factor: float):
     """Scale coordinates by scaling factor."""
     return coords.multiply(scaling_factor)
 
 
-def list_close(positions: np.array, exclusion_dist: int):
+def neighbour_pairs(positions: np.array, radius: float, chunk_size: int = 500000):
+    """List all index pairs in np.array closer than distance threshold (radius).
+
+    Points are hashed into a uniform grid with cell size equal to the radius, so
+    only points in the same or adjacent cells have to be compared. Runtime is
+    close to linear for the particle densities found in tomograms.
+
+    Input:
+        positions: np.array with 3D coordinates as columns
+        radius: float value, distance threshold
+        chunk_size: number of points whose neighbours are searched at once
+
+    Output:
+        pairs: (M, 2) np.array of indices (i, j) with i < j, sorted by i and j.
+
+    """
+    positions = np.asarray(positions, dtype=np.float64)[:, :3]
+
+    if len(positions) < 2 or radius <= 0:
+        return np.empty((0, 2), dtype=np.int64)
+
+    # Integer cell per point, padded by one cell on each side for the offsets
+    cells = np.floor((positions - positions.min(axis=0)) / radius).astype(np.int64)
+    cells += 1
+    shape = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * shape[1] + cells[:, 1]) * shape[2] + cells[:, 2]
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    sorted_positions = positions[order]
+
+    # Own cell plus the 13 neighbouring cells in the positive half-shell,
+    # so that every pair of cells is only visited once
+    offsets = [
+        (dx * shape[1] + dy) * shape[2] + dz
+        for dx in (-1, 0, 1)
+        for dy in (-1, 0, 1)
+        for dz in (-1, 0, 1)
+        if (dx, dy, dz) > (0, 0, 0)
+    ]
+
+    radius_sq = float(radius) ** 2
+    pairs_i, pairs_j = [], []
+
+    for chunk_start in range(0, len(positions), chunk_size):
+        rows = np.arange(chunk_start, min(chunk_start + chunk_size, len(positions)))
+        row_keys = sorted_keys[rows]
+
+        for offset in [0, *offsets]:
+            end = np.searchsorted(sorted_keys, row_keys + offset, side="right")
+
+            # Within the own cell, only look at points further down the order
+            if offset == 0:
+                start = rows + 1
+            else:
+                start = np.searchsorted(sorted_keys, row_keys + offset, side="left")
+
+            counts = np.maximum(end - start, 0)
+            total = counts.sum()
+
+            if total == 0:
+                continue
+
+            # Expand [start, end) ranges into flat candidate index arrays
+            idx_i = np.repeat(rows, counts)
+            idx_j = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(
+                total
+            )
+
+            dist_sq = np.sum(
+                np.square(sorted_positions[idx_i] - sorted_positions[idx_j]), axis=1
+            )
+            close = dist_sq < radius_sq
+
+            pairs_i.append(order[idx_i[close]])
+            pairs_j.append(order[idx_j[close]])
+
+    if not pairs_i:
+        return np.empty((0, 2), dtype=np.int64)
+
+    pairs_i = np.concatenate(pairs_i)
+    pairs_j = np.concatenate(pairs_j)
+
+    pairs = np.stack(
+        [np.minimum(pairs_i, pairs_j), np.maximum(pairs_i, pairs_j)], axis=1
+    )
+
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
+def greedy_exclude(pairs: np.array, n_points: int, min_shrink: float = 0.5):
+    """Resolve neighbour pairs greedily, lower indices win.
+
+    Walking the points in index order, a point is kept unless a kept point with
+    lower index is its neighbour. Isolated clusters are resolved in vectorized
+    rounds first: all points without undecided lower-index neighbours are kept
+    at once. On chain-like picks (filaments, lattices) a round only settles the
+    head of every chain, so once a round removes less than min_shrink of the
+    remaining pairs, the rest is resolved by a sequential sweep over the pairs,
+    which is linear in their number.
+
+    Input:
+        pairs: (M, 2) np.array of neighbour indices (i, j) with i < j, sorted by
+            i and j (see neighbour_pairs)
+        n_points: total number of points
+        min_shrink: fraction of pairs a round has to settle to continue rounds
+
+    Output:
+        excluded: sorted np.array of the indices of suppressed points
+
+    """
+    excluded = np.zeros(n_points, dtype=bool)
+    decided = np.zeros(n_points, dtype=bool)
+
+    while len(pairs) > 0:
+        # Points with an undecided neighbour of lower index have to wait
+        waiting = np.zeros(n_points, dtype=bool)
+        waiting[pairs[:, 1]] = True
+
+        # All others are kept, and suppress their neighbours
+        suppressing = ~waiting[pairs[:, 0]] & ~decided[pairs[:, 0]]
+        excluded[pairs[suppressing, 1]] = True
+        decided[pairs[suppressing].ravel()] = True
+
+        n_pairs = len(pairs)
+        pairs = pairs[~(decided[pairs[:, 0]] | decided[pairs[:, 1]])]
+
+        if len(pairs) > (1 - min_shrink) * n_pairs:
+            break
+
+    if len(pairs) > 0:
+        # Remaining points have no kept neighbour yet, so walking the pairs in
+        # order reproduces the sweep over the input
+        first, starts = np.unique(pairs[:, 0], return_index=True)
+        ends = np.append(starts[1:], len(pairs))
+
+        for i, start, end in zip(first.tolist(), starts.tolist(), ends.tolist()):
+            if not excluded[i]:
+                excluded[pairs[start:end, 1]] = True
+
+    return np.flatnonzero(excluded)
+
+
+def euler_matrices(rot, tilt, psi):
+    """Return rotation matrices (N, 3, 3) of Relion (ZYZ) Euler angles in degrees.
+
+    Same convention as Euler_angles2matrix of Relion, for all angles at once.
+    """
+    rot, tilt, psi = (
+        np.deg2rad(np.asarray(angles, dtype=np.float64)) for angles in (rot, tilt, psi)
+    )
+    ca, sa = np.cos(rot), np.sin(rot)
+    cb, sb = np.cos(tilt), np.sin(tilt)
+    cg, sg = np.cos(psi), np.sin(psi)
+    cc, cs, sc, ss = cb * ca, cb * sa, sb * ca, sb * sa
+
+    return np.stack(
+        [
+            np.stack([cg * cc - sg * sa, cg * cs + sg * ca, -cg * sb], axis=-1),
+            np.stack([-sg * cc - cg * sa, -sg * cs + cg * ca, sg * sb], axis=-1),
+            np.stack([sc, ss, cb], axis=-1),
+        ],
+        axis=-2,
+    )
+
+
+def symmetry_matrices(symmetry: str = "C1"):
+    """Return rotation matrices (K, 3, 3) of point group Cn or Dn.
+
+    As in Relion, the n-fold axis is along Z, and the 2-fold axes of Dn are X
+    and its rotations about Z.
+    """
+    match = re.fullmatch(r"([CD])([1-9]\d*)", symmetry.strip().upper())
+
+    if match is None:
+        raise ValueError(f"Unsupported symmetry {symmetry}, only Cn and Dn.")
+
+    group, n = match[1], int(match[2])
+    angles = 2 * np.pi * np.arange(n) / n
+    c, s = np.cos(angles), np.sin(angles)
+    zeros, ones = np.zeros_like(c), np.ones_like(c)
+
+    # Rotations about Z
+    matrices = np.stack(
+        [
+            np.stack([c, -s, zeros], axis=-1),
+            np.stack([s, c, zeros], axis=-1),
+            np.stack([zeros, zeros, ones], axis=-1),
+        ],
+        axis=-2,
+    )
+
+    if group == "D":
+        flip = np.diag([1.0, -1.0, -1.0])
+        matrices = np.concatenate([matrices, matrices @ flip])
+
+    return matrices
+
+
+def pair_angles(matrices: np.array, pairs: np.array, symmetry=None, batch=1_000_000):
+    """Return the angle in degrees between the orientations of each pair.
+
+    With symmetry matrices, the smallest angle over all symmetry-related
+    orientations (A_j S) of the second particle is taken. Pairs are handled in
+    batches, as whole arrays.
+
+    Input:
+        matrices: (N, 3, 3) rotation matrices, see euler_matrices
+        pairs: (M, 2) np.array of indices
+        symmetry: optional (K, 3, 3) symmetry matrices, see symmetry_matrices
+        batch: number of pairs per batch
+
+    Output:
+        angles: (M,) np.array
+
+    """
+    if symmetry is None:
+        symmetry = np.eye(3)[np.newaxis]
+
+    angles = np.empty(len(pairs))
+
+    for start in range(0, len(pairs), batch):
+        i, j = pairs[start : start + batch].T
+
+        # trace(A_i^T A_j S) for all pairs and symmetry operators
+        relative = np.einsum("pki,pkj->pij", matrices[i], matrices[j])
+        traces = np.einsum("pij,sji->ps", relative, symmetry).max(axis=1)
+
+        angles[start : start + batch] = np.rad2deg(
+            np.arccos(np.clip((traces - 1) / 2, -1, 1))
+        )
+
+    return angles
+
+
+def list_close(
+    positions: np.array,
+    exclusion_dist: int,
+    scores=None,
+    matrices=None,
+    max_angle=None,
+    symmetry=None,
+):
     """List indices in np.array closer than distance threshold (radius).
 
-    First point in sphere is retained.
+    First point in sphere is retained, or with scores the point with the highest
+    score (greedy non-maximum suppression; ties are kept in input order). With
+    matrices and max_angle, points only count as close if their orientations
+    differ by at most max_angle as well.
 
     Input:
         positions: np.array with 3D coordinates as columns
         exclusion_dist: int value, minimum distance between coordinates
+        scores: optional np.array with one score per point, higher is better
+        matrices: optional (N, 3, 3) rotation matrices, see euler_matrices
+        max_angle: largest angle in degrees between close orientations
+        symmetry: optional symmetry matrices, see pair_angles
 
     Output:
         exclude_list: Indices of the points closer than exclusion radius.
 
     """
-    exclude_list = []
+    if scores is not None:
+        # Relabel points by rank, so that "first wins" means "best wins"
+        order = np.argsort(-np.asarray(scores, dtype=np.float64), kind="stable")
+        excluded = list_close(
+            np.asarray(positions)[order],
+            exclusion_dist,
+            matrices=None if matrices is None else matrices[order],
+            max_angle=max_angle,
+            symmetry=symmetry,
+        )
 
-    for i in range(0, len(positions)):
-        if i in exclude_list:
-            continue
+        return np.sort(order[excluded]).tolist()
 
-        else:
-            exclude_idx = np.where(
-                euclidean_dist_3D(positions, positions[i]) < exclusion_dist
-            )[0]
+    pairs = neighbour_pairs(positions, exclusion_dist)
 
-            if len(exclude_idx) > 1:
-                exclude_idx_cleaned = np.delete(
-                    exclude_idx, np.argwhere(exclude_idx == i)
-                )
+    if matrices is not None and max_angle is not None and len(pairs):
+        pairs = pairs[pair_angles(matrices, pairs, symmetry) <= max_angle]
 
-                exclude_list.extend(exclude_idx_cleaned.tolist())
+    return greedy_exclude(pairs, len(positions)).tolist()
 
-    return exclude_list
 
-
-def dedup(positions: np.array, exclusion_dist: int):
+def dedup(positions: np.array, exclusion_dist: int, scores=None):
     """Deduplicate np.array based on distance threshold (radius).
 
     If multiple coordinates are found within the exclusion radius, only the
-    first one survives.
+    first one survives, or the one with the highest score if scores are given.
 
     Input:
         positions: np.array with 3D coordinates as columns
         exclusion_dist: int value, minimum distance between coordinates
+        scores: optional np.array with one score per point, higher is better
 
     Output:
         positions_dedup: XYZ coordinates of the surviving points.
 
     """
-    exclude_list = list_close(positions, exclusion_dist)
+    exclude_list = list_close(positions, exclusion_dist, scores)
 
     positions_dedup = np.delete(positions, exclude_list, axis=0)
 
@@ -82,3 +548,100 @@ def euclidean_dist_3D(array, point):
         + np.square(array[:, 1] - point[1])
         + np.square(array[:, 2] - point[2])
     )
+
+
+def collect_paths(paths, path_list=None):
+    """Return paths given directly and those listed in a text file.
+
+    Input:
+        paths: iterable of paths, e.g. from the command line
+        path_list: optional text file with one path per line, empty lines and
+            lines starting with # are skipped
+
+    Output:
+        list of Path, in the given order
+
+    """
+    collected = [Path(path) for path in paths]
+
+    if path_list is not None:
+        with open(path_list) as f:
+            collected += [
+                Path(line.strip())
+                for line in f
+                if line.strip() and not line.lstrip().startswith("#")
+            ]
+
+    return collected
+
+
+def mrc_path(image_name: str):
+    """Return file path of an image name, dropping a stack index (N@) if given."""
+    return str(image_name).split("@")[-1]
+
+
+@lru_cache(maxsize=None)
+def probe_mrc(path: str):
+    """Return shape and pixel size of an MRC file, reading only the header.
+
+    Results are memoized per path.
+
+    Input:
+        path: path to MRC file, or image name (N@path)
+
+    Output:
+        shape: (Z, Y, X) as stored in the header, of a single volume for
+            volume stacks (e.g. written by pack-subtomos)
+        angpix: pixel size in X
+
+    """
+    with mrcfile.open(mrc_path(path), header_only=True) as mrc:
+        header = mrc.header
+        # Space groups 401-630 mark volume stacks, of mz sections per volume
+        depth = header.mz if 401 <= header.ispg <= 630 else header.nz
+        shape = (int(depth), int(header.ny), int(header.nx))
+        angpix = float(mrc.voxel_size.x)
+
+    return shape, angpix
+
+
+def validate_mrcs(image_names, jobs: int = 16):
+    """Check that all referenced MRC files exist and have the same shape.
+
+    Headers are probed in parallel with a thread pool, each file only once.
+
+    Input:
+        image_names: iterable of paths or image names (N@path)
+        jobs: number of threads
+
+    Output:
+        problems: list of (path, message), empty if all files are consistent.
+
+    """
+    paths = list(dict.fromkeys(mrc_path(name) for name in image_names))
+
+    def try_probe(path):
+        try:
+            return probe_mrc(path)
+        except FileNotFoundError:
+            return "file not found"
+        except ValueError as e:
+            return f"invalid MRC header ({e})"
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(try_probe, paths))
+
+    problems = [(p, r) for p, r in zip(paths, results) if isinstance(r, str)]
+    shapes = [r[0] for r in results if not isinstance(r, str)]
+
+    if shapes:
+        # Compare against the most common shape
+        expected = max(set(shapes), key=shapes.count)
+
+        problems.extend(
+            (p, f"shape {r[0]} differs from {expected}")
+            for p, r in zip(paths, results)
+            if not isinstance(r, str) and r[0] != expected
+        )
+
+    return problems
@@ -0,0 +1,246 @@
+"""Read subtomograms from loose files or packed volume stacks, with read-ahead.
+
+Warp writes one .mrc per subtomogram (and CTF volume), so large datasets consist
+of hundreds of thousands of small files. pack-subtomos copies them into one MRC
+volume stack per kind, referenced like 2D particle stacks as N@stack.mrcs (N
+starting at 1). The stack is memory-mapped, so a volume is read at a fixed
+offset without opening a file per particle.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+import click
+import mrcfile
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from subtomotools import metrics, star_io, utils
+
+
+def parse_image_name(image_name: str):
+    """Split an image name into (index, path).
+
+    Output:
+        index: 0-based position in the stack, or None for a single volume file
+        path: path of the MRC file
+
+    """
+    index, at, path = str(image_name).rpartition("@")
+
+    if not at:
+        return None, path
+
+    return int(index) - 1, path
+
+
+@lru_cache(maxsize=8)
+def _open_stack(path: str):
+    """Memory-map a volume stack, once per (worker) process."""
+    return mrcfile.mmap(path, mode="r", permissive=True)
+
+
+def read_volume(image_name: str):
+    """Return the volume referenced by an image name (path or N@stack)."""
+    index, path = parse_image_name(image_name)
+
+    if index is None:
+        return mrcfile.read(path)
+
+    return np.array(_open_stack(path).data[index])
+
+
+def read_volumes(image_names):
+    """Return the volumes referenced by image names as one stack (BZYX).
+
+    Volumes in the same packed stack are read with one indexing operation on
+    its memory map, in the order of their index.
+    """
+    volumes = [None] * len(image_names)
+    stacked = {}
+
+    for position, image_name in enumerate(image_names):
+        index, path = parse_image_name(image_name)
+
+        if index is None:
+            volumes[position] = mrcfile.read(path)
+        else:
+            stacked.setdefault(path, []).append((index, position))
+
+    for path, items in stacked.items():
+        indices, positions = np.array(sorted(items)).T
+        data = _open_stack(path).data[indices]
+
+        for position, volume in zip(positions, data):
+            volumes[position] = volume
+
+    return np.stack(volumes)
+
+
+class VolumeReader:
+    """Read chunks of volumes in background threads, ahead of their use.
+
+    Iterating yields one stack (BZYX) per chunk of image names, in order, while
+    the following read_ahead chunks are already being read. Reading loose files
+    is mostly waiting for the filesystem, which overlaps with the work done on
+    the current chunk.
+
+    Input:
+        name_chunks: iterable of lists of image names (paths or N@stack)
+        read_ahead: number of chunks read in advance
+
+    """
+
+    def __init__(self, name_chunks, read_ahead: int = 2):
+        self.name_chunks = name_chunks
+        self.read_ahead = max(read_ahead, 1)
+
+    def __iter__(self):
+        """Yield the volumes of each chunk of image names."""
+        with ThreadPoolExecutor(max_workers=self.read_ahead) as executor:
+            in_flight = deque()
+
+            for names in self.name_chunks:
+                in_flight.append(executor.submit(read_volumes, names))
+
+                if len(in_flight) > self.read_ahead:
+                    yield in_flight.popleft().result()
+
+            while in_flight:
+                yield in_flight.popleft().result()
+
+
+def pack_volumes(image_names, out_mrcs: Path, chunk: int = 64, read_ahead: int = 4):
+    """Copy volumes into one memory-mapped MRC volume stack, in the given order.
+
+    All volumes need the same shape. Voxel size and data type are taken from the
+    first volume.
+
+    Output:
+        image_names: names of the packed volumes (N@out_mrcs)
+
+    """
+    perf = metrics.current()
+    first = read_volume(image_names[0])
+    shape, angpix = first.shape, utils.probe_mrc(image_names[0])[1]
+
+    name_chunks = (
+        image_names[start : start + chunk]
+        for start in range(0, len(image_names), chunk)
+    )
+
+    with mrcfile.new_mmap(
+        out_mrcs,
+        shape=(len(image_names), *shape),
+        mrc_mode=mrcfile.utils.mode_from_dtype(first.dtype),
+        overwrite=True,
+    ) as mrcs, tqdm(total=len(image_names)) as pbar:
+        mrcs.voxel_size = angpix
+        start = 0
+
+        reader = VolumeReader(name_chunks, read_ahead)
+
+        try:
+            for volumes in perf.timed(reader, "read volumes"):
+                perf.read(nbytes=volumes.nbytes)
+
+                with perf.stage("write stack"):
+                    mrcs.data[start : start + len(volumes)] = volumes
+
+                start += len(volumes)
+                pbar.update(len(volumes))
+
+        # Volumes of different shapes can neither be stacked nor written
+        except ValueError as e:
+            raise click.ClickException(
+                f"Could not pack volumes {image_names[start]} to "
+                f"{image_names[min(start + chunk, len(image_names)) - 1]}: all "
+                f"volumes need the shape {shape} of the first ({e})."
+            ) from None
+
+        with perf.stage("write stack"):
+            mrcs.update_header_stats()
+
+    perf.wrote(out_mrcs)
+
+    return [f"{i}@{out_mrcs}" for i in range(1, len(image_names) + 1)]
+
+
+@click.command()
+@metrics.instrumented()
+@click.option(
+    "--ctf/--no-ctf",
+    default=True,
+    show_default=True,
+    help="Also pack the CTF volumes (rlnCtfImage), if the star has them.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=4,
+    type=int,
+    show_default=True,
+    help="Number of chunks read in parallel.",
+)
+@click.option(
+    "--chunk",
+    default=64,
+    type=int,
+    show_default=True,
+    help="Number of volumes per read.",
+)
+@click.argument("input_star", nargs=1)
+def pack_subtomos(ctf, jobs, chunk, input_star):
+    """Pack subtomograms of a star into one memory-mapped volume stack.
+
+    Writes <stem>_subtomos.mrcs (and <stem>_ctfs.mrcs) next to the star, and
+    <stem>_packed.star referring to them as N@stack.mrcs. The original paths are
+    kept as rlnImageOriginalName. Each CTF file is packed once, even if many
+    particles share it. The packed star can be used with
+    project-particles and upgrade-star like the original.
+    """
+    input_star = Path(input_star)
+    perf = metrics.current()
+    base = input_star.with_name(input_star.stem)
+
+    with perf.stage("read star"):
+        star = star_io.read_star(input_star)
+
+    perf.read(input_star)
+    key = star_io.particles_key(star)
+    particles = star[key].copy()
+
+    print(f"Packing {len(particles.index)} subtomograms.")
+
+    # Keep the subtomogram paths, they identify the session of each tomogram
+    if "rlnImageOriginalName" not in particles:
+        particles["rlnImageOriginalName"] = particles["rlnImageName"]
+
+    particles["rlnImageName"] = pack_volumes(
+        particles["rlnImageName"].tolist(),
+        Path(f"{base}_subtomos.mrcs"),
+        chunk,
+        jobs,
+    )
+    perf.count("subtomograms packed", len(particles.index))
+
+    if ctf and "rlnCtfImage" in particles:
+        codes, ctf_names = pd.factorize(particles["rlnCtfImage"])
+        print(f"Packing {len(ctf_names)} CTF volumes.")
+
+        packed = pack_volumes(
+            ctf_names.tolist(), Path(f"{base}_ctfs.mrcs"), chunk, jobs
+        )
+        particles["rlnCtfImage"] = np.array(packed, dtype=object)[codes]
+        perf.count("CTF volumes packed", len(ctf_names))
+
+    out_star = Path(f"{base}_packed.star")
+
+    with perf.stage("write star"):
+        star_io.write_star({**star, key: particles}, out_star)
+
+    perf.wrote(out_star)
+
+    print(f"Wrote {out_star}.")
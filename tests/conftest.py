@@ -0,0 +1,5 @@
+"""Make the synthetic dataset generators of the benchmarks importable."""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "benchmarks"))
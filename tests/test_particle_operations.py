@@ -0,0 +1,129 @@
+import mrcfile
+import numpy as np
+import pytest
+import synthetic
+from click.testing import CliRunner
+
+from subtomotools import particle_operations
+
+BOX = 16
+
+
+def real_space_projection(subtomo, ctf=None, z_thickness=None):
+    """Project one subtomogram straightforwardly: apply CTF, average Z slices."""
+    if ctf is not None and ctf.shape == subtomo.shape:
+        subtomo = np.real(np.fft.ifftn(np.fft.fftn(subtomo) * ctf))
+    elif ctf is not None:
+        subtomo = np.fft.irfftn(
+            np.fft.rfftn(subtomo) * ctf, s=subtomo.shape, axes=(0, 1, 2)
+        )
+
+    if z_thickness is not None:
+        lower = int(np.floor((BOX - z_thickness) / 2))
+        subtomo = subtomo[lower : lower + z_thickness]
+
+    return subtomo.mean(axis=0)
+
+
+@pytest.fixture
+def subtomos():
+    """A batch of random subtomograms."""
+    rng = np.random.default_rng(0)
+    return rng.normal(size=(3, BOX, BOX, BOX)).astype(np.float32)
+
+
+def test_extract_boxes():
+    """Boxes match slices of the volume, boxes reaching outside are padded."""
+    volume = np.random.default_rng(0).normal(size=(20, 24, 28)).astype(np.float32)
+    centres = np.array([[10.0, 12.0, 8.0], [1.6, 20.0, 10.0], [0.0, 0.0, 0.0]])
+
+    boxes = particle_operations.extract_boxes(volume, centres, 8)
+
+    np.testing.assert_array_equal(boxes[0], volume[4:12, 8:16, 6:14])
+    np.testing.assert_array_equal(boxes[1, :, :, 2:], volume[6:14, 16:24, 0:6])
+    np.testing.assert_allclose(boxes[1, :, :, :2], volume[6:14, 16:24, 0:6].mean())
+    np.testing.assert_array_equal(boxes[2, 4:, 4:, 4:], volume[:4, :4, :4])
+
+
+def test_extract_boxes_outside():
+    """Boxes entirely outside the volume are an error, not blank particles."""
+    volume = np.zeros((20, 24, 28), dtype=np.float32)
+    centres = np.array([[10.0, 12.0, 8.0], [40.0, 12.0, 8.0], [10.0, 12.0, -4.0]])
+
+    assert particle_operations.boxes_outside(centres, 8, volume.shape).tolist() == [
+        False,
+        True,
+        True,
+    ]
+
+    with pytest.raises(ValueError, match=r"\[1, 2\]"):
+        particle_operations.extract_boxes(volume, centres, 8)
+
+
+@pytest.mark.parametrize("method", ["fourier", "real"])
+@pytest.mark.parametrize("layout", ["rfftn", "fftn", None])
+@pytest.mark.parametrize("z_thickness", [None, 6])
+@pytest.mark.parametrize("out_shape", [None, (8, 8), (10, 10)])
+def test_project_batch(subtomos, method, layout, z_thickness, out_shape):
+    """Projections match the real-space baseline, with and without CTF or --bin."""
+    rng = np.random.default_rng(1)
+    ctfs = [None] * len(subtomos)
+
+    if layout is not None:
+        # Random, but like a CTF the same at k and -k
+        ctfs = rng.uniform(size=subtomos.shape)
+        ctfs = (ctfs + np.roll(ctfs[:, ::-1, ::-1, ::-1], 1, axis=(1, 2, 3))) / 2
+        ctfs = ctfs.astype(np.float32)
+
+        if layout == "rfftn":
+            ctfs = ctfs[..., : BOX // 2 + 1]
+
+    projections = particle_operations.project_batch(
+        subtomos,
+        None if layout is None else ctfs,
+        z_thickness,
+        method=method,
+        out_shape=out_shape,
+    )
+
+    expected = np.stack(
+        [
+            real_space_projection(subtomo, ctf, z_thickness)
+            for subtomo, ctf in zip(subtomos, ctfs)
+        ]
+    )
+
+    if out_shape is not None:
+        expected = particle_operations.fourier_crop(expected, out_shape)
+
+    assert projections.shape == (len(subtomos), *(out_shape or (BOX, BOX)))
+    tolerance = 1e-5 * np.abs(expected).max()
+    np.testing.assert_allclose(projections, expected, atol=tolerance)
+
+
+def test_fourier_crop():
+    """Binning keeps band-limited images, sampled on the coarser grid."""
+    y, x = np.indices((BOX, BOX)) / BOX
+    image = 2 + np.cos(2 * np.pi * 3 * x) + np.sin(2 * np.pi * (2 * y + x))
+    binned = particle_operations.fourier_crop(image[np.newaxis], (BOX // 2, BOX // 2))
+
+    np.testing.assert_allclose(binned[0], image[::2, ::2], atol=1e-12)
+
+
+def test_project_particles_bin(tmp_path, monkeypatch):
+    """project-particles --ctf --bin gives the same stack with both methods."""
+    monkeypatch.chdir(tmp_path)
+    star = synthetic.warp_star(tmp_path, n_particles=12, n_tomograms=2)
+    synthetic.subtomo_volumes(tmp_path, star, box=16)
+    stacks = {}
+
+    for method in ("fourier", "real"):
+        result = CliRunner().invoke(
+            particle_operations.project_particles,
+            ["--ctf", "--bin", "2", "-r", "6", "--projection", method, "warp.star"],
+        )
+        assert result.exit_code == 0, result.output
+        stacks[method] = mrcfile.read("warp_projected.mrcs")
+
+    assert stacks["fourier"].shape == (12, 8, 8)
+    np.testing.assert_allclose(stacks["fourier"], stacks["real"], atol=1e-4)
@@ -0,0 +1,47 @@
+import os
+import pickle
+
+import pandas as pd
+import synthetic
+
+from subtomotools import star_io
+
+
+def assert_blocks_equal(blocks, other):
+    """Check that two dicts from read_star hold the same blocks."""
+    assert blocks.keys() == other.keys()
+
+    for name, block in blocks.items():
+        if isinstance(block, pd.DataFrame):
+            pd.testing.assert_frame_equal(block, other[name])
+        else:
+            assert block == other[name]
+
+
+def test_read_star_cache(tmp_path):
+    """Cached reads match a fresh read, for the same contents only."""
+    star = synthetic.relion31_star(tmp_path, n_particles=200, n_tomograms=3)
+
+    for typed in (False, True):
+        fresh = star_io.read_star(star, typed)
+        star_io.read_star(star, typed, cache=True)
+        assert_blocks_equal(fresh, star_io.read_star(star, typed, cache=True))
+
+    # Same size and modification time, other contents
+    stat = star.stat()
+    star.write_text(star.read_text().replace("TS_1.mrc", "TS_7.mrc"))
+    os.utime(star, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    particles = star_io.read_star(star, cache=True)["particles"]
+    assert "TS_7.mrc" in set(particles["rlnMicrographName"])
+
+
+def test_read_star_cache_no_pickle(tmp_path):
+    """A pickle in place of the cache is not loaded."""
+    star = synthetic.relion5_star(tmp_path, n_particles=20, n_tomograms=1)
+    fresh = star_io.read_star(star)
+
+    with open(star_io._cache_path(star), "wb") as f:
+        pickle.dump({"key": star_io._cache_key(star, False), "blocks": {}}, f)
+
+    assert_blocks_equal(fresh, star_io.read_star(star, cache=True))
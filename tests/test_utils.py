@@ -0,0 +1,27 @@
+import numpy as np
+
+from subtomotools import utils
+
+
+def test_seen_values_across_chunks():
+    """Values are only first seen once, within and across chunks."""
+    seen = utils.SeenValues()
+
+    assert seen.first_seen(np.array(["a", "b", "a"])).tolist() == [True, True, False]
+    assert seen.first_seen(["c", "b", "c"]).tolist() == [True, False, False]
+    assert len(seen) == 3
+
+
+def test_seen_values_hash_collisions(monkeypatch):
+    """Distinct values with the same hash are only taken as equal with exact=False."""
+    monkeypatch.setattr(utils, "hash", lambda value: len(value), raising=False)
+    chunks = [["ab", "cd"], ["ef", "ab", "xyz"], ["cd", "gh"]]
+
+    exact, hashed = utils.SeenValues(), utils.SeenValues(exact=False)
+
+    assert [exact.first_seen(chunk).tolist() for chunk in chunks] == [
+        [True, True],
+        [True, False, True],
+        [False, True],
+    ]
+    assert [hashed.first_seen(chunk).sum() for chunk in chunks] == [1, 1, 0]
@@ -0,0 +1,33 @@
+import starfile
+import synthetic
+from click.testing import CliRunner
+
+from subtomotools.star_operations import dedup_3d
+from subtomotools.volume_io import pack_subtomos
+
+
+def kept_particles(star):
+    """Return the coordinates of the particles of a star."""
+    particles = starfile.read(star)
+    return particles[["rlnCoordinateX", "rlnCoordinateY", "rlnCoordinateZ"]]
+
+
+def test_dedup_of_packed_star(tmp_path, monkeypatch):
+    """dedup-3d keeps the same particles of a star before and after packing."""
+    monkeypatch.chdir(tmp_path)
+    star = synthetic.warp_star(tmp_path, n_particles=150, n_tomograms=3)
+    synthetic.subtomo_volumes(tmp_path, star, box=8)
+    runner = CliRunner()
+
+    result = runner.invoke(pack_subtomos, [star.name])
+    assert result.exit_code == 0, result.output
+
+    for name in (star.name, "warp_packed.star"):
+        result = runner.invoke(dedup_3d, ["-r", "50", name])
+        assert result.exit_code == 0, result.output
+
+    original = kept_particles("warp_dedup.star")
+    packed = kept_particles("warp_packed_dedup.star")
+
+    assert len(original) < 150
+    assert original.equals(packed)